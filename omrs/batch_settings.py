@@ -0,0 +1,22 @@
+"""
+Settings for running the management commands only, e.g. from scripts:
+
+    manage.py extract_db --settings=omrs.batch_settings ...
+
+or with DJANGO_SETTINGS_MODULE=omrs.batch_settings. The databases and the other settings are
+those of omrs/settings.py, but the web stack (admin, auth, sessions, messages, staticfiles and
+their middleware) is not loaded, Django's logging configuration (which imports the debug views
+to report request errors) is skipped, and DEBUG is off so that queries are not logged in memory.
+"""
+from omrs.settings import *
+
+DEBUG = False
+TEMPLATE_DEBUG = False
+
+INSTALLED_APPS = (
+    'omrs',
+)
+
+MIDDLEWARE_CLASSES = ()
+
+LOGGING_CONFIG = None
@@ -1,4 +1,13 @@
 """ Init for commands """
+from collections import OrderedDict, namedtuple
+from contextlib import contextmanager
+import datetime, json, uuid, time, sys, resource, re
+from django.conf import settings
+from django.core.management import CommandError
+from django.db import models, connections
+from django.db.backends.util import CursorWrapper
+from omrs.models import ConceptName
+from omrs.routers import ReadDatabaseRouter
 
 
 class UnrecognizedSourceException(Exception):
@@ -83,16 +92,739 @@ class OclOpenmrsHelper(object):
 #        raise UnrecognizedSourceException('Source %s not found in source directory.' % ocl_source_id)
         return None
 
-class ConceptHelper(object):
-    """ Helper class for Concept id mapping """
+
+def use_read_database(alias=None):
+    """
+    Routes the reads of a read-only command to a database alias, or to settings.READ_DATABASE if
+    no alias is given, and returns the alias
+    """
+    alias = alias or getattr(settings, 'READ_DATABASE', 'default')
+    if alias not in connections.databases:
+        raise CommandError('ERROR: unknown database "%s"' % alias)
+    ReadDatabaseRouter.use_for_reads(alias)
+    return alias
+
+
+class JournaledIndex(object):
+    """
+    Base class for the in-memory indexes kept during a sync. Changes made between begin()
+    and rollback() are undone, so an index stays consistent with the database when a
+    transaction fails.
+    """
+
+    def __init__(self):
+        self.values = {}
+        self.journal = None
+
+    def __len__(self):
+        return len(self.values)
+
+    def set_value(self, key, value):
+        """ Sets the value for key, recording the previous value if a journal is active """
+        if self.journal is not None:
+            self.journal.append((key, self.values.get(key)))
+        self.values[key] = value
+
+    def begin(self):
+        """ Starts recording changes so that they can be undone with rollback() """
+        self.journal = []
+
+    def commit(self):
+        """ Keeps the changes made since begin() """
+        self.journal = None
+
+    def rollback(self):
+        """ Undoes the changes made since begin(), e.g. when a database transaction failed """
+        for key, previous_value in reversed(self.journal or []):
+            if previous_value is None:
+                del self.values[key]
+            else:
+                self.values[key] = previous_value
+        self.journal = None
+
+
+class ConceptCrosswalk(JournaledIndex):
+    """
+    Hash-based crosswalk from source concept IDs (the OCL/OpenMRS export) to the concept IDs
+    in the target database. The crosswalk is built while syncing concepts and can be saved
+    to a tab-separated file so that later runs and other tools can load it instantly.
+    """
+
+    def add(self, old_concept_id, new_concept_id):
+        """ Records the new ID for the specified source concept ID """
+        self.set_value(int(old_concept_id), int(new_concept_id))
+
+    def get_new_id(self, old_concept_id):
+        """ Returns the new ID for the specified source concept ID, None if it is not known """
+        if old_concept_id is None:
+            return None
+        return self.values.get(int(old_concept_id))
+
+    def save(self, filename):
+        """ Writes the crosswalk to a file, one "old_id<TAB>new_id" pair per line """
+        with open(filename, 'w') as crosswalk_file:
+            for old_concept_id in sorted(self.values):
+                crosswalk_file.write('%d\t%d\n' % (old_concept_id, self.values[old_concept_id]))
 
     @classmethod
-    def get_new_id(cls, concepts, old_concept_id):
-        """ Returns the new ID for the specified source """
-        if not concepts and not ocl_concept_id:
-            raise Exception('Must pass only concepts list and old concept_id.')
-
-        for item in concepts:
-            if item['id'] == old_concept_id:
-                return item['new_id']
+    def load(cls, filename):
+        """ Returns a crosswalk loaded from a file written by save() """
+        crosswalk = cls()
+        with open(filename, 'r') as crosswalk_file:
+            for line in crosswalk_file:
+                if line.strip():
+                    old_concept_id, new_concept_id = line.split('\t')
+                    crosswalk.add(old_concept_id, new_concept_id)
+        return crosswalk
+
+
+class LookupCache(JournaledIndex):
+    """
+    Get-or-create cache of a lookup table (concept classes, datatypes, reference sources,
+    map types or reference terms). The table is preloaded with one query and rows created
+    during the run are added, so each distinct value costs at most one query per run.
+
+    Keys are compared case-insensitively, like the default collation of the OpenMRS schema.
+    If value_field is set, only that column (e.g. the primary key) is kept for each row
+    instead of the model instance, which keeps large tables such as reference terms small.
+    """
+
+    def __init__(self, model, key_fields, value_field=None, using='default'):
+        super(LookupCache, self).__init__()
+        self.model = model
+        self.key_fields = key_fields
+        self.value_field = value_field
+        queryset = model._default_manager.db_manager(using).all()
+        if value_field:
+            rows = queryset.values_list(*(list(key_fields) + [value_field])).iterator()
+            for row in rows:
+                self.values.setdefault(self.make_key(row[:-1]), row[-1])
+        else:
+            for obj in queryset.iterator():
+                self.values.setdefault(self.make_key([getattr(obj, f) for f in key_fields]), obj)
+
+    @staticmethod
+    def make_key(key_values):
+        return tuple(unicode(value).lower() for value in key_values)
+
+    def get(self, *key_values):
+        """ Returns the cached row (or value_field) for the key, None if it does not exist """
+        return self.values.get(self.make_key(key_values))
+
+    def add(self, value, *key_values):
+        """ Adds a row created during the run """
+        self.set_value(self.make_key(key_values), value)
+
+
+class ConceptNameIndex(JournaledIndex):
+    """
+    In-memory (name, locale) -> concept ID index of the non-voided concept names, used to
+    match incoming concepts without a query per name. It is loaded with a keyset-paginated
+    scan of concept_name so memory use is bounded by the index itself. Keys are lower-cased
+    like the collation of the OpenMRS schema and stored as UTF-8 byte strings, which keeps
+    an index of ~500k names to a few tens of MB.
+    """
+
+    # Number of concept_name rows fetched per query while loading
+    LOAD_BATCH_SIZE = 10000
+
+    def __init__(self, using='default'):
+        super(ConceptNameIndex, self).__init__()
+        last_concept_name_id = 0
+        while True:
+            rows = list(ConceptName.objects.using(using).filter(
+                voided=False, concept_name_id__gt=last_concept_name_id).order_by(
+                'concept_name_id').values_list('concept_name_id', 'name', 'locale', 'concept_id')[:self.LOAD_BATCH_SIZE])
+            if not rows:
+                break
+            for concept_name_id, name, locale, concept_id in rows:
+                self.values.setdefault(self.make_key(name, locale), concept_id)
+            last_concept_name_id = rows[-1][0]
+
+    @staticmethod
+    def make_key(name, locale):
+        return (u'%s\t%s' % (locale, name)).lower().encode('utf-8')
+
+    def get(self, name, locale):
+        """ Returns the ID of the concept with this name, None if there is none """
+        return self.values.get(self.make_key(name, locale))
+
+    def add(self, concept_id, name, locale):
+        """ Adds a name inserted during the run """
+        self.set_value(self.make_key(name, locale), concept_id)
+
+
+class ExistingRows(object):
+    """
+    Existence checks for a chunk of input records. load() finds which of the given values
+    (typically uuids) already exist in a table with one 'IN (...)' query per QUERY_BATCH_SIZE
+    values, replacing what was known about that table. Rows queued afterwards can be added
+    with add(), so that values repeated within the chunk are only inserted once. Keys are
+    made like LookupCache keys.
+    """
+
+    # Maximum number of values per 'IN (...)' query (SQLite allows 999 parameters)
+    QUERY_BATCH_SIZE = 500
+
+    def __init__(self, using='default'):
+        self.using = using
+        self.rows = {}
+
+    def load(self, model, field, values, key_fields=('uuid',), value_field=None):
+        """ Loads the rows of model whose field is in values, keyed by key_fields """
+        rows = {}
+        values = list(set(value for value in values if value is not None))
+        fields = tuple(key_fields) + ((value_field,) if value_field else ())
+        for i in range(0, len(values), self.QUERY_BATCH_SIZE):
+            queryset = model._default_manager.db_manager(self.using).filter(
+                **{field + '__in': values[i:i + self.QUERY_BATCH_SIZE]}).values_list(*fields)
+            for row in queryset:
+                if value_field:
+                    rows[LookupCache.make_key(row[:-1])] = row[-1]
+                else:
+                    rows[LookupCache.make_key(row)] = True
+        self.rows[model] = rows
+
+    def get(self, model, *key_values):
+        """ Returns the value (or True) of an existing row, None if it does not exist """
+        return self.rows.get(model, {}).get(LookupCache.make_key(key_values))
+
+    def add(self, model, value, *key_values):
+        """ Records a row queued for insertion """
+        self.rows.setdefault(model, {})[LookupCache.make_key(key_values)] = value
+
+
+## COMPACT EXPORT RECORDS
+
+# Shared copies of the strings that repeat across the records of an export file. intern()
+# only takes byte strings in Python 2, and the parsed JSON strings are unicode.
+_interned_strings = {}
+
+
+def intern_string(value):
+    """ Returns the shared copy of a repeated string (locale, name type, class, map type, source...) """
+    if value is None:
         return None
+    return _interned_strings.setdefault(value, value)
+
+
+ConceptNameRecord = namedtuple('ConceptNameRecord', 'name locale name_type locale_preferred external_id')
+ConceptDescriptionRecord = namedtuple('ConceptDescriptionRecord', 'description locale external_id')
+
+
+class ConceptRecord(object):
+    """
+    A concept of an export file, with only the fields the sync uses. Records use slots and
+    tuples instead of dicts, and share their repeated strings, since a sync may hold a whole
+    export in memory (e.g. when syncing several databases).
+    """
+    __slots__ = ('id', 'external_id', 'concept_class', 'datatype', 'retired', 'is_set', 'description',
+                 'numeric', 'names', 'descriptions')
+
+    def __init__(self, data):
+        extras = data.get('extras') or {}
+        self.id = data['id']
+        self.external_id = data.get('external_id')
+        self.concept_class = intern_string(data['concept_class'])
+        self.datatype = intern_string(data['datatype'])
+        self.retired = data['retired']
+        self.is_set = extras.get('is_set', 0)
+        self.description = data.get('description')
+        self.numeric = extras if self.datatype == 'Numeric' else None
+        self.names = tuple(ConceptNameRecord(
+            cname['name'], intern_string(cname['locale']), intern_string(cname['name_type']),
+            cname['locale_preferred'], cname['external_id']) for cname in data['names'])
+        self.descriptions = tuple(ConceptDescriptionRecord(
+            cdescription['description'], intern_string(cdescription['locale']), cdescription['external_id'])
+            for cdescription in data['descriptions'])
+
+    def get_fields(self):
+        """ Returns the content of the record as a tuple, e.g. to hash it """
+        return tuple(getattr(self, field) for field in self.__slots__)
+
+
+class MappingRecord(object):
+    """
+    A mapping of an export file. The source and concept ID of its concept URLs are parsed
+    once, when the record is read. kind is INTERNAL (to a concept of the export), EXTERNAL
+    (to a code of another source), or None if the mapping has neither.
+    """
+    __slots__ = ('kind', 'external_id', 'map_type', 'from_source', 'from_concept_id', 'to_source',
+                 'to_concept_id', 'to_concept_code')
+
+    INTERNAL = 'internal'
+    EXTERNAL = 'external'
+
+    def __init__(self, data):
+        self.external_id = data.get('external_id')
+        self.map_type = intern_string(data.get('map_type'))
+        self.from_source, self.from_concept_id = self.parse_url(data.get('from_concept_url'))
+        self.to_concept_id = self.to_concept_code = None
+        if 'to_concept_url' in data:
+            self.kind = self.INTERNAL
+            self.to_source, self.to_concept_id = self.parse_url(data['to_concept_url'])
+        elif 'to_source_url' in data:
+            self.kind = self.EXTERNAL
+            self.to_source = self.parse_url(data['to_source_url'])[0]
+            self.to_concept_code = data.get('to_concept_code')
+        else:
+            self.kind = self.to_source = None
+
+    @staticmethod
+    def parse_url(url):
+        """
+        Returns (source, concept ID) of an '/orgs/ORG/sources/SOURCE/concepts/ID/' URL, or of
+        a source URL without the concept part. The URL may be absolute or relative, with or
+        without the trailing slash. Parts that are missing or invalid are None.
+        """
+        parts = [part for part in (url or '').split('/') if part]
+        if 'sources' not in parts:
+            return None, None
+        pos = parts.index('sources')
+        source = intern_string(parts[pos + 1]) if len(parts) > pos + 1 else None
+        concept_id = None
+        if len(parts) > pos + 3 and parts[pos + 2] == 'concepts':
+            try:
+                concept_id = int(parts[pos + 3])
+            except ValueError:
+                pass
+        return source, concept_id
+
+    def get_fields(self):
+        """ Returns the content of the record as a tuple, e.g. to hash it """
+        return tuple(getattr(self, field) for field in self.__slots__)
+
+
+class SyncStats(object):
+    """
+    Per-phase instrumentation of a sync. The wall time, the number of SQL queries and the time
+    spent in them are charged to the innermost active phase, except for the writes of a
+    BulkWriter flush, which are split between the phases that queued the rows, in proportion
+    to their number of rows. Each phase also counts the rows it inserted and skipped and the
+    growth of the peak memory of the process (ru_maxrss) while it was active: the peak only ever
+    goes up, so it is reported once for the whole process. When disabled, all methods are no-ops.
+    """
+
+    # Phase that everything outside of a named phase is charged to
+    OTHER_PHASE = 'other'
+
+    def __init__(self, enabled=True, using='default'):
+        self.enabled = enabled
+        self.using = using
+        self.phases = OrderedDict()
+        self.stack = [self.OTHER_PHASE]
+        self.started = self.mark = time.time()
+        self.memory_mark = self.get_peak_memory()
+        self.counter = None
+        if enabled:
+            # Queries are counted without keeping them, which would add to the memory measured
+            self.counter = QueryCounter(using)
+            self.cnt_queries_mark = 0
+            self.query_time_mark = 0.0
+            self.get_phase(self.OTHER_PHASE)
+
+    @property
+    def current(self):
+        """ Name of the innermost active phase """
+        return self.stack[-1]
+
+    def get_phase(self, name):
+        phase = self.phases.get(name)
+        if phase is None:
+            phase = self.phases[name] = {'inserted': 0, 'skipped': 0, 'queries': 0, 'query_time': 0.0,
+                                         'time': 0.0, 'memory_growth_kb': 0.0}
+        return phase
+
+    @staticmethod
+    def get_peak_memory():
+        """ Returns the peak memory of the process so far, in KB on Linux """
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    @contextmanager
+    def phase(self, name):
+        """ Charges what is done inside the with block to the named phase """
+        if not self.enabled:
+            yield
+            return
+        self.charge()
+        self.stack.append(name)
+        try:
+            yield
+        finally:
+            self.charge()
+            self.stack.pop()
+
+    @contextmanager
+    def write(self, row_phases):
+        """ Charges a write to the phases that queued its rows, one phase name per row """
+        if not self.enabled:
+            yield
+            return
+        self.charge()
+        shares = {}
+        for name in row_phases:
+            shares[name] = shares.get(name, 0) + 1
+        try:
+            yield
+        finally:
+            self.charge(shares)
+        for name, count in shares.items():
+            self.get_phase(name)['inserted'] += count
+
+    def charge(self, shares=None):
+        """
+        Charges the time, queries and peak memory growth since the last call to the current
+        phase, or splits them between phases in proportion to shares, a {phase name: number of
+        rows} dict
+        """
+        now = time.time()
+        cnt_queries = self.counter.count - self.cnt_queries_mark
+        query_time = self.counter.time - self.query_time_mark
+        self.cnt_queries_mark, self.query_time_mark = self.counter.count, self.counter.time
+        memory = self.get_peak_memory()
+        shares = shares or {self.current: 1}
+        total = float(sum(shares.values()))
+        for name, share in shares.items():
+            phase = self.get_phase(name)
+            phase['time'] += (now - self.mark) * share / total
+            phase['queries'] += cnt_queries * share / total
+            phase['query_time'] += query_time * share / total
+            phase['memory_growth_kb'] += (memory - self.memory_mark) * share / total
+        self.mark = now
+        self.memory_mark = memory
+
+    def insert(self, count=1):
+        """ Counts rows inserted by the current phase outside of a BulkWriter """
+        if self.enabled:
+            self.get_phase(self.current)['inserted'] += count
+
+    def skip(self, count=1):
+        """ Counts rows the current phase found already existing """
+        if self.enabled:
+            self.get_phase(self.current)['skipped'] += count
+
+    def merge(self, phases):
+        """ Adds the phases of another process, e.g. a parallel worker """
+        for name, other in phases.items():
+            phase = self.get_phase(name)
+            for key, value in other.items():
+                phase[key] += value
+
+    def get_report(self):
+        """ Returns the phases as a dict that can be saved as JSON """
+        self.charge()
+        phases = OrderedDict()
+        for name, phase in self.phases.items():
+            phases[name] = OrderedDict([
+                ('inserted', phase['inserted']),
+                ('skipped', phase['skipped']),
+                ('queries', int(round(phase['queries']))),
+                ('query_time', round(phase['query_time'], 3)),
+                ('time', round(phase['time'], 3)),
+                ('rows_per_second', round(phase['inserted'] / phase['time'], 1) if phase['time'] else None),
+                ('memory_growth_kb', int(round(phase['memory_growth_kb']))),
+            ])
+        return OrderedDict([
+            ('elapsed', round(time.time() - self.started, 3)),
+            ('peak_memory_kb', self.get_peak_memory()),
+            ('phases', phases),
+        ])
+
+    def track(self, records, label, total, interval=1.0):
+        """
+        Yields records while showing a progress line on stderr at most every 'interval' seconds,
+        with the rate, the ETA and, when enabled, the phase that took the most time so far
+        """
+        started = last = time.time()
+        done = 0
+        for record in records:
+            yield record
+            done += 1
+            now = time.time()
+            if now - last >= interval:
+                last = now
+                self.show_progress(label, done, total, now - started)
+        self.show_progress(label, done, total, time.time() - started)
+        sys.stderr.write('\n')
+
+    def show_progress(self, label, done, total, elapsed):
+        rate = done / elapsed if elapsed else 0.0
+        line = '%s: %d/%d (%d%%), %.0f records/s, elapsed %s' % (
+            label, done, total, 100 * done / total if total else 100, rate, datetime.timedelta(seconds=int(elapsed)))
+        if rate and total > done:
+            line += ', ETA %s' % datetime.timedelta(seconds=int((total - done) / rate))
+        if self.enabled:
+            self.charge()
+            name = max(self.phases, key=lambda name: self.phases[name]['time'])
+            line += ', slowest phase: %s (%.0fs, %d queries)' % (
+                name, self.phases[name]['time'], self.phases[name]['queries'])
+        sys.stderr.write('\r%s\033[K' % line)
+        sys.stderr.flush()
+
+
+class QueryCounter(object):
+    """
+    Counts the SQL queries run on a connection and the time spent in them. Unlike Django's debug
+    cursor, the queries themselves are not kept, so counting does not add to the memory use of a
+    long command.
+    """
+
+    def __init__(self, using='default'):
+        self.count = 0
+        self.time = 0.0
+        connection = connections[using]
+        connection.use_debug_cursor = True
+        connection.make_debug_cursor = lambda cursor: CountingCursorWrapper(cursor, connection, self)
+
+
+class CountingCursorWrapper(CursorWrapper):
+    """ Cursor that adds each execute() and executemany() call, and its time, to a QueryCounter """
+
+    def __init__(self, cursor, db, counter):
+        super(CountingCursorWrapper, self).__init__(cursor, db)
+        self.counter = counter
+
+    def execute(self, sql, params=None):
+        self.counter.count += 1
+        start = time.time()
+        try:
+            return super(CountingCursorWrapper, self).execute(sql, params)
+        finally:
+            self.counter.time += time.time() - start
+
+    def executemany(self, sql, param_list):
+        self.counter.count += 1
+        start = time.time()
+        try:
+            return super(CountingCursorWrapper, self).executemany(sql, param_list)
+        finally:
+            self.counter.time += time.time() - start
+
+
+class RenamingCursor(object):
+    """
+    Cursor proxy that adds a suffix to every table and index name with a given prefix in the SQL
+    it executes, e.g. to give the staging tables of a sync names of their own
+    """
+
+    def __init__(self, cursor, prefix, suffix):
+        self.cursor = cursor
+        self.suffix = suffix
+        self.name_pattern = re.compile(r'\b%s\w+' % re.escape(prefix))
+
+    def rename(self, sql):
+        return self.name_pattern.sub(lambda match: match.group(0) + self.suffix, sql)
+
+    def execute(self, sql, params=None):
+        return self.cursor.execute(self.rename(sql), params)
+
+    def executemany(self, sql, param_list):
+        return self.cursor.executemany(self.rename(sql), param_list)
+
+    def __getattr__(self, attr):
+        return getattr(self.cursor, attr)
+
+
+class BulkWriter(object):
+    """
+    Accumulates new model instances per table and inserts them with multi-row bulk_create
+    statements once batch_size rows are pending.
+
+    A row may depend on a parent row that has not been inserted yet (e.g. a concept name on
+    a new concept). bulk_create does not return generated primary keys on MySQL, so parent
+    keys of the models listed in resolve_models are looked up by uuid after each flush and
+    copied into the foreign key of the dependent rows before they are inserted. The tables
+    in resolve_models are flushed first, the others in the order they were first used.
+
+    Pending rows can be registered under a key and found with get_pending(), so that
+    get-or-create logic also sees rows that have not been written yet.
+
+    If write_models is set, rows of other models are ignored. This is used to create only the
+    rows shared between parallel workers ahead of them.
+
+    If stats is set, each row is tagged with the phase that queued it, and the writes are
+    charged to those phases.
+    """
+
+    # Maximum number of uuids per query when resolving generated primary keys
+    RESOLVE_BATCH_SIZE = 500
+
+    def __init__(self, batch_size=1000, using='default', resolve_models=(), write_models=None, stats=None):
+        self.batch_size = batch_size
+        self.stats = stats if stats is not None else SyncStats(enabled=False)
+        self.using = using
+        self.resolve_models = set(resolve_models)
+        self.write_models = set(write_models) if write_models is not None else None
+        self.pending = OrderedDict()
+        self.pending_phases = {}
+        self.pending_keys = {}
+        self.dependencies = []
+        self.callbacks = []
+        self.cnt_pending = 0
+        self.cnt_inserted = {}
+
+    def add(self, obj, key=None, depends_on=None, fk_attname=None):
+        """
+        Queues obj for insertion.
+
+        :param key: Optional key to find the pending row with get_pending().
+        :param depends_on: Pending parent row whose primary key is copied into fk_attname.
+        """
+        model = type(obj)
+        if self.write_models is not None and model not in self.write_models:
+            return
+        self.pending.setdefault(model, []).append(obj)
+        if self.stats.enabled:
+            self.pending_phases.setdefault(model, []).append(self.stats.current)
+        if key is not None:
+            self.pending_keys[(model, key)] = obj
+        if depends_on is not None:
+            self.add_dependency(obj, depends_on, fk_attname)
+        self.cnt_pending += 1
+        if self.cnt_pending >= self.batch_size:
+            self.flush()
+
+    def add_dependency(self, obj, parent, fk_attname):
+        """ Sets fk_attname of obj to the primary key of parent, once parent is inserted """
+        if parent.pk is None:
+            self.dependencies.append((obj, parent, fk_attname))
+        else:
+            setattr(obj, fk_attname, parent.pk)
+
+    def save(self, obj):
+        """ Inserts a single row right away, e.g. metadata that pending rows refer to """
+        obj.save(using=self.using)
+
+    def add_callback(self, obj, callback):
+        """ Calls callback with obj once it is inserted and its primary key is known """
+        if obj.pk is not None:
+            callback(obj)
+        else:
+            self.callbacks.append((obj, callback))
+
+    def get_pending(self, model, key):
+        """ Returns the pending row registered under key, or None """
+        return self.pending_keys.get((model, key))
+
+    def flush(self):
+        """ Inserts all pending rows, resolving primary keys of parent rows on the way """
+        dependencies = {}
+        for obj, parent, fk_attname in self.dependencies:
+            dependencies.setdefault(type(obj), []).append((obj, parent, fk_attname))
+        models = sorted(self.pending, key=lambda model: model not in self.resolve_models)
+        for model in models:
+            objs = self.pending[model]
+            for obj, parent, fk_attname in dependencies.get(model, []):
+                setattr(obj, fk_attname, parent.pk)
+            with self.stats.write(self.pending_phases.get(model, ())):
+                self.insert_rows(model, objs)
+            self.cnt_inserted[model.__name__] = self.cnt_inserted.get(model.__name__, 0) + len(objs)
+        for obj, callback in self.callbacks:
+            callback(obj)
+        self.discard()
+
+    def insert_rows(self, model, objs):
+        """ Writes the rows of one table with multi-row inserts """
+        # Django does not cap an explicit batch size to the limits of the database (SQLite
+        # allows 999 parameters and 500 rows per statement)
+        batch_size = min(self.batch_size, connections[self.using].ops.bulk_batch_size(model._meta.local_fields, objs))
+        model._default_manager.db_manager(self.using).bulk_create(objs, batch_size=max(batch_size, 1))
+        if model in self.resolve_models:
+            self.resolve_pks(model, objs)
+
+    def discard(self):
+        """ Drops all pending rows without writing them, e.g. when a database transaction failed """
+        self.pending = OrderedDict()
+        self.pending_phases = {}
+        self.pending_keys = {}
+        self.dependencies = []
+        self.callbacks = []
+        self.cnt_pending = 0
+
+    def resolve_pks(self, model, objs):
+        """ Sets the generated primary keys of inserted rows by looking them up by uuid """
+        pk_name = model._meta.pk.attname
+        objs_by_uuid = dict((str(obj.uuid), obj) for obj in objs if obj.pk is None)
+        uuids = objs_by_uuid.keys()
+        for i in range(0, len(uuids), self.RESOLVE_BATCH_SIZE):
+            rows = model._default_manager.db_manager(self.using).filter(
+                uuid__in=uuids[i:i + self.RESOLVE_BATCH_SIZE]).values_list('uuid', pk_name)
+            for row_uuid, pk in rows:
+                setattr(objs_by_uuid[str(row_uuid)], pk_name, pk)
+
+
+class PlanWriter(BulkWriter):
+    """
+    BulkWriter for dry runs. Instead of being inserted, rows are written to a JSON-lines plan
+    file and given synthetic negative primary keys, so rows that depend on them are planned
+    exactly as in a real run. Planned rows stay visible to get_pending(), as rows inserted
+    by a real run would be to its existence queries. A plan record holds the model name, the synthetic ID and the
+    field values; foreign keys to planned rows hold their synthetic IDs. Records are written
+    parents first, so a plan can be applied in file order with make_row().
+    """
+
+    def __init__(self, plan_file, batch_size=1000, using='default', resolve_models=(), stats=None):
+        super(PlanWriter, self).__init__(batch_size=batch_size, using=using, resolve_models=resolve_models, stats=stats)
+        self.plan_file = plan_file
+        self.last_synthetic_id = 0
+        self.planned_keys = {}
+
+    def get_pending(self, model, key):
+        obj = super(PlanWriter, self).get_pending(model, key)
+        if obj is None:
+            obj = self.planned_keys.get((model, key))
+        return obj
+
+    def flush(self):
+        pending_keys = self.pending_keys
+        super(PlanWriter, self).flush()
+        self.planned_keys.update(pending_keys)
+
+    def save(self, obj):
+        self.write_rows(type(obj), [obj], saved=True)
+
+    def insert_rows(self, model, objs):
+        self.write_rows(model, objs)
+
+    def write_rows(self, model, objs, saved=False):
+        """ Gives the rows synthetic primary keys and writes their plan records """
+        pk_name = model._meta.pk.attname
+        for obj in objs:
+            self.last_synthetic_id -= 1
+            setattr(obj, pk_name, self.last_synthetic_id)
+            fields = dict((field.attname, self.to_json_value(getattr(obj, field.attname)))
+                          for field in model._meta.fields if not field.primary_key)
+            record = {'model': model.__name__, 'id': self.last_synthetic_id, 'fields': fields}
+            if saved:
+                record['saved'] = True
+            self.write_record(record)
+
+    def write_record(self, record):
+        self.plan_file.write(json.dumps(record) + '\n')
+
+    @staticmethod
+    def to_json_value(value):
+        if isinstance(value, (datetime.datetime, datetime.date)):
+            return value.isoformat()
+        if isinstance(value, uuid.UUID):
+            return str(value)
+        return value
+
+    @staticmethod
+    def make_row(record):
+        """
+        Returns (obj, references) for a plan record, where references lists the
+        (fk_attname, synthetic_id) pairs of foreign keys to other planned rows.
+        """
+        model = models.get_model('omrs', record['model'])
+        values = {}
+        references = []
+        for field in model._meta.fields:
+            if field.attname not in record['fields']:
+                continue
+            value = record['fields'][field.attname]
+            if isinstance(field, models.ForeignKey) and value is not None and value < 0:
+                references.append((field.attname, value))
+                value = None
+            values[field.attname] = field.to_python(value) if value is not None else None
+        return model(**values), references
@@ -0,0 +1,372 @@
+"""
+Command to benchmark extract_db, validate_export and sync_bahmni_db end to end on synthetic
+dictionaries made by generate_dictionary, at several scales.
+
+Example usage:
+
+    manage.py benchmark [--scales=1000,10000,100000] [--dir=WORK_DIRECTORY] [--output=RESULTS_FILENAME]
+
+Scales are numbers of concepts. A generated concept has about ten rows, so the default scales
+are dictionaries of about 10k, 100k and 1M rows. For each scale:
+
+- generate_dictionary creates the dictionary in a SQLite database
+- extract_db exports its concepts, then its mappings
+- validate_export compares an OCL export made from these files to the dictionary
+- sync_bahmni_db loads the files into an empty database, then syncs them again
+
+Each step runs in its own process, with its default database pointed at the SQLite file of the
+step, so the peak RSS of a step is its own. The wall time, the number of SQL queries and the peak
+RSS of every step are printed, and saved as JSON with 'output'. The databases and files are
+written to a temporary directory that is removed at the end, unless 'dir' is given.
+
+With 'baseline', the benchmark is a regression gate: it runs the scales and seed of a results
+file saved earlier with 'output', and fails if a step issues more queries than its budget. The
+query budget of a step is its 'max_queries' in the baseline file, or its baseline value plus
+'query_tolerance' (a fraction). Times depend on the machine, so they are only advisory: a step
+slower than its baseline time plus 'time_tolerance' (or its 'max_time') is flagged as SLOW, and
+only fails the gate with 'enforce_time', e.g. on the machine the baseline was recorded on. Time
+differences under TIME_SLACK seconds are ignored, as short steps are dominated by noise. Each
+step is listed with its baseline, its change and its budget. With 'results', a results file
+saved with 'output' is checked against the baseline instead of running the benchmark.
+
+    manage.py benchmark --baseline=benchmark_baseline.json [--query_tolerance=0.1] [--time_tolerance=0.5] [--enforce_time]
+    manage.py benchmark --baseline=benchmark_baseline.json --results=RESULTS_FILENAME
+
+"""
+from optparse import make_option
+import json, math, multiprocessing, os, resource, shutil, sqlite3, sys, tempfile, time
+from django.core.management import BaseCommand, CommandError, call_command
+from django.db import connections
+from omrs.management.commands import MappingRecord, QueryCounter
+
+
+class Command(BaseCommand):
+    """
+    Benchmark extract_db, validate_export and sync_bahmni_db on synthetic dictionaries
+    """
+
+    DEFAULT_SCALES = '1000,10000,100000'
+    DEFAULT_QUERY_TOLERANCE = 0.1
+    DEFAULT_TIME_TOLERANCE = 0.5
+    TIME_SLACK = 0.1
+    ORG_ID = 'CIEL'
+    SOURCE_ID = 'CIEL'
+
+    # Command attributes
+    help = 'Benchmark extract_db, validate_export and sync_bahmni_db on synthetic dictionaries'
+    option_list = BaseCommand.option_list + (
+        make_option('--scales',
+                    dest='scales',
+                    default=None,
+                    help='Comma-separated numbers of concepts of the generated dictionaries, default %s' % DEFAULT_SCALES),
+        make_option('--dir',
+                    dest='directory',
+                    default=None,
+                    help='Directory for the databases and files of the benchmark, which are then kept'),
+        make_option('--output',
+                    dest='output_filename',
+                    default=None,
+                    help='File to save the results to as JSON'),
+        make_option('--seed',
+                    type='int',
+                    dest='seed',
+                    default=None,
+                    help='Seed of the generated dictionaries, default 1'),
+        make_option('--baseline',
+                    dest='baseline_filename',
+                    default=None,
+                    help='Results file to compare to; the command fails if a step exceeds its budget'),
+        make_option('--query_tolerance',
+                    type='float',
+                    dest='query_tolerance',
+                    default=DEFAULT_QUERY_TOLERANCE,
+                    help='Fraction of queries over the baseline allowed, default %s' % DEFAULT_QUERY_TOLERANCE),
+        make_option('--time_tolerance',
+                    type='float',
+                    dest='time_tolerance',
+                    default=DEFAULT_TIME_TOLERANCE,
+                    help='Fraction of time over the baseline allowed, default %s' % DEFAULT_TIME_TOLERANCE),
+        make_option('--enforce_time',
+                    action='store_true',
+                    dest='enforce_time',
+                    default=False,
+                    help='Fail the baseline check on time too, not only on queries'),
+        make_option('--results',
+                    dest='results_filename',
+                    default=None,
+                    help='Results file saved with --output to check against the baseline, instead of running the benchmark'),
+    )
+
+
+    ## COMMAND LINE HANDLER
+
+    def handle(self, *args, **options):
+        """ Runs every step at every scale and reports the results """
+        self.verbosity = int(options['verbosity'])
+        self.query_tolerance = options['query_tolerance']
+        self.time_tolerance = options['time_tolerance']
+        self.enforce_time = options['enforce_time']
+        if self.query_tolerance < 0 or self.time_tolerance < 0:
+            raise CommandError('ERROR: "query_tolerance" and "time_tolerance" cannot be negative')
+
+        # A baseline brings the scales and seed it was measured with
+        baseline = None
+        scales = options['scales'] or self.DEFAULT_SCALES
+        self.seed = options['seed'] or 1
+        if options['baseline_filename']:
+            baseline = self.load_baseline(options['baseline_filename'])
+            if options['scales'] or options['seed']:
+                raise CommandError('ERROR: "scales" and "seed" come from the baseline and cannot be set with it')
+            scales = ','.join(str(scale['concepts']) for scale in baseline['scales'])
+            self.seed = baseline['seed']
+        if options['results_filename']:
+            if not baseline:
+                raise CommandError('ERROR: "results" requires "baseline"')
+            self.check_results(self.load_baseline(options['results_filename'])['scales'], baseline,
+                               options['baseline_filename'])
+            return
+        try:
+            scales = [int(scale) for scale in scales.split(',')]
+        except ValueError:
+            raise CommandError('ERROR: "scales" must be a comma-separated list of numbers of concepts')
+        if any(scale <= 0 for scale in scales):
+            raise CommandError('ERROR: "scales" must be positive numbers of concepts')
+
+        directory = options['directory'] or tempfile.mkdtemp(prefix='ocl_benchmark_')
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        results = []
+        try:
+            for cnt_concepts in scales:
+                results.append(self.run_scale(directory, cnt_concepts))
+        finally:
+            if not options['directory']:
+                shutil.rmtree(directory)
+
+        if options['output_filename']:
+            if baseline:
+                self.keep_budgets(results, baseline)
+            with open(options['output_filename'], 'w') as output_file:
+                json.dump({'seed': self.seed, 'scales': results}, output_file, indent=2, separators=(',', ': '),
+                          sort_keys=True)
+        self.print_results(results)
+        if baseline:
+            self.check_results(results, baseline, options['baseline_filename'])
+
+
+    ## BENCHMARK STEPS
+
+    def run_scale(self, directory, cnt_concepts):
+        """ Generates a dictionary of cnt_concepts concepts and runs each step on it """
+        def path(name):
+            return os.path.join(directory, '%s_%d.%s' % (name, cnt_concepts, name.endswith('db') and 'sqlite3' or 'json'))
+        source_db, target_db = path('source_db'), path('target_db')
+        concept_filename, mapping_filename, export_filename = path('concepts'), path('mappings'), path('export')
+        for filename in (source_db, target_db):
+            if os.path.exists(filename):
+                os.remove(filename)
+        if self.verbosity >= 1:
+            print 'BENCHMARK: %d concepts' % cnt_concepts
+
+        result = {'concepts': cnt_concepts, 'steps': []}
+        def step(name, database_filename, output_filename, command_name, **options):
+            metrics = self.run_step(database_filename, output_filename, command_name, **options)
+            metrics['step'] = name
+            result['steps'].append(metrics)
+            if self.verbosity >= 1:
+                print '    %-24s %s' % (name, self.format_metrics(metrics))
+
+        step('generate_dictionary', source_db, None, 'generate_dictionary', cnt_concepts=cnt_concepts, seed=self.seed)
+        result['rows'] = self.count_rows(source_db)
+
+        # The empty target is not part of the results
+        self.run_step(target_db, None, 'generate_dictionary', cnt_concepts=0)
+
+        extract_options = dict(org_id=self.ORG_ID, source_id=self.SOURCE_ID, raw=True)
+        step('extract_db concepts', source_db, concept_filename, 'extract_db', concept=True, **extract_options)
+        step('extract_db mappings', source_db, mapping_filename, 'extract_db', mapping=True, **extract_options)
+
+        self.write_export(concept_filename, mapping_filename, export_filename)
+        step('validate_export', source_db, None, 'validate_export', ocl_export_filenames=[export_filename])
+
+        sync_options = dict(org_id=self.ORG_ID, source_id=self.SOURCE_ID, concept_filename=concept_filename,
+                            mapping_filename=mapping_filename)
+        step('sync_bahmni_db', target_db, None, 'sync_bahmni_db', **sync_options)
+        step('sync_bahmni_db resync', target_db, None, 'sync_bahmni_db', **sync_options)
+        return result
+
+    def run_step(self, database_filename, output_filename, command_name, **options):
+        """
+        Runs a command in a child process and returns its wall time, number of SQL queries and
+        peak RSS. A command that fails in the child is raised as a CommandError.
+        """
+        results = multiprocessing.Queue()
+        process = multiprocessing.Process(target=self.run_command,
+                                          args=(results, database_filename, output_filename, command_name, options))
+        process.start()
+        metrics = results.get()
+        process.join()
+        if 'error' in metrics:
+            raise CommandError('ERROR: %s failed: %s' % (command_name, metrics['error']))
+        return metrics
+
+    def run_command(self, results, database_filename, output_filename, command_name, options):
+        """ Child process of run_step: the standard output of the command goes to output_filename, or is discarded """
+        try:
+            connections.databases['default'] = {'ENGINE': 'django.db.backends.sqlite3', 'NAME': database_filename}
+            if hasattr(connections._connections, 'default'):
+                del connections._connections.default
+            counter = QueryCounter()
+            stdout = sys.stdout
+            sys.stdout = open(output_filename or os.devnull, 'w')
+            try:
+                start = time.time()
+                call_command(command_name, verbosity=0, **options)
+                elapsed = time.time() - start
+            finally:
+                sys.stdout.close()
+                sys.stdout = stdout
+            results.put({'time': round(elapsed, 3), 'queries': counter.count,
+                         'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss})
+        except Exception as e:
+            results.put({'error': '%s: %s' % (type(e).__name__, e)})
+        finally:
+            connections['default'].close()
+
+    def write_export(self, concept_filename, mapping_filename, export_filename):
+        """
+        Writes an OCL export of the extract_db files, one record at a time. Mappings get the
+        concept codes and source names of an export instead of the URLs of the import files.
+        """
+        with open(export_filename, 'w') as export_file:
+            export_file.write('{"concepts": [')
+            for cnt, concept in enumerate(self.read_json_lines(concept_filename)):
+                concept['id'] = str(concept['id'])
+                export_file.write((cnt and ',\n' or '\n') + json.dumps(concept))
+            export_file.write('],\n"mappings": [')
+            for cnt, data in enumerate(self.read_json_lines(mapping_filename)):
+                ref_map = MappingRecord(data)
+                mapping = {
+                    'id': 'M%d' % (cnt + 1),
+                    'map_type': data['map_type'],
+                    'retired': data.get('retired', False),
+                    'external_id': data.get('external_id'),
+                    'from_concept_code': str(ref_map.from_concept_id),
+                    'from_source_name': ref_map.from_source,
+                    'to_concept_code': (str(ref_map.to_concept_id) if ref_map.kind == MappingRecord.INTERNAL
+                                        else ref_map.to_concept_code),
+                    'to_source_name': ref_map.to_source,
+                }
+                export_file.write((cnt and ',\n' or '\n') + json.dumps(mapping))
+            export_file.write(']}\n')
+
+    def read_json_lines(self, filename):
+        with open(filename, 'r') as input_file:
+            for line in input_file:
+                if line.strip():
+                    yield json.loads(line)
+
+    def count_rows(self, database_filename):
+        """ Returns the number of rows in all the tables of a SQLite database """
+        db = sqlite3.connect(database_filename)
+        try:
+            tables = [row[0] for row in db.execute("SELECT name FROM sqlite_master WHERE type = 'table'")]
+            return sum(db.execute('SELECT COUNT(*) FROM "%s"' % table).fetchone()[0] for table in tables)
+        finally:
+            db.close()
+
+
+    ## BASELINE
+
+    def check_results(self, results, baseline, baseline_filename):
+        """ Raises a CommandError, so that the command exits with an error, if a step is over budget """
+        regressions = self.check_baseline(results, baseline)
+        if regressions:
+            raise CommandError('ERROR: %d step(s) exceeded their budget against baseline %s' % (
+                regressions, baseline_filename))
+        print 'All steps are within their budget'
+
+    def load_baseline(self, filename):
+        try:
+            with open(filename, 'r') as baseline_file:
+                baseline = json.load(baseline_file)
+        except (IOError, ValueError) as e:
+            raise CommandError('ERROR: Cannot read baseline %s: %s' % (filename, e))
+        if not baseline.get('scales') or 'seed' not in baseline:
+            raise CommandError('ERROR: Baseline %s has no seed or scales; save one with "output"' % filename)
+        return baseline
+
+    def get_budgets(self, step):
+        """ Returns the (queries, time) budget of a baseline step """
+        max_queries = step.get('max_queries', int(math.ceil(step['queries'] * (1 + self.query_tolerance))))
+        max_time = step.get('max_time', step['time'] * (1 + self.time_tolerance) + self.TIME_SLACK)
+        return max_queries, max_time
+
+    def keep_budgets(self, results, baseline):
+        """ Copies the fixed budgets of the baseline steps to the results, so that a new baseline keeps them """
+        baseline_steps = dict(((scale['concepts'], step['step']), step)
+                              for scale in baseline['scales'] for step in scale['steps'])
+        for result in results:
+            for metrics in result['steps']:
+                step = baseline_steps.get((result['concepts'], metrics['step']), {})
+                for key in ('max_queries', 'max_time'):
+                    if key in step:
+                        metrics[key] = step[key]
+
+    def check_baseline(self, results, baseline):
+        """
+        Prints each step against its baseline and returns the number of steps over budget. A
+        step over its time budget only counts with enforce_time.
+        """
+        print '\nBASELINE COMPARISON (queries +%d%%, time +%d%%%s):' % (
+            self.query_tolerance * 100, self.time_tolerance * 100, '' if self.enforce_time else ', advisory')
+        baseline_steps = dict(((scale['concepts'], step['step']), step)
+                              for scale in baseline['scales'] for step in scale['steps'])
+        regressions = 0
+        for result in results:
+            for metrics in result['steps']:
+                step = baseline_steps.get((result['concepts'], metrics['step']))
+                if step is None:
+                    print '    %10d  %-24s not in the baseline' % (result['concepts'], metrics['step'])
+                    continue
+                max_queries, max_time = self.get_budgets(step)
+                lines = []
+                for label, value, base_value, budget, unit, enforced in (
+                        ('queries', metrics['queries'], step['queries'], max_queries, '', True),
+                        ('time', metrics['time'], step['time'], max_time, 's', self.enforce_time)):
+                    over = value > budget
+                    if over and enforced:
+                        regressions += 1
+                        status = 'FAIL'
+                    else:
+                        status = over and 'SLOW' or 'ok'
+                    lines.append('%-4s %-7s %10s vs baseline %10s (%s), budget %s' % (
+                        status, label, self.format_value(value, unit),
+                        self.format_value(base_value, unit), self.format_change(value, base_value),
+                        self.format_value(budget, unit)))
+                print '    %10d  %-24s %s' % (result['concepts'], metrics['step'], lines[0])
+                print '    %10s  %-24s %s' % ('', '', lines[1])
+        return regressions
+
+    def format_value(self, value, unit):
+        return unit and '%.2f%s' % (value, unit) or '%d' % value
+
+    def format_change(self, value, base_value):
+        if not base_value:
+            return 'n/a'
+        return '%+.1f%%' % ((value - base_value) * 100.0 / base_value)
+
+
+    ## REPORT
+
+    def format_metrics(self, metrics):
+        return '%9.2fs %10d queries %9.1f MB' % (metrics['time'], metrics['queries'], metrics['peak_rss_kb'] / 1024.0)
+
+    def print_results(self, results):
+        """ Prints one line per step and scale """
+        print '\nBENCHMARK RESULTS:'
+        print '%10s %10s  %-24s %10s %18s %12s' % ('concepts', 'rows', 'step', 'time', 'queries', 'peak RSS')
+        for result in results:
+            for metrics in result['steps']:
+                print '%10d %10d  %-24s %s' % (result['concepts'], result['rows'], metrics['step'],
+                                              self.format_metrics(metrics))
@@ -0,0 +1,195 @@
+"""
+Command to check that an OpenMRS/Bahmni database has the indexes needed by the lookups of
+sync_bahmni_db and validate_export, and optionally to create the missing ones.
+
+Example usage:
+
+    manage.py check_indexes [--database=DATABASE] [--create] [-v2]
+
+Each lookup is an equality filter on a few columns of one table. An index covers a lookup if
+its leading columns are exactly those columns, in any order. An index on only some of them is
+reported as partial: the database can use it, but still has to read every row that shares its
+values. The impact of a missing index is estimated from the number of rows that each lookup has
+to examine without it.
+
+The database is the 'default' one unless another alias is given with --database. Only MySQL
+and SQLite are supported.
+
+"""
+from optparse import make_option
+from django.core.management import BaseCommand, CommandError
+from django.db import connections, DatabaseError
+
+
+class Command(BaseCommand):
+    """
+    Report (and optionally create) the indexes missing for the lookups of sync_bahmni_db and validate_export
+    """
+
+    # Lookups issued by sync_bahmni_db and validate_export, as (table, columns, used by)
+    LOOKUPS = (
+        ('concept', ('uuid',), 'sync_bahmni_db: match concepts by uuid'),
+        ('concept_name', ('name', 'locale'), 'sync_bahmni_db: match concepts by name'),
+        ('concept_name', ('uuid',), 'sync_bahmni_db: skip existing names'),
+        ('concept_description', ('uuid',), 'sync_bahmni_db: skip existing descriptions'),
+        ('concept_answer', ('uuid',), 'sync_bahmni_db: skip existing answers'),
+        ('concept_answer', ('concept_id', 'answer_concept'), 'validate_export: Q-AND-A mappings'),
+        ('concept_set', ('uuid',), 'sync_bahmni_db: skip existing set members'),
+        ('concept_set', ('concept_id', 'concept_set'), 'validate_export: concept set mappings'),
+        ('concept_reference_term', ('code', 'concept_source_id'), 'sync_bahmni_db: get or create reference terms'),
+        ('concept_reference_map', ('concept_id', 'concept_reference_term_id', 'concept_map_type_id'),
+         'sync_bahmni_db and validate_export: existing reference maps'),
+        ('concept_reference_map', ('uuid',), 'sync_bahmni_db: skip existing reference maps (staging engine)'),
+    )
+
+    # Number of rows a lookup may examine before a missing index is reported as high or medium impact
+    HIGH_IMPACT_ROWS = 100000
+    MEDIUM_IMPACT_ROWS = 10000
+
+    # Command attributes
+    help = 'Check the indexes used by sync_bahmni_db and validate_export'
+    option_list = BaseCommand.option_list + (
+        make_option('--database',
+                    dest='database',
+                    default='default',
+                    help='Alias of the database to check (default "default")'),
+        make_option('--create',
+                    action='store_true',
+                    dest='create',
+                    default=False,
+                    help='Create the missing indexes'),
+    )
+
+
+    ## COMMAND LINE HANDLER
+
+    def handle(self, *args, **options):
+        """ Checks each lookup, prints a report and creates the missing indexes if requested """
+        self.create = options['create']
+        self.verbosity = int(options['verbosity'])
+        if options['database'] not in connections.databases:
+            raise CommandError('ERROR: unknown database "%s"' % options['database'])
+        self.connection = connections[options['database']]
+        if self.connection.vendor not in ('mysql', 'sqlite'):
+            raise CommandError('ERROR: check_indexes only supports MySQL and SQLite, not %s' % self.connection.vendor)
+
+        cursor = self.connection.cursor()
+        missing = []
+        indexes = {}
+        print 'CHECKING INDEXES:'
+        for table, columns, used_by in self.LOOKUPS:
+            if table not in indexes:
+                indexes[table] = self.get_indexes(cursor, table)
+            status, index_name, cnt_columns = self.check_lookup(indexes[table], columns)
+            if status == 'covered':
+                if self.verbosity >= 2:
+                    print '    OK       %s(%s) by index %s' % (table, ', '.join(columns), index_name)
+                continue
+            rows_examined = self.estimate_rows_examined(cursor, table, index_name, cnt_columns)
+            print '    %-8s %s(%s) -- %s' % (status.upper(), table, ', '.join(columns), used_by)
+            if index_name:
+                print '             only index %s can be used' % index_name
+            if rows_examined is None:
+                print '             impact: unknown, the database has no statistics for the index'
+            else:
+                print '             impact: %s, about %d rows examined per lookup' % (self.get_impact(rows_examined), rows_examined)
+            missing.append((table, columns))
+
+        if not missing:
+            print 'All lookups are covered by an index'
+            return
+        print '%d lookup(s) are not covered by an index' % len(missing)
+        for table, columns in missing:
+            sql = self.get_create_index_sql(table, columns)
+            if not self.create:
+                print '    %s;' % sql
+                continue
+            try:
+                cursor.execute(sql)
+                print 'Created index: %s' % sql
+            except DatabaseError as e:
+                print 'Failed to create index: %s (%s)' % (sql, e)
+        if not self.create:
+            print 'Run with --create to create them'
+
+
+    ## INDEX INTROSPECTION
+
+    def get_indexes(self, cursor, table):
+        """ Returns {index name: [columns in index order]} for a table """
+        indexes = {}
+        if self.connection.vendor == 'mysql':
+            cursor.execute('SELECT index_name, column_name FROM information_schema.statistics '
+                           'WHERE table_schema = DATABASE() AND table_name = %s ORDER BY index_name, seq_in_index',
+                           [table])
+            for index_name, column in cursor.fetchall():
+                indexes.setdefault(index_name, []).append(column.lower())
+        else:
+            cursor.execute('PRAGMA index_list(%s)' % self.connection.ops.quote_name(table))
+            for row in cursor.fetchall():
+                index_name = row[1]
+                cursor.execute('PRAGMA index_info(%s)' % self.connection.ops.quote_name(index_name))
+                indexes[index_name] = [column.lower() for seqno, cid, column in sorted(cursor.fetchall())]
+            # An INTEGER PRIMARY KEY is the rowid and has no index of its own
+            cursor.execute('PRAGMA table_info(%s)' % self.connection.ops.quote_name(table))
+            for cid, column, column_type, notnull, default, pk in cursor.fetchall():
+                if pk and column_type.upper() == 'INTEGER':
+                    indexes['PRIMARY'] = [column.lower()]
+        return indexes
+
+    def check_lookup(self, indexes, columns):
+        """
+        Returns (status, index name, number of lookup columns the index starts with). The status
+        is 'covered' if an index starts with all the columns of the lookup, 'partial' if the best
+        index starts with some of them, or 'missing'.
+        """
+        best_name, best_count = None, 0
+        for index_name, index_columns in sorted(indexes.items()):
+            count = 0
+            while count < len(index_columns) and index_columns[count] in columns:
+                count += 1
+            if count == len(columns):
+                return 'covered', index_name, count
+            if count > best_count:
+                best_name, best_count = index_name, count
+        if best_name is None:
+            return 'missing', None, 0
+        return 'partial', best_name, best_count
+
+    def estimate_rows_examined(self, cursor, table, index_name, cnt_columns):
+        """
+        Estimates how many rows a lookup examines: the whole table without an index, or the
+        rows per distinct value of the partial index (if the database has statistics for it)
+        """
+        if self.connection.vendor == 'mysql':
+            cursor.execute('SELECT table_rows FROM information_schema.tables '
+                           'WHERE table_schema = DATABASE() AND table_name = %s', [table])
+            row = cursor.fetchone()
+            cnt_rows = int(row[0] or 0) if row else 0
+        else:
+            cursor.execute('SELECT COUNT(*) FROM %s' % self.connection.ops.quote_name(table))
+            cnt_rows = cursor.fetchone()[0]
+        if index_name is None:
+            return cnt_rows
+        if self.connection.vendor == 'mysql':
+            cursor.execute('SELECT cardinality FROM information_schema.statistics '
+                           'WHERE table_schema = DATABASE() AND table_name = %s AND index_name = %s '
+                           'AND seq_in_index = %s', [table, index_name, cnt_columns])
+            cardinality = cursor.fetchone()[0]
+            if cardinality:
+                return max(1, cnt_rows // int(cardinality))
+        return None
+
+    def get_impact(self, rows_examined):
+        if rows_examined >= self.HIGH_IMPACT_ROWS:
+            return 'high'
+        if rows_examined >= self.MEDIUM_IMPACT_ROWS:
+            return 'medium'
+        return 'low'
+
+    def get_create_index_sql(self, table, columns):
+        """ Returns the CREATE INDEX statement for a lookup; names are kept within MySQL's 64 characters """
+        index_name = ('ocl_%s_%s' % (table, '_'.join(columns)))[:60] + '_idx'
+        return 'CREATE INDEX %s ON %s (%s)' % (
+            self.connection.ops.quote_name(index_name), self.connection.ops.quote_name(table),
+            ', '.join(self.connection.ops.quote_name(column) for column in columns))
@@ -9,10 +9,15 @@ Separate files should be created for concepts and mappings, for example:
 The 'raw' option indicates that JSON should be formatted one record per line (JSON lines file)
 instead of human-readable format.
 
-It is also possible to create a list of retired concept IDs (this is not used during import):
+It is also possible to create a list of retired concept IDs (applied by 'sync_bahmni_db --retired'):
 
     manage.py extract_db --org_id=CIEL --source_id=CIEL --raw -v0 --retired > retired_concepts.json
 
+Use 'database' to read from another database alias than READ_DATABASE of the settings, e.g. a
+read replica, so that the export does not load the primary database:
+
+    manage.py extract_db --org_id=CIEL --source_id=CIEL --raw -v0 --concepts --database=replica > concepts.json
+
 You should validate reference sources before generating the export with the "check_sources" option:
 
     manage.py extract_db --check_sources --env=... --token=...
@@ -38,8 +43,7 @@ from optparse import make_option
 import json
 from django.core.management import BaseCommand, CommandError
 from omrs.models import Concept, ConceptReferenceSource
-from omrs.management.commands import OclOpenmrsHelper, UnrecognizedSourceException
-import requests
+from omrs.management.commands import OclOpenmrsHelper, UnrecognizedSourceException, use_read_database
 
 
 
@@ -106,6 +110,11 @@ class Command(BaseCommand):
                     dest='token',
                     default=None,
                     help='OCL API token to validate OpenMRS reference sources'),
+        make_option('--database',
+                    action='store',
+                    dest='database',
+                    default=None,
+                    help='Alias of the database to read from (default settings.READ_DATABASE, e.g. a replica)'),
     )
 
     OCL_API_URL = {
@@ -146,6 +155,7 @@ class Command(BaseCommand):
 
         # Validate the options
         self.validate_options()
+        self.database = use_read_database(options['database'])
 
         # Validate all reference sources
         if options['check_sources']:
@@ -240,6 +250,8 @@ class Command(BaseCommand):
 
             # Check that org:source exists in OCL
             if self.ocl_api_token:
+                # requests is only imported here, as it adds to the startup time of every run
+                import requests
                 url = url_base + 'orgs/%s/sources/%s/' % (org_id, source_id)
                 r = requests.head(url, headers=headers)
                 if r.status_code != requests.codes.OK:
@@ -268,18 +280,23 @@ class Command(BaseCommand):
         if self.raw:
             output_indent = None
 
+        # Concepts and mappings are exported from the export graph, fetched for a batch of
+        # concepts at a time with one query per table instead of several queries per concept
+        concept_results = Concept.objects.all()
+        if self.do_concept or self.do_mapping:
+            concept_results = concept_results.with_export_graph(concepts=self.do_concept, mappings=self.do_mapping)
+
         # Create the concept enumerator, applying 'concept_id' and 'concept_limit' options
         if self.concept_id is not None:
             # If 'concept_id' option set, fetch a single concept and convert to enumerator
-            concept = Concept.objects.get(concept_id=self.concept_id)
+            concept = concept_results.get(concept_id=self.concept_id)
             concept_enumerator = enumerate([concept])
         else:
             # Fetch all concepts and filter with 'concept_limit' if set
             # TODO: 'concept_limit' is based on numeric value of concept_id not on actual count
-            concept_results = Concept.objects.all()
             if self.concept_limit is not None:
                 concept_results = concept_results.filter(concept_id__lte=self.concept_limit)
-            concept_enumerator = enumerate(concept_results)
+            concept_enumerator = enumerate(concept_results.in_batches())
 
         # Iterate concept enumerator and process the export
         for num, concept in concept_enumerator:
@@ -474,7 +491,7 @@ class Command(BaseCommand):
             map_dict = self.generate_internal_mapping(
                 map_type=OclOpenmrsHelper.MAP_TYPE_Q_AND_A,
                 from_concept=concept,
-                to_concept_code=answer.answer_concept.concept_id,
+                to_concept_code=answer.answer_concept_id,
                 external_id=answer.uuid)
             maps.append(map_dict)
             self.cnt_answers_exported += 1
@@ -500,7 +517,7 @@ class Command(BaseCommand):
             map_dict = self.generate_internal_mapping(
                 map_type=OclOpenmrsHelper.MAP_TYPE_CONCEPT_SET,
                 from_concept=concept,
-                to_concept_code=set_member.concept.concept_id,
+                to_concept_code=set_member.concept_id,
                 external_id=set_member.uuid)
             maps.append(map_dict)
             self.cnt_set_members_exported += 1
@@ -0,0 +1,299 @@
+"""
+Command to generate a synthetic OpenMRS concept dictionary in a SQLite database, e.g. to measure
+the other commands without a copy of a production database.
+
+Example usage:
+
+    manage.py generate_dictionary --file=DICTIONARY_FILENAME --concepts=10000 [--seed=1]
+
+The OpenMRS concept tables are created if they do not exist, with an index on each foreign key.
+Each concept gets an English name and often a synonym and French or Spanish names, usually a
+description, a CIEL reference map to itself and up to four maps to terms of the other sources of
+the source directory. Numeric concepts get ranges, coded concepts get answers and convenience
+sets get members, all drawn from earlier concepts. A concept has about ten rows on average, so
+10000 concepts make a dictionary of about 100k rows.
+
+With --concepts=0 only the empty tables are created, e.g. as the target of sync_bahmni_db. The
+same seed always generates the same dictionary. Use 'database' instead of 'file' to write to a
+SQLite database of the settings.
+
+Only SQLite is supported.
+
+"""
+from optparse import make_option
+import random, time, uuid
+from django.core.management import BaseCommand, CommandError
+from django.db import connections, transaction
+from django.db.models import get_app, get_models
+from django.utils import timezone
+from omrs.models import (Concept, ConceptAnswer, ConceptClass, ConceptDatatype, ConceptDescription, ConceptMapType,
+                         ConceptName, ConceptNumeric, ConceptReferenceMap, ConceptReferenceSource,
+                         ConceptReferenceTerm, ConceptSet)
+from omrs.management.commands import OclOpenmrsHelper
+
+
+class Command(BaseCommand):
+    """
+    Generate a synthetic OpenMRS concept dictionary in a SQLite database
+    """
+
+    # Alias under which the 'file' database is added to the connections
+    FILE_DATABASE = 'generate_dictionary'
+
+    # Number of concepts generated and written per transaction
+    CHUNK_SIZE = 1000
+
+    # Concept classes with their weight, and the datatypes a class may have
+    CONCEPT_CLASSES = (('Diagnosis', 35), ('Finding', 15), ('Symptom', 10), ('Test', 12), ('Question', 10),
+                       ('Drug', 10), ('Procedure', 5), ('ConvSet', 3))
+    CLASS_DATATYPES = {'Test': ('Numeric', 'Numeric', 'Coded', 'Text'), 'Question': ('Coded', 'Coded', 'Text', 'Boolean')}
+    DATATYPES = ('N/A', 'Coded', 'Numeric', 'Text', 'Boolean', 'Date')
+    MAP_TYPES = (('SAME-AS', 70), ('NARROWER-THAN', 15), ('BROADER-THAN', 10), ('ASSOCIATED-WITH', 5))
+
+    # Probability of each optional row of a concept
+    SYNONYM_RATE = 0.4
+    LOCALE_RATES = (('fr', 0.4), ('es', 0.3))
+    DESCRIPTION_RATE = 0.7
+    RETIRED_RATE = 0.02
+
+    # Number of external reference maps, answers and set members, drawn uniformly
+    EXTERNAL_MAP_COUNTS = (0, 1, 1, 2, 2, 3, 4)
+    ANSWER_COUNTS = (2, 6)
+    SET_MEMBER_COUNTS = (3, 10)
+
+    WORDS = ('acute', 'chronic', 'renal', 'hepatic', 'cardiac', 'pulmonary', 'viral', 'bacterial', 'congenital',
+             'infection', 'failure', 'syndrome', 'disorder', 'pain', 'fever', 'lesion', 'level', 'count', 'test',
+             'history', 'stage', 'dose', 'tablet', 'injection', 'right', 'left', 'upper', 'lower', 'serum', 'urine')
+
+    # Command attributes
+    help = 'Generate a synthetic OpenMRS concept dictionary in a SQLite database'
+    option_list = BaseCommand.option_list + (
+        make_option('--file',
+                    action='store',
+                    dest='filename',
+                    default=None,
+                    help='SQLite database file to write the dictionary to'),
+        make_option('--database',
+                    action='store',
+                    dest='database',
+                    default='default',
+                    help='SQLite database alias to write the dictionary to, if "file" is not set'),
+        make_option('--concepts',
+                    action='store',
+                    dest='cnt_concepts',
+                    type='int',
+                    default=1000,
+                    help='Number of concepts to generate (0 only creates the tables)'),
+        make_option('--seed',
+                    action='store',
+                    dest='seed',
+                    type='int',
+                    default=1,
+                    help='Seed of the random generator'),
+    )
+
+
+    ## COMMAND LINE HANDLER
+
+    def handle(self, *args, **options):
+        """ Creates the tables and generates the concepts in chunks """
+        self.verbosity = int(options['verbosity'])
+        self.cnt_concepts = options['cnt_concepts']
+        self.database = options['database']
+        if options['filename']:
+            self.database = self.FILE_DATABASE
+            connections.databases[self.database] = {'ENGINE': 'django.db.backends.sqlite3', 'NAME': options['filename']}
+        if self.database not in connections.databases:
+            raise CommandError('ERROR: unknown database "%s"' % self.database)
+        if connections[self.database].vendor != 'sqlite':
+            raise CommandError('ERROR: generate_dictionary only writes to SQLite databases')
+        if self.cnt_concepts < 0:
+            raise CommandError('ERROR: "concepts" cannot be negative')
+
+        start = time.time()
+        self.create_tables()
+        if Concept.objects.using(self.database).exists():
+            raise CommandError('ERROR: the database already has concepts')
+        if not self.cnt_concepts:
+            return
+
+        self.random = random.Random(options['seed'])
+        self.now = timezone.now()
+        self.cnt_rows = {}
+        self.next_ids = {}
+        self.create_metadata()
+        for first_concept_id in range(1, self.cnt_concepts + 1, self.CHUNK_SIZE):
+            last_concept_id = min(first_concept_id + self.CHUNK_SIZE - 1, self.cnt_concepts)
+            with transaction.atomic(using=self.database):
+                self.write_rows(self.generate_concepts(first_concept_id, last_concept_id))
+        if self.verbosity:
+            self.print_debug_summary(time.time() - start)
+
+    def print_debug_summary(self, elapsed):
+        """ Outputs the number of rows generated in each table """
+        print '------------------------------------------------------'
+        print 'SUMMARY'
+        print '------------------------------------------------------'
+        for model_name in sorted(self.cnt_rows):
+            print '    %s: %d' % (model_name, self.cnt_rows[model_name])
+        print 'Total rows: %d (%.1fs)' % (sum(self.cnt_rows.values()), elapsed)
+        print '------------------------------------------------------'
+
+
+    ## SCHEMA
+
+    def create_tables(self):
+        """
+        Creates the tables of the OpenMRS models that do not exist yet. Columns that may be
+        blank are nullable, like in the OpenMRS schema, and foreign keys are indexed.
+        """
+        connection = connections[self.database]
+        quote_name = connection.ops.quote_name
+        cursor = connection.cursor()
+        tables = connection.introspection.table_names(cursor)
+        for model in get_models(get_app('omrs')):
+            table = model._meta.db_table
+            if table in tables:
+                continue
+            columns = []
+            for field in model._meta.local_fields:
+                column = '%s %s' % (quote_name(field.column), field.db_type(connection))
+                if field.primary_key:
+                    column += ' PRIMARY KEY'
+                else:
+                    if not field.null and not field.blank:
+                        column += ' NOT NULL'
+                    if field.unique:
+                        column += ' UNIQUE'
+                columns.append(column)
+            cursor.execute('CREATE TABLE %s (%s)' % (quote_name(table), ', '.join(columns)))
+            for field in model._meta.local_fields:
+                if field.rel and not field.primary_key:
+                    cursor.execute('CREATE INDEX %s ON %s (%s)' % (
+                        quote_name('%s_%s' % (table, field.column)), quote_name(table), quote_name(field.column)))
+
+
+    ## DICTIONARY
+
+    def create_metadata(self):
+        """ Creates the concept classes, datatypes, map types and the sources of the source directory """
+        self.concept_class_ids = self.create_named_rows(ConceptClass, [name for name, weight in self.CONCEPT_CLASSES])
+        self.datatype_ids = self.create_named_rows(ConceptDatatype, self.DATATYPES)
+        self.map_type_ids = self.create_named_rows(ConceptMapType, [name for name, weight in self.MAP_TYPES])
+        source_names = [source['omrs_id'] for source in OclOpenmrsHelper.SOURCE_DIRECTORY]
+        self.source_ids = self.create_named_rows(ConceptReferenceSource, source_names)
+        self.ciel_source_id = self.source_ids['CIEL']
+        self.external_source_ids = sorted(source_id for name, source_id in self.source_ids.items() if name != 'CIEL')
+
+    def create_named_rows(self, model, names):
+        """ Creates one row of a metadata table per name and returns {name: ID} """
+        rows = []
+        for row_id, name in enumerate(names, 1):
+            row = model(pk=row_id, name=name, description='', retired=0, creator=1, date_created=self.now,
+                        uuid=self.make_uuid())
+            if model is ConceptReferenceSource:
+                row.hl7_code = name
+            rows.append(row)
+        self.write_rows([rows])
+        return dict((row.name, row.pk) for row in rows)
+
+    def generate_concepts(self, first_concept_id, last_concept_id):
+        """ Returns the lists of rows of a range of concepts, one list per table """
+        concepts, names, descriptions, numerics, terms, maps, answers, set_members = [], [], [], [], [], [], [], []
+        for concept_id in range(first_concept_id, last_concept_id + 1):
+            concept_class = self.choose_weighted(self.CONCEPT_CLASSES)
+            datatype = self.random.choice(self.CLASS_DATATYPES.get(concept_class, ('N/A',)))
+            retired = self.random.random() < self.RETIRED_RATE
+            concepts.append(Concept(
+                concept_id=concept_id, concept_class_id=self.concept_class_ids[concept_class],
+                datatype_id=self.datatype_ids[datatype], is_set=int(concept_class == 'ConvSet'), retired=retired,
+                retired_by=1 if retired else None, date_retired=self.now if retired else None,
+                creator=1, date_created=self.now, uuid=self.make_uuid()))
+
+            # Names are unique within a locale, so no two concepts are matched by name
+            words = ' '.join(self.random.sample(self.WORDS, 2))
+            names.append(self.make_name(concept_id, '%s %d' % (words.capitalize(), concept_id), 'en', 'FULLY_SPECIFIED'))
+            if self.random.random() < self.SYNONYM_RATE:
+                names.append(self.make_name(concept_id, '%s (%d)' % (words, concept_id), 'en', None))
+            for locale, rate in self.LOCALE_RATES:
+                if self.random.random() < rate:
+                    names.append(self.make_name(concept_id, '%s %d [%s]' % (words.capitalize(), concept_id, locale),
+                                                locale, 'FULLY_SPECIFIED'))
+            if self.random.random() < self.DESCRIPTION_RATE:
+                descriptions.append(ConceptDescription(
+                    concept_description_id=self.next_id(ConceptDescription), concept_id=concept_id,
+                    description='Synthetic concept %d: %s' % (concept_id, words), locale='en',
+                    creator=1, date_created=self.now, uuid=self.make_uuid()))
+            if datatype == 'Numeric':
+                low = self.random.randint(0, 100)
+                numerics.append(ConceptNumeric(
+                    concept_id=concept_id, low_absolute=0, low_critical=low, low_normal=low * 2,
+                    hi_normal=low * 4, hi_critical=low * 8, hi_absolute=low * 10, units='mg/dl',
+                    precise=self.random.randint(0, 1), display_precision=1))
+
+            # The CIEL term of the concept itself, then terms of other sources
+            self.add_reference_map(terms, maps, concept_id, self.ciel_source_id, str(concept_id), 'SAME-AS')
+            for i in range(self.random.choice(self.EXTERNAL_MAP_COUNTS)):
+                source_id = self.random.choice(self.external_source_ids)
+                term_id = self.next_ids.get(ConceptReferenceTerm, 0) + 1
+                self.add_reference_map(terms, maps, concept_id, source_id, 'T%d' % term_id,
+                                       self.choose_weighted(self.MAP_TYPES))
+
+            if datatype == 'Coded' and concept_id > 1:
+                for answer_concept_id in self.sample_concepts(concept_id, self.ANSWER_COUNTS):
+                    answers.append(ConceptAnswer(
+                        concept_answer_id=self.next_id(ConceptAnswer), question_concept_id=concept_id,
+                        answer_concept_id=answer_concept_id, creator=1, date_created=self.now, uuid=self.make_uuid()))
+            if concept_class == 'ConvSet' and concept_id > 1:
+                for member_concept_id in self.sample_concepts(concept_id, self.SET_MEMBER_COUNTS):
+                    set_members.append(ConceptSet(
+                        concept_set_id=self.next_id(ConceptSet), concept_id=member_concept_id,
+                        concept_set_owner_id=concept_id, creator=1, date_created=self.now, uuid=self.make_uuid()))
+        return concepts, names, descriptions, numerics, terms, maps, answers, set_members
+
+    def make_name(self, concept_id, name, locale, name_type):
+        return ConceptName(
+            concept_name_id=self.next_id(ConceptName), concept_id=concept_id, name=name, locale=locale,
+            concept_name_type=name_type, locale_preferred=name_type == 'FULLY_SPECIFIED', voided=False,
+            creator=1, date_created=self.now, uuid=self.make_uuid())
+
+    def add_reference_map(self, terms, maps, concept_id, source_id, code, map_type):
+        """ Adds a new reference term and a map from the concept to it """
+        term_id = self.next_id(ConceptReferenceTerm)
+        terms.append(ConceptReferenceTerm(
+            concept_reference_term_id=term_id, concept_source_id=source_id, code=code, retired=0,
+            creator=1, date_created=self.now, uuid=self.make_uuid()))
+        maps.append(ConceptReferenceMap(
+            concept_map_id=self.next_id(ConceptReferenceMap), concept_id=concept_id,
+            concept_reference_term_id=term_id, map_type_id=self.map_type_ids[map_type],
+            creator=1, date_created=self.now, uuid=self.make_uuid()))
+
+    def sample_concepts(self, concept_id, counts):
+        """ Returns distinct earlier concept IDs, as many as a random number in the range counts """
+        cnt = min(self.random.randint(*counts), concept_id - 1)
+        return sorted(self.random.sample(xrange(1, concept_id), cnt))
+
+    def choose_weighted(self, choices):
+        """ Returns the name of a (name, weight) pair, with a probability proportional to its weight """
+        value = self.random.uniform(0, sum(weight for name, weight in choices))
+        for name, weight in choices:
+            value -= weight
+            if value <= 0:
+                return name
+        return choices[-1][0]
+
+    def next_id(self, model):
+        self.next_ids[model] = self.next_ids.get(model, 0) + 1
+        return self.next_ids[model]
+
+    def make_uuid(self):
+        """ Returns a uuid drawn from the seeded generator, so that a seed always gives the same rows """
+        return str(uuid.UUID(int=self.random.getrandbits(128), version=4))
+
+    def write_rows(self, row_lists):
+        """ Inserts lists of rows of one model each with multi-row inserts """
+        for rows in row_lists:
+            if rows:
+                model = type(rows[0])
+                model.objects.using(self.database).bulk_create(rows)
+                self.cnt_rows[model.__name__] = self.cnt_rows.get(model.__name__, 0) + len(rows)
@@ -5,6 +5,65 @@ Example usage:
 
     manage.py sync_bahmni_db --org_id=CIEL --source_id=CIEL --concept_file=CONCEPT_FILENAME --mapping_file=MAPPING_FILENAME
 
+The old -> new concept ID crosswalk built while syncing concepts can be saved with the 'crosswalk_file'
+option. If the file already exists it is loaded first, so IDs from earlier runs are reused.
+
+New rows are inserted with multi-row inserts of 'batch_size' rows (default 1000). Records are read in
+chunks of the same size, and which of their concepts, names, descriptions, answers, set members and
+reference maps already exist is checked with a few 'uuid IN (...)' queries per chunk, so only missing
+rows are inserted.
+
+Use 'commit_every' to write groups of N concepts (and then N mappings) in one transaction. A group that
+fails is rolled back and reported with the range of records it covered, and the sync continues.
+
+Use 'plan' to do a dry run: nothing is written to the database, and every row the sync would insert is
+written to the given plan file instead. The plan can be applied later with 'apply_plan', as long as the
+database has not changed in the meantime:
+
+    manage.py sync_bahmni_db --org_id=CIEL --source_id=CIEL --concept_file=... --mapping_file=... --plan=PLAN_FILENAME
+    manage.py sync_bahmni_db --apply_plan=PLAN_FILENAME
+
+Use 'previous_concept_file' and 'previous_mapping_file' to sync only the delta between two versions of the
+export: records are compared by ID (the external_id for mappings) and a hash of their content, and only
+added and changed records are synced, plus unchanged mappings from or to a synced concept. Removed records
+are reported but not deleted.
+
+    manage.py sync_bahmni_db ... --previous_concept_file=OLD_CONCEPT_FILENAME --previous_mapping_file=OLD_MAPPING_FILENAME
+
+Use 'checkpoint_file' together with 'commit_every' to record the progress of a sync after each committed
+group: the phase, the number of records done, and the crosswalk built so far. After a crash, run the same
+command with 'resume' to continue where it stopped.
+
+Use 'workers' to sync with N processes, each with its own database connection. Rows shared between
+concepts or mappings (classes, datatypes, sources, map types and reference terms) are created first by
+the main process, in input order. Concepts are then split so that concepts sharing a name go to the
+same worker, and mappings are split by their from concept once all concepts have their new IDs.
+On SQLite, which allows one writer at a time, the groups of 'commit_every' are written by one worker
+at a time.
+
+Use 'engine=staging' for large loads: the files are bulk-loaded into staging tables, and the new
+concepts, names, descriptions, answers, set members, reference terms and reference maps are inserted
+with set-based INSERT ... SELECT statements and anti-joins, in one transaction.
+
+Use 'database' to sync into another database alias than "default". Repeat it to sync the same files
+into several databases at once: the files are parsed once, and each database is synced concurrently by
+its own process, with its own connection, caches and summary. The crosswalk and stats files get the
+database alias as suffix.
+
+    manage.py sync_bahmni_db ... --database=site1 --database=site2
+
+Use 'progress' to show a progress line with the rate and ETA on stderr, and 'stats_file' to record
+the rows inserted and skipped, the SQL queries and their time, the wall time and the growth of the
+peak memory of each phase of the sync (concept matching, concept insert, names, descriptions, internal,
+external and CIEL mappings). The phases are listed in the summary and saved to the stats file as JSON,
+with the peak memory of the whole process.
+
+Use 'retired' to retire the concepts listed in a file created by 'extract_db --retired', after the sync
+or on its own with the crosswalk of an earlier sync. The IDs are translated with the crosswalk and the
+concepts are retired with one UPDATE per batch of concepts:
+
+    manage.py sync_bahmni_db --crosswalk_file=CROSSWALK_FILENAME --retired=RETIRED_FILENAME
+
 Set verbosity to 0 (e.g. '-v0') to suppress the results summary output. Set verbosity to 2
 to see all debug output.
 
@@ -16,11 +75,16 @@ BUGS:
 """
 
 from optparse import make_option
-import json, uuid
+import json, uuid, os, sys, multiprocessing, random, time, hashlib, Queue
+from StringIO import StringIO
+from array import array
+from contextlib import contextmanager
 from django.core.management import BaseCommand, CommandError
-from omrs.models import Concept, ConceptName, ConceptClass, ConceptAnswer, ConceptSet,  ConceptReferenceSource, ConceptDescription, ConceptNumeric, ConceptReferenceTerm, ConceptReferenceMap, ConceptMapType, ConceptDatatype
-from omrs.management.commands import OclOpenmrsHelper, ConceptHelper, UnrecognizedSourceException
-import requests, datetime
+from django.db import transaction, connections, OperationalError
+from django.db.models import Max
+from omrs.models import Concept, ConceptName, ConceptClass, ConceptAnswer, ConceptSet,  ConceptReferenceSource, ConceptDescription, ConceptReferenceTerm, ConceptReferenceMap, ConceptMapType, ConceptDatatype
+from omrs.management.commands import OclOpenmrsHelper, ConceptCrosswalk, BulkWriter, RenamingCursor, PlanWriter, LookupCache, ConceptNameIndex, ExistingRows, SyncStats, ConceptRecord, MappingRecord, UnrecognizedSourceException
+import datetime
 from django.utils import timezone
 
 
@@ -42,16 +106,88 @@ class Command(BaseCommand):
                     dest='mapping_filename',
                     default=None,
                     help='OCL mapping filename'),
+        make_option('--previous_concept_file',
+                    action='store',
+                    dest='previous_concept_filename',
+                    default=None,
+                    help='Previous version of the concept file; only added and changed concepts are synced'),
+        make_option('--previous_mapping_file',
+                    action='store',
+                    dest='previous_mapping_filename',
+                    default=None,
+                    help='Previous version of the mapping file; only added and changed mappings are synced'),
+        make_option('--crosswalk_file',
+                    action='store',
+                    dest='crosswalk_filename',
+                    default=None,
+                    help='File to load and save the old to new concept ID crosswalk'),
+        make_option('--batch_size',
+                    action='store',
+                    dest='batch_size',
+                    default=1000,
+                    help='Number of new rows to accumulate before they are inserted with multi-row inserts'),
+        make_option('--commit_every',
+                    action='store',
+                    dest='commit_every',
+                    default=None,
+                    help='Commit every N concepts or mappings in one transaction instead of autocommitting each row'),
+        make_option('--checkpoint_file',
+                    action='store',
+                    dest='checkpoint_filename',
+                    default=None,
+                    help='File to record the progress of the sync in after each committed group (requires --commit_every)'),
+        make_option('--resume',
+                    action='store_true',
+                    dest='resume',
+                    default=False,
+                    help='Continue a sync from the position recorded in --checkpoint_file'),
+        make_option('--workers',
+                    action='store',
+                    dest='workers',
+                    default=1,
+                    help='Number of worker processes to sync concepts and mappings with'),
+        make_option('--database',
+                    action='append',
+                    dest='databases',
+                    default=[],
+                    help='Alias of the database to sync into (default "default"). May be repeated to sync into several databases at once'),
+        make_option('--engine',
+                    action='store',
+                    type='choice',
+                    choices=['python', 'staging'],
+                    dest='engine',
+                    default='python',
+                    help='"python" syncs record by record, "staging" loads the files into staging tables and merges them with set-based SQL'),
+        make_option('--progress',
+                    action='store_true',
+                    dest='progress',
+                    default=False,
+                    help='Show a progress line with the rate and ETA on stderr'),
+        make_option('--stats_file',
+                    action='store',
+                    dest='stats_filename',
+                    default=None,
+                    help='Record rows, SQL queries, time and memory per phase and save them to this JSON file'),
+        make_option('--plan',
+                    action='store',
+                    dest='plan_filename',
+                    default=None,
+                    help='Dry run: write the rows that would be inserted to this plan file instead of the database'),
+        make_option('--apply_plan',
+                    action='store',
+                    dest='apply_plan_filename',
+                    default=None,
+                    help='Insert the rows of a plan file created with --plan'),
         make_option('--concept_id',
                     action='store',
                     dest='concept_id',
                     default=None,
                     help='ID for concept to sync, if specified only sync this one. e.g. 5839'),
         make_option('--retired',
-                    action='store_true',
-                    dest='retire_sw',
-                    default=False,
-                    help='If specify, output a list of retired concepts.'),
+                    action='store',
+                    dest='retired_filename',
+                    default=None,
+                    help='File of retired concept IDs, as written by "extract_db --retired", to retire after the sync'),
         make_option('--org_id',
                     action='store',
                     dest='org_id',
@@ -79,6 +215,24 @@ class Command(BaseCommand):
                     help='OCL API token to validate OpenMRS reference sources'),
     )
 
+    # Number of times a group of records is retried after a lock wait or deadlock error,
+    # which concurrent workers can run into
+    LOCK_RETRIES = 3
+
+    # Seconds to wait for a result from child processes before checking that they are still alive
+    RESULT_POLL_SECONDS = 5
+
+    # Number of concepts retired per UPDATE ... WHERE concept_id IN (...) statement
+    RETIRE_BATCH_SIZE = 500
+    RETIRE_REASON = 'Retired in the source dictionary'
+
+    # Tables created by the staging engine for the duration of a sync. Each sync adds a suffix of
+    # its own to their names, so that concurrent syncs into the same database do not share them.
+    # On MySQL, where they are regular tables, the suffix is also the name of a lock held by the sync.
+    STAGING_PREFIX = 'ocl_stg_'
+    STAGING_TABLES = ('ocl_stg_concept', 'ocl_stg_name', 'ocl_stg_description', 'ocl_stg_rep', 'ocl_stg_crosswalk',
+                      'ocl_stg_prior_crosswalk', 'ocl_stg_mapping', 'ocl_stg_first', 'ocl_stg_term', 'ocl_stg_refmap')
+
     OCL_API_URL = {
         'dev': 'http://api.dev.openconceptlab.com/',
         'staging': 'http://api.staging.openconceptlab.com/',
@@ -101,8 +255,22 @@ class Command(BaseCommand):
         self.concept_id = options['concept_id']
         self.concept_filename = options['concept_filename']
         self.mapping_filename = options['mapping_filename']
-
-        self.do_retire = options['retire_sw']
+        self.previous_concept_filename = options['previous_concept_filename']
+        self.previous_mapping_filename = options['previous_mapping_filename']
+        self.crosswalk_filename = options['crosswalk_filename']
+        self.batch_size = int(options['batch_size'])
+        self.commit_every = int(options['commit_every']) if options['commit_every'] else None
+        self.workers = int(options['workers'])
+        self.databases = options['databases'] or ['default']
+        self.engine = options['engine']
+        self.progress = options['progress']
+        self.stats_filename = options['stats_filename']
+        self.checkpoint_filename = options['checkpoint_filename']
+        self.resume = options['resume']
+        self.plan_filename = options['plan_filename']
+        self.apply_plan_filename = options['apply_plan_filename']
+
+        self.retired_filename = options['retired_filename']
 
         self.verbosity = int(options['verbosity'])
         self.ocl_api_token = options['token']
@@ -116,18 +284,31 @@ class Command(BaseCommand):
         # Validate the options
         self.validate_options()
 
-        # Load the concepts and mapping file into memory
-        # NOTE: This will only work if it can fit into memory -- explore streaming partial loads
+        # Input files parsed ahead of a sync into several databases
+        self.parsed_files = {}
+
+        # Lock shared by the workers to write their groups one at a time (SQLite only)
+        self.write_lock = None
 
-        concepts = []
-        mappings = []
-        for line in open(self.concept_filename, 'r'):
-            concepts.append(json.loads(line))
-        for line in open(self.mapping_filename, 'r'):
-            mappings.append(json.loads(line))
+        if len(self.databases) > 1:
+            self.sync_databases()
+            return
+        self.database = self.databases[0]
+        self.sync_database()
+
+        # Display final counts
+        if self.verbosity:
+            self.print_debug_summary()
+        if self.stats_filename:
+            self.save_stats()
+        if self.failed_batches:
+            raise CommandError('%d batch(es) failed and were rolled back' % len(self.failed_batches))
 
+    def sync_database(self):
+        """ Syncs the files, or applies a plan, into the database self.database """
         # Initialize counters
         self.cnt_total_concepts_processed = 0
+        self.cnt_concepts_matched = 0
         self.cnt_concepts_created = 0
         self.cnt_internal_mappings_created = 0
         self.cnt_external_mappings_created = 0
@@ -137,14 +318,63 @@ class Command(BaseCommand):
         self.cnt_retired_concepts_created = 0
         self.cnt_set_members_created = 0
         self.cnt_retired_concepts_created = 0
+        self.cnt_concepts_retired = 0
+        self.cnt_concepts_already_retired = 0
+        self.cnt_retired_not_found = 0
         self.cnt_of_classes = {}
+        self.cnt_inserted = {}
+        self.failed_batches = []
+        self.cnt_delta = {}
+        self.synced_concept_ids = None
+        self.shared_rows_pass = False
+        self.term_creating_mappings = set()
+        self.stats = SyncStats(enabled=bool(self.stats_filename), using=self.database)
+
+        # Load the concept ID crosswalk from an earlier run, if any
+        if self.crosswalk_filename and os.path.exists(self.crosswalk_filename):
+            self.crosswalk = ConceptCrosswalk.load(self.crosswalk_filename)
+        else:
+            self.crosswalk = ConceptCrosswalk()
 
-        # Process concepts, mappings, or retirement script
-        self.sync_db(concepts, mappings)
+        # Classes, datatypes, sources, map types and reference terms are preloaded
+        self.load_lookup_caches()
 
-        # Display final counts
-        if self.verbosity:
-            self.print_debug_summary()
+        # Incoming concepts are matched to existing ones by name using an in-memory index
+        # (the staging engine matches them in the database, except for unchanged concepts of a delta)
+        if self.engine == 'python' or self.previous_concept_filename:
+            with self.stats.phase('concept matching'):
+                self.concept_names = ConceptNameIndex(using=self.database)
+
+        # Rows of the records being processed that already exist, loaded per chunk of records
+        self.existing = ExistingRows(using=self.database)
+
+        # Process concepts, mappings, or retirement script
+        if self.apply_plan_filename:
+            # New rows are queued and written in batches
+            self.writer = BulkWriter(batch_size=self.batch_size, using=self.database, resolve_models=(Concept, ConceptReferenceTerm),
+                                     stats=self.stats)
+            self.apply_plan()
+        elif self.plan_filename:
+            with open(self.plan_filename, 'w') as plan_file:
+                self.writer = PlanWriter(plan_file, batch_size=self.batch_size, using=self.database,
+                                         resolve_models=(Concept, ConceptReferenceTerm), stats=self.stats)
+                self.writer.write_record({'plan': self.get_db_fingerprint()})
+                if self.concept_filename:
+                    self.sync_db()
+                if self.retired_filename:
+                    self.retire_concepts()
+        else:
+            self.writer = BulkWriter(batch_size=self.batch_size, using=self.database, resolve_models=(Concept, ConceptReferenceTerm),
+                                     stats=self.stats)
+            if self.concept_filename:
+                self.sync_db()
+            if self.retired_filename:
+                self.retire_concepts()
+
+    def save_stats(self):
+        """ Saves the per-phase stats of the sync to the stats file as JSON """
+        with open(self.stats_filename, 'w') as stats_file:
+            json.dump(self.stats.get_report(), stats_file, indent=2)
 
     def validate_options(self):
         """
@@ -154,9 +384,43 @@ class Command(BaseCommand):
         # If concept/mapping export enabled, org/source IDs are required & must be valid mnemonics
         # TODO: Check that org and source IDs are valid mnemonics
         # TODO: Check that specified org and source IDs exist in OCL
-        if (not self.concept_filename or not self.mapping_filename):
+        if self.apply_plan_filename:
+            if self.plan_filename:
+                raise CommandError('ERROR: "plan" and "apply_plan" cannot be used together')
+            if self.retired_filename:
+                raise CommandError('ERROR: "retired" cannot be used with "apply_plan", the plan has the retired concepts')
+        elif self.retired_filename and not self.concept_filename and not self.mapping_filename:
+            # Only retire concepts, whose new IDs come from the crosswalk of an earlier sync
+            if not self.crosswalk_filename:
+                raise CommandError('ERROR: "retired" without concept and mapping files requires "crosswalk_file"')
+        elif (not self.concept_filename or not self.mapping_filename):
             raise CommandError(
                 ("ERROR: concept and mapping json file names are required options "))
+        if self.workers < 1:
+            raise CommandError('ERROR: "workers" must be at least 1')
+        if self.workers > 1 and (self.plan_filename or self.apply_plan_filename):
+            raise CommandError('ERROR: "workers" cannot be used with "plan" or "apply_plan"')
+        if self.resume and not self.checkpoint_filename:
+            raise CommandError('ERROR: "resume" requires "checkpoint_file"')
+        if self.checkpoint_filename:
+            if not self.commit_every:
+                raise CommandError('ERROR: "checkpoint_file" requires "commit_every"')
+            if self.workers > 1 or self.plan_filename or self.apply_plan_filename or self.concept_id:
+                raise CommandError('ERROR: "checkpoint_file" cannot be used with "workers", "plan", "apply_plan" or "concept_id"')
+        if self.previous_concept_filename or self.previous_mapping_filename:
+            if self.workers > 1 or self.checkpoint_filename or self.apply_plan_filename:
+                raise CommandError('ERROR: "previous_concept_file" and "previous_mapping_file" cannot be used with "workers", "checkpoint_file" or "apply_plan"')
+        if self.engine == 'staging':
+            if self.workers > 1 or self.commit_every or self.checkpoint_filename or self.plan_filename or self.apply_plan_filename:
+                raise CommandError('ERROR: "engine=staging" cannot be used with "workers", "commit_every", "checkpoint_file", "plan" or "apply_plan"')
+        for database in self.databases:
+            if database not in connections.databases:
+                raise CommandError('ERROR: unknown database "%s"' % database)
+        if len(set(self.databases)) != len(self.databases):
+            raise CommandError('ERROR: the same "database" is given more than once')
+        if len(self.databases) > 1:
+            if self.workers > 1 or self.plan_filename or self.apply_plan_filename or self.checkpoint_filename:
+                raise CommandError('ERROR: several "database" options cannot be used with "workers", "plan", "apply_plan" or "checkpoint_file"')
         if self.ocl_api_env not in self.OCL_API_URL:
             raise CommandError('Invalid "env" option provided: %s' % self.ocl_api_env)
         return True
@@ -167,6 +431,30 @@ class Command(BaseCommand):
         print 'SUMMARY'
         print '------------------------------------------------------'
         print 'Total concepts processed: %d' % self.cnt_total_concepts_processed
+        print 'Concepts matched by name: %d' % self.cnt_concepts_matched
+        print '%s:' % ('Planned new rows' if self.plan_filename else 'New rows')
+        cnt_inserted = dict(self.cnt_inserted)
+        for model_name, count in self.writer.cnt_inserted.items():
+            cnt_inserted[model_name] = cnt_inserted.get(model_name, 0) + count
+        for model_name in sorted(cnt_inserted):
+            print '    %s: %d' % (model_name, cnt_inserted[model_name])
+        if self.retired_filename or self.cnt_concepts_retired:
+            print '%s: %d (%d already retired, %d not in the crosswalk)' % (
+                'Planned retired concepts' if self.plan_filename else 'Retired concepts',
+                self.cnt_concepts_retired, self.cnt_concepts_already_retired, self.cnt_retired_not_found)
+        for phase in sorted(self.cnt_delta):
+            print '%s delta: %d added, %d changed, %d unchanged, %d removed' % ((phase,) + tuple(
+                self.cnt_delta[phase][key] for key in ('added', 'changed', 'unchanged', 'removed')))
+        if self.failed_batches:
+            print 'Failed batches (rolled back):'
+            for phase, first, last, error in self.failed_batches:
+                print '    %s %s to %s: %s' % (phase, first, last, error)
+        if self.stats.enabled:
+            print 'Phases:'
+            for name, phase in self.stats.get_report()['phases'].items():
+                print '    %s: %d inserted, %d skipped, %d queries (%.1fs), %.1fs, peak memory +%d KB' % (
+                    name, phase['inserted'], phase['skipped'], phase['queries'], phase['query_time'], phase['time'],
+                    phase['memory_growth_kb'])
         print '------------------------------------------------------'
         print 'Class Counts: '
         for key in self.cnt_of_classes:
@@ -181,7 +469,7 @@ class Command(BaseCommand):
         """ Validates that all reference sources in OpenMRS have been defined in OCL. """
         url_base = self.OCL_API_URL[self.ocl_api_env]
         headers = {'Authorization': 'Token %s' % self.ocl_api_token}
-        reference_sources = ConceptReferenceSource.objects.all()
+        reference_sources = ConceptReferenceSource.objects.using(self.database).all()
         reference_sources = reference_sources.filter(retired=0)
         enum_reference_sources = enumerate(reference_sources)
         for num, source in enum_reference_sources:
@@ -196,6 +484,8 @@ class Command(BaseCommand):
 
             # Check that org:source exists in OCL
             if self.ocl_api_token:
+                # requests is only imported here, as it adds to the startup time of every run
+                import requests
                 url = url_base + 'orgs/%s/sources/%s/' % (org_id, source_id)
                 r = requests.head(url, headers=headers)
                 if r.status_code != requests.codes.OK:
@@ -209,33 +499,1083 @@ class Command(BaseCommand):
 
     ## MAIN EXPORT LOOP
 
-    def sync_db(self, concepts, mappings):
+    def sync_db(self):
         """
         Main loop to sync all concepts and/or their mappings.
 
-        Loop thru all concepts and mappings and generates needed entries.
+        Streams the concept file and then the mapping file, one line at a time, so only the
+        crosswalk of concept IDs is kept across the two passes.
         Note that the retired status of concepts is not handled here.
         """
-
-        # Create the concept enumerator, applying 'concept_id'
+        if self.workers > 1 and self.concept_id is None:
+            self.sync_db_parallel()
+            return
+        if self.engine == 'staging':
+            self.sync_db_staging()
+            return
+
+        phase, cnt_done = 'Concepts', 0
+        if self.resume:
+            phase, cnt_done = self.load_checkpoint()
+            if phase == 'Done':
+                print 'The sync in checkpoint "%s" is already complete' % self.checkpoint_filename
+            elif self.verbosity:
+                print 'Resuming %s after %d records' % (phase, cnt_done)
+
+        if phase == 'Concepts':
+            concepts = self.get_concept_records(cnt_done)
+
+            # Iterate concepts and process them
+            self.process_in_transactions(concepts, self.sync_concept, 'Concepts', lambda concept: concept.id, cnt_done,
+                                         prefetch=self.prefetch_concepts)
+
+            # Save the crosswalk before the mappings so it survives a failed mapping sync
+            # (a dry run only has synthetic IDs for new concepts, so it does not save it)
+            if self.crosswalk_filename and not self.plan_filename:
+                self.crosswalk.save(self.crosswalk_filename)
+            phase, cnt_done = 'Mappings', 0
+            self.save_checkpoint(phase, cnt_done)
+
+        if phase == 'Mappings':
+            mappings = self.get_mapping_records(cnt_done)
+            self.process_in_transactions(mappings, self.sync_mapping, 'Mappings', lambda ref_map: ref_map.external_id, cnt_done,
+                                         prefetch=self.prefetch_mappings)
+            self.save_checkpoint('Done', 0)
+
+    def get_concept_records(self, cnt_done=0):
+        """ Returns the concepts to sync, after the first cnt_done """
+        concepts = self.read_json_lines(self.concept_filename, skip=cnt_done, record_type=ConceptRecord)
+        if self.progress:
+            concepts = self.stats.track(concepts, 'Concepts', self.count_json_lines(self.concept_filename) - cnt_done)
+
+        # If 'concept_id' option set, only sync that concept
         if self.concept_id is not None:
-            # If 'concept_id' option set, fetch a single concept and convert to enumerator
-            concept_enumerator = enumerate([concepts])
-        else:
-            # Fetch all concepts
-            concept_enumerator = enumerate(concepts)
+            concepts = (concept for concept in concepts if str(concept.id) == self.concept_id)
+
+        # Only sync what changed since the previous version
+        if self.previous_concept_filename:
+            concepts = self.filter_delta(concepts, self.previous_concept_filename, ConceptRecord, 'Concepts',
+                                         lambda concept: concept.id, self.resolve_unchanged_concepts)
+            concepts = self.record_synced_concepts(concepts)
+        return concepts
+
+    def get_mapping_records(self, cnt_done=0):
+        """ Returns the mappings to sync, after the first cnt_done """
+        mappings = self.read_json_lines(self.mapping_filename, skip=cnt_done, record_type=MappingRecord)
+        if self.progress:
+            mappings = self.stats.track(mappings, 'Mappings', self.count_json_lines(self.mapping_filename) - cnt_done)
+        if self.previous_mapping_filename:
+            mappings = self.filter_delta(mappings, self.previous_mapping_filename, MappingRecord, 'Mappings',
+                                         self.get_mapping_id, is_affected=self.maps_synced_concept)
+        return mappings
+
+    ## DELTA SYNC
+
+    def get_record_digest(self, record):
+        """ Returns a hash of the content of a record that the sync uses """
+        return hashlib.md5(json.dumps(record.get_fields(), sort_keys=True)).digest()
+
+    def get_mapping_id(self, ref_map):
+        """ Mappings are identified by their external_id, or by their content if they have none """
+        return ref_map.external_id or self.get_record_digest(ref_map)
+
+    def filter_delta(self, records, previous_filename, record_type, phase, get_id, process_unchanged=None, is_affected=None):
+        """
+        Yields the records that were added or changed since the previous version of the file,
+        and unchanged records for which is_affected returns True. Only the ID and content hash
+        of the previous records are kept in memory. Other unchanged records are passed to
+        process_unchanged in chunks of 'batch_size'.
+        """
+        previous_digests = {}
+        for record in self.read_json_lines(previous_filename, record_type=record_type):
+            previous_digests[get_id(record)] = self.get_record_digest(record)
+
+        cnt = self.cnt_delta[phase] = {'added': 0, 'changed': 0, 'unchanged': 0, 'removed': 0}
+        unchanged = []
+        for record in records:
+            previous_digest = previous_digests.pop(get_id(record), None)
+            if previous_digest is None:
+                cnt['added'] += 1
+            elif previous_digest != self.get_record_digest(record):
+                cnt['changed'] += 1
+            else:
+                cnt['unchanged'] += 1
+                if is_affected and is_affected(record):
+                    yield record
+                    continue
+                if process_unchanged:
+                    unchanged.append(record)
+                    if len(unchanged) >= self.batch_size:
+                        process_unchanged(unchanged)
+                        unchanged = []
+                continue
+            yield record
+        if unchanged:
+            process_unchanged(unchanged)
+
+        # Whatever is left was removed from the export
+        cnt['removed'] = len(previous_digests)
+        if self.verbosity >= 2:
+            for record_id in previous_digests:
+                print '%s removed since the previous version: %r' % (phase, record_id)
+
+    def record_synced_concepts(self, concepts):
+        """ Passes the concepts of a delta through, keeping their IDs """
+        self.synced_concept_ids = set()
+        for concept in concepts:
+            self.synced_concept_ids.add(int(concept.id))
+            yield concept
+
+    def maps_synced_concept(self, ref_map):
+        """
+        Returns True if a mapping is from or to a concept synced by this delta, in which case
+        it may not have been synced before (e.g. if the concept was added)
+        """
+        if self.synced_concept_ids is None:
+            return False
+        return ref_map.from_concept_id in self.synced_concept_ids or ref_map.to_concept_id in self.synced_concept_ids
+
+    def resolve_unchanged_concepts(self, concepts):
+        """
+        Adds unchanged concepts, which are not synced, to the crosswalk so that mappings to
+        them can be synced. They are looked up by uuid, then by name.
+        """
+        concepts = [concept for concept in concepts if self.crosswalk.get_new_id(concept.id) is None]
+        with self.stats.phase('concept matching'):
+            existing = ExistingRows(using=self.database)
+            existing.load(Concept, 'uuid', [concept.external_id for concept in concepts], value_field='concept_id')
+            for concept in concepts:
+                new_concept_id = existing.get(Concept, concept.external_id)
+                for cname in concept.names:
+                    if new_concept_id is not None:
+                        break
+                    new_concept_id = self.concept_names.get(cname.name, cname.locale)
+                if new_concept_id is not None:
+                    self.crosswalk.add(concept.id, new_concept_id)
+
+    ## CHECKPOINTS
+
+    def save_checkpoint(self, phase, cnt_done):
+        """
+        Records that the first cnt_done records of the phase are done. The crosswalk is kept
+        next to the checkpoint; both files are replaced atomically.
+        """
+        if not self.checkpoint_filename:
+            return
+        crosswalk_filename = self.checkpoint_filename + '.crosswalk'
+        if phase == 'Concepts' or cnt_done == 0:
+            self.crosswalk.save(crosswalk_filename + '.tmp')
+            os.rename(crosswalk_filename + '.tmp', crosswalk_filename)
+        checkpoint = {
+            'concept_file': os.path.abspath(self.concept_filename),
+            'mapping_file': os.path.abspath(self.mapping_filename),
+            'phase': phase,
+            'records_done': cnt_done,
+            'crosswalk_file': crosswalk_filename,
+        }
+        with open(self.checkpoint_filename + '.tmp', 'w') as checkpoint_file:
+            json.dump(checkpoint, checkpoint_file)
+        os.rename(self.checkpoint_filename + '.tmp', self.checkpoint_filename)
+
+    def load_checkpoint(self):
+        """ Loads the crosswalk of a checkpoint and returns its (phase, records done) """
+        if not os.path.exists(self.checkpoint_filename):
+            raise CommandError('Checkpoint file "%s" not found' % self.checkpoint_filename)
+        with open(self.checkpoint_filename, 'r') as checkpoint_file:
+            checkpoint = json.load(checkpoint_file)
+        if (checkpoint['concept_file'] != os.path.abspath(self.concept_filename) or
+                checkpoint['mapping_file'] != os.path.abspath(self.mapping_filename)):
+            raise CommandError('Checkpoint "%s" was written for other input files' % self.checkpoint_filename)
+        crosswalk = ConceptCrosswalk.load(checkpoint['crosswalk_file'])
+        for old_concept_id, new_concept_id in crosswalk.values.items():
+            self.crosswalk.add(old_concept_id, new_concept_id)
+        return checkpoint['phase'], checkpoint['records_done']
+
+    ## PARALLEL SYNC
+
+    def sync_db_parallel(self):
+        """
+        Syncs concepts and then mappings with several worker processes.
 
-        # Iterate concept enumerator and process them
+        Workers never create the same row: the main process first creates the shared rows
+        (classes and datatypes, then sources, map types and reference terms) serially and in
+        input order, so each worker finds them in the inherited lookup caches. Concepts that
+        share a name are assigned to the same worker, and mappings are assigned by their
+        from concept, which also owns the reference maps and CIEL term they create.
+        """
+        self.assign_concepts_to_workers()
+        for result in self.run_workers('Concepts'):
+            for old_concept_id, new_concept_id in result['crosswalk']:
+                self.crosswalk.add(old_concept_id, new_concept_id)
+        if self.crosswalk_filename:
+            self.crosswalk.save(self.crosswalk_filename)
 
-        for num, concept in concept_enumerator:
+        self.create_shared_mapping_rows()
+        self.run_workers('Mappings')
+
+    def assign_concepts_to_workers(self):
+        """
+        Creates the classes and datatypes of the concepts and assigns each concept to a
+        worker: the worker of the first earlier concept sharing one of its names, otherwise
+        the next worker in turn.
+        """
+        self.concept_workers = array('H')
+        name_workers = {}
+        for num, concept in enumerate(self.read_json_lines(self.concept_filename, record_type=ConceptRecord)):
+            self.get_concept_class(concept.concept_class, concept.retired)
+            self.get_datatype(concept.datatype)
+            name_keys = [ConceptNameIndex.make_key(cname.name, cname.locale) for cname in concept.names]
+            worker = num % self.workers
+            for name_key in name_keys:
+                if name_key in name_workers:
+                    worker = name_workers[name_key]
+                    break
+            for name_key in name_keys:
+                name_workers.setdefault(name_key, worker)
+            self.concept_workers.append(worker)
+
+    def create_shared_mapping_rows(self):
+        """
+        Runs the mapping sync serially, writing only reference terms (sources and map types
+        are saved as they are found). Mappings whose term is created here are remembered,
+        because the original sync only adds reference maps for newly created terms.
+        """
+        self.shared_rows_pass = True
+        self.writer = BulkWriter(batch_size=self.batch_size, using=self.database, resolve_models=(ConceptReferenceTerm,),
+                                 write_models=(ConceptReferenceTerm,), stats=self.stats)
+        self.process_in_transactions(self.read_json_lines(self.mapping_filename, record_type=MappingRecord), self.sync_mapping,
+                                     'Shared mapping rows', lambda ref_map: ref_map.external_id)
+        self.shared_rows_pass = False
+
+    def get_mapping_worker(self, ref_map):
+        """ Returns the worker of a mapping, based on the ID of its from concept """
+        return (ref_map.from_concept_id or 0) % self.workers
+
+    def run_workers(self, phase):
+        """ Runs one phase in 'workers' processes and adds up their results """
+        # Each process must open its own database connection
+        for connection in connections.all():
+            connection.close()
+        # SQLite allows a single writer, and a transaction that starts by reading cannot wait for
+        # another one to commit, so the workers take turns to write their groups
+        if self.commit_every and connections[self.database].vendor == 'sqlite':
+            self.write_lock = multiprocessing.Lock()
+        results = multiprocessing.Queue()
+        processes = [multiprocessing.Process(target=self.run_worker, args=(phase, worker, results))
+                     for worker in range(self.workers)]
+        for process in processes:
+            process.start()
+        worker_results = self.collect_results(processes, results, 'worker', range(self.workers), 'worker %s')
+
+        for result in worker_results:
+            if 'error' in result:
+                raise CommandError('Worker %d failed: %s' % (result['worker'], result['error']))
+            self.cnt_total_concepts_processed += result['cnt_total_concepts_processed']
+            self.cnt_concepts_matched += result['cnt_concepts_matched']
+            for key, count in result['cnt_of_classes'].items():
+                self.cnt_of_classes[key] = self.cnt_of_classes.get(key, 0) + count
+            for key, count in result['cnt_inserted'].items():
+                self.cnt_inserted[key] = self.cnt_inserted.get(key, 0) + count
+            self.failed_batches.extend(result['failed_batches'])
+            self.stats.merge(result['stats'])
+        return worker_results
+
+    def collect_results(self, processes, results, key, names, label):
+        """
+        Waits for the result that each child process puts in the queue, identified by its value
+        for key (one of names, in process order), and returns them in that order. A process that
+        exits without a result, e.g. after being killed, is reported as a CommandError.
+        """
+        collected = {}
+        exited = set()
+        while len(collected) < len(processes):
+            try:
+                result = results.get(timeout=self.RESULT_POLL_SECONDS)
+            except Queue.Empty:
+                for name, process in zip(names, processes):
+                    if name in collected or process.is_alive():
+                        continue
+                    # Give the result of a process that just exited one more poll to arrive
+                    if name in exited:
+                        for other in processes:
+                            if other.is_alive():
+                                other.terminate()
+                        raise CommandError('ERROR: %s exited with code %s without a result' % (label % name, process.exitcode))
+                    exited.add(name)
+                continue
+            collected[result[key]] = result
+        for process in processes:
+            process.join()
+        return [collected[name] for name in names]
+
+    def run_worker(self, phase, worker, results):
+        """ Syncs the concepts or mappings assigned to one worker, in a child process """
+        try:
+            self.cnt_total_concepts_processed = 0
+            self.cnt_concepts_matched = 0
+            self.cnt_of_classes = {}
+            self.failed_batches = []
+            self.stats = SyncStats(enabled=self.stats.enabled, using=self.database)
+            self.writer = BulkWriter(batch_size=self.batch_size, using=self.database, resolve_models=(Concept, ConceptReferenceTerm),
+                                     stats=self.stats)
+            if phase == 'Concepts':
+                concepts = (concept for num, concept in enumerate(self.read_json_lines(self.concept_filename, record_type=ConceptRecord))
+                            if self.concept_workers[num] == worker)
+                self.process_in_transactions(concepts, self.sync_concept, phase, lambda concept: concept.id,
+                                             prefetch=self.prefetch_concepts)
+            else:
+                mappings = (ref_map for ref_map in self.read_json_lines(self.mapping_filename, record_type=MappingRecord)
+                            if self.get_mapping_worker(ref_map) == worker)
+                self.process_in_transactions(mappings, self.sync_mapping, phase, lambda ref_map: ref_map.external_id,
+                                             prefetch=self.prefetch_mappings)
+            results.put({
+                'worker': worker,
+                'cnt_total_concepts_processed': self.cnt_total_concepts_processed,
+                'cnt_concepts_matched': self.cnt_concepts_matched,
+                'cnt_of_classes': self.cnt_of_classes,
+                'cnt_inserted': self.writer.cnt_inserted,
+                'failed_batches': self.failed_batches,
+                'stats': self.stats.phases,
+                'crosswalk': self.crosswalk.values.items() if phase == 'Concepts' else [],
+            })
+        except Exception as e:
+            results.put({'worker': worker, 'error': str(e)})
+        finally:
+            for connection in connections.all():
+                connection.close()
+
+    ## SYNC INTO SEVERAL DATABASES
+
+    def sync_databases(self):
+        """
+        Syncs the same files into several databases at once. The files are parsed once, then
+        one process per database is forked with its own connection, caches and counters. The
+        summary of each database is printed once all of them are done.
+        """
+        for filename, record_type in ((self.concept_filename, ConceptRecord), (self.mapping_filename, MappingRecord),
+                                      (self.previous_concept_filename, ConceptRecord),
+                                      (self.previous_mapping_filename, MappingRecord), (self.retired_filename, None)):
+            if filename:
+                self.parsed_files[filename] = list(self.read_json_lines(filename, record_type=record_type))
+
+        # Each process must open its own database connection
+        for connection in connections.all():
+            connection.close()
+        results = multiprocessing.Queue()
+        processes = [multiprocessing.Process(target=self.sync_database_process, args=(database, results))
+                     for database in self.databases]
+        for process in processes:
+            process.start()
+        database_results = self.collect_results(processes, results, 'database', self.databases, 'the sync of database "%s"')
+
+        failed_databases = []
+        for database, result in zip(self.databases, database_results):
+            if 'error' in result:
+                print 'Database "%s" failed: %s' % (database, result['error'])
+                failed_databases.append(database)
+                continue
+            if self.verbosity:
+                print 'DATABASE "%s"' % database
+                sys.stdout.write(result['summary'])
+            if result['cnt_failed_batches']:
+                failed_databases.append(database)
+        if failed_databases:
+            raise CommandError('The sync failed in database(s): %s' % ', '.join(failed_databases))
+
+    def sync_database_process(self, database, results):
+        """ Syncs one of several databases, in a child process. Its files get the database alias as suffix. """
+        try:
+            self.database = database
+            if self.crosswalk_filename:
+                self.crosswalk_filename += '.' + database
+            if self.stats_filename:
+                self.stats_filename += '.' + database
+            self.sync_database()
+
+            summary = StringIO()
+            stdout, sys.stdout = sys.stdout, summary
+            try:
+                if self.verbosity:
+                    self.print_debug_summary()
+            finally:
+                sys.stdout = stdout
+            if self.stats_filename:
+                self.save_stats()
+            results.put({'database': database, 'summary': summary.getvalue(),
+                         'cnt_failed_batches': len(self.failed_batches)})
+        except Exception as e:
+            results.put({'database': database, 'error': str(e)})
+        finally:
+            for connection in connections.all():
+                connection.close()
+
+    ## STAGING ENGINE
+
+    def sync_db_staging(self):
+        """
+        Syncs with set-based statements instead of record by record. The concept and mapping
+        files are loaded into staging tables with multi-row inserts, and the merge into the
+        OpenMRS tables is done with INSERT ... SELECT statements and NOT EXISTS anti-joins,
+        in one transaction.
+        """
+        connection = connections[self.database]
+        owner = uuid.uuid4().hex[:8]
+        cursor = RenamingCursor(connection.cursor(), self.STAGING_PREFIX, '_' + owner)
+        try:
+            with self.stats.phase('staging'):
+                if connection.vendor == 'mysql':
+                    self.lock_staging_tables(connection.cursor(), owner)
+                    self.drop_stale_staging_tables(connection.cursor())
+                self.create_staging_tables(cursor)
+            with transaction.atomic(using=self.database):
+                self.staging_now = connection.ops.value_to_db_datetime(timezone.now())
+                with self.stats.phase('staging'):
+                    self.stage_concepts(cursor, self.get_concept_records())
+                self.merge_concepts(cursor)
+                self.load_staged_crosswalk(cursor)
+                if self.crosswalk_filename:
+                    self.crosswalk.save(self.crosswalk_filename)
+                with self.stats.phase('staging'):
+                    self.stage_mappings(cursor, self.get_mapping_records())
+                self.merge_mappings(cursor)
+        finally:
+            with self.stats.phase('staging'):
+                self.drop_staging_tables(cursor)
+                if connection.vendor == 'mysql':
+                    self.unlock_staging_tables(connection.cursor(), owner)
+
+    def lock_staging_tables(self, cursor, owner):
+        """ Takes the lock of the staging tables of this sync, which MySQL releases if the connection is lost """
+        cursor.execute('SELECT GET_LOCK(%s, 0)', [self.STAGING_PREFIX + owner])
+        if cursor.fetchone()[0] != 1:
+            raise CommandError('ERROR: Cannot lock the staging tables %s*_%s' % (self.STAGING_PREFIX, owner))
+
+    def unlock_staging_tables(self, cursor, owner):
+        cursor.execute('SELECT RELEASE_LOCK(%s)', [self.STAGING_PREFIX + owner])
+
+    def drop_stale_staging_tables(self, cursor):
+        """
+        Drops the staging tables left behind by earlier syncs whose process died before dropping
+        them (killed, out of memory or disconnected): their lock is free, while the tables of
+        syncs that are still running stay locked.
+        """
+        cursor.execute('SELECT table_name FROM information_schema.tables WHERE table_schema = DATABASE() '
+                       'AND table_name LIKE %s', [self.STAGING_PREFIX.replace('_', '\\_') + '%'])
+        for (table,) in cursor.fetchall():
+            owner = table.rsplit('_', 1)[-1]
+            cursor.execute('SELECT IS_FREE_LOCK(%s)', [self.STAGING_PREFIX + owner])
+            if cursor.fetchone()[0] == 1:
+                cursor.execute('DROP TABLE IF EXISTS %s' % connections[self.database].ops.quote_name(table))
+                if self.verbosity >= 1:
+                    print 'Dropped stale staging table %s' % table
+
+    def create_staging_tables(self, cursor):
+        """
+        Creates the staging tables. They are temporary tables, which only live as long as the
+        connection, except on MySQL, which does not allow a temporary table to be referred to
+        twice in the same query: there they are regular tables, and the tables that a sync
+        leaves behind when it dies are dropped by the next one.
+        """
+        create = 'CREATE TABLE' if connections[self.database].vendor == 'mysql' else 'CREATE TEMPORARY TABLE'
+        cursor.execute(create + ' ocl_stg_concept ('
+                       'seq INTEGER NOT NULL, ocl_id INTEGER NOT NULL, uuid VARCHAR(38) NOT NULL, '
+                       'class_id INTEGER NOT NULL, datatype_id INTEGER NOT NULL, is_set INTEGER NOT NULL, '
+                       'retired INTEGER NOT NULL, description TEXT NULL, concept_id INTEGER NULL)')
+        cursor.execute('CREATE INDEX ocl_stg_concept_seq ON ocl_stg_concept (seq)')
+        cursor.execute('CREATE INDEX ocl_stg_concept_uuid ON ocl_stg_concept (uuid)')
+        cursor.execute(create + ' ocl_stg_name ('
+                       'seq INTEGER NOT NULL, concept_seq INTEGER NOT NULL, name VARCHAR(255) NOT NULL, '
+                       'locale VARCHAR(50) NOT NULL, uuid VARCHAR(38) NOT NULL, name_type VARCHAR(50) NULL, '
+                       'locale_preferred INTEGER NOT NULL)')
+        cursor.execute('CREATE INDEX ocl_stg_name_concept ON ocl_stg_name (concept_seq)')
+        cursor.execute('CREATE INDEX ocl_stg_name_name ON ocl_stg_name (name, locale)')
+        cursor.execute(create + ' ocl_stg_description ('
+                       'seq INTEGER NOT NULL, concept_seq INTEGER NOT NULL, description TEXT NOT NULL, '
+                       'locale VARCHAR(50) NOT NULL, uuid VARCHAR(38) NOT NULL)')
+        cursor.execute('CREATE INDEX ocl_stg_description_uuid ON ocl_stg_description (uuid)')
+        cursor.execute(create + ' ocl_stg_rep (seq INTEGER NOT NULL, rep_seq INTEGER NOT NULL)')
+        cursor.execute(create + ' ocl_stg_crosswalk (ocl_id INTEGER NOT NULL, concept_id INTEGER NOT NULL)')
+        cursor.execute('CREATE INDEX ocl_stg_crosswalk_ocl_id ON ocl_stg_crosswalk (ocl_id)')
+        cursor.execute(create + ' ocl_stg_prior_crosswalk (ocl_id INTEGER NOT NULL, concept_id INTEGER NOT NULL)')
+        cursor.execute(create + ' ocl_stg_mapping ('
+                       'seq INTEGER NOT NULL, kind VARCHAR(10) NOT NULL, uuid VARCHAR(38) NOT NULL, '
+                       'from_ocl INTEGER NOT NULL, to_ocl INTEGER NULL, source_id INTEGER NULL, '
+                       'code VARCHAR(255) NOT NULL, map_type_id INTEGER NOT NULL, ciel_source_id INTEGER NULL, '
+                       'ciel_code VARCHAR(255) NOT NULL, ciel_uuid VARCHAR(38) NOT NULL, '
+                       'term_uuid VARCHAR(38) NOT NULL, ciel_term_uuid VARCHAR(38) NOT NULL, '
+                       'creates_term INTEGER NOT NULL)')
+        cursor.execute('CREATE INDEX ocl_stg_mapping_seq ON ocl_stg_mapping (seq)')
+        cursor.execute('CREATE INDEX ocl_stg_mapping_term ON ocl_stg_mapping (source_id, code)')
+        cursor.execute(create + ' ocl_stg_first (seq INTEGER NOT NULL)')
+        cursor.execute('CREATE INDEX ocl_stg_first_seq ON ocl_stg_first (seq)')
+        cursor.execute(create + ' ocl_stg_term ('
+                       'seq INTEGER NOT NULL, source_id INTEGER NOT NULL, code VARCHAR(255) NOT NULL, '
+                       'uuid VARCHAR(38) NOT NULL)')
+        cursor.execute('CREATE INDEX ocl_stg_term_term ON ocl_stg_term (source_id, code)')
+        cursor.execute(create + ' ocl_stg_refmap ('
+                       'seq INTEGER NOT NULL, concept_id INTEGER NOT NULL, source_id INTEGER NOT NULL, '
+                       'code VARCHAR(255) NOT NULL, map_type_id INTEGER NOT NULL, uuid VARCHAR(38) NOT NULL)')
+
+    def drop_staging_tables(self, cursor):
+        """ Drops the staging tables of this sync, including those of a failed create_staging_tables() """
+        for table in self.STAGING_TABLES:
+            cursor.execute('DROP TABLE IF EXISTS %s' % table)
+
+    def bulk_insert(self, cursor, table, columns, rows):
+        """ Loads rows into a staging table using multi-row inserts """
+        sql = 'INSERT INTO %s (%s) VALUES (%s)' % (table, ', '.join(columns), ', '.join(['%s'] * len(columns)))
+        for i in range(0, len(rows), self.batch_size):
+            cursor.executemany(sql, rows[i:i + self.batch_size])
+        del rows[:]
+
+    def insert_select(self, cursor, model, expressions, from_sql, params=()):
+        """
+        Inserts the rows of a SELECT into the table of a model. expressions gives the SQL of the
+        selected columns by field attname; the creator and date_created are set as in sync_concept,
+        and the other fields get their default value. Returns the number of rows inserted.
+        """
+        connection = connections[self.database]
+        constants = {'creator': 1, 'date_created': self.staging_now}
+        columns, select, select_params = [], [], []
+        for field in model._meta.fields:
+            if field.attname in expressions:
+                select.append(expressions[field.attname])
+            elif field.primary_key:
+                continue
+            elif field.attname in constants:
+                select.append('%s')
+                select_params.append(constants[field.attname])
+            else:
+                select.append('%s')
+                select_params.append(field.get_db_prep_save(field.get_default(), connection))
+            columns.append(connection.ops.quote_name(field.column))
+        cursor.execute('INSERT INTO %s (%s) SELECT %s %s' % (
+            connection.ops.quote_name(model._meta.db_table), ', '.join(columns), ', '.join(select), from_sql),
+            select_params + list(params))
+        self.cnt_inserted[model.__name__] = self.cnt_inserted.get(model.__name__, 0) + cursor.rowcount
+        self.stats.insert(cursor.rowcount)
+        return cursor.rowcount
+
+    def stage_concepts(self, cursor, concepts):
+        """ Loads the concepts, names and descriptions into the staging tables """
+        concept_rows, name_rows, description_rows = [], [], []
+        cnt_names = cnt_descriptions = 0
+        for seq, concept in enumerate(concepts):
             self.cnt_total_concepts_processed += 1
-            export_data = ''
-            self.sync_concept(concept)
+            concept_class = self.get_concept_class(concept.concept_class, concept.retired)
+            self.cnt_of_classes[concept.concept_class] = self.cnt_of_classes.get(concept.concept_class, 0) + 1
+            datatype = self.get_datatype(concept.datatype)
+            concept_rows.append((seq, int(concept.id), concept.external_id, concept_class.concept_class_id,
+                                 datatype.concept_datatype_id, int(concept.is_set),
+                                 int(concept.retired), concept.description))
+            for cname in concept.names:
+                cnt_names += 1
+                name_rows.append((cnt_names, seq, cname.name, cname.locale,
+                                  cname.external_id, cname.name_type, int(bool(cname.locale_preferred))))
+            for cdescription in concept.descriptions:
+                cnt_descriptions += 1
+                description_rows.append((cnt_descriptions, seq, cdescription.description,
+                                         cdescription.locale, cdescription.external_id))
+            if len(concept_rows) >= self.batch_size:
+                self.flush_staged_concepts(cursor, concept_rows, name_rows, description_rows)
+        self.flush_staged_concepts(cursor, concept_rows, name_rows, description_rows)
+        self.bulk_insert(cursor, 'ocl_stg_prior_crosswalk', ('ocl_id', 'concept_id'),
+                         list(self.crosswalk.values.items()))
+
+    def flush_staged_concepts(self, cursor, concept_rows, name_rows, description_rows):
+        self.bulk_insert(cursor, 'ocl_stg_concept', ('seq', 'ocl_id', 'uuid', 'class_id', 'datatype_id', 'is_set',
+                                                     'retired', 'description'), concept_rows)
+        self.bulk_insert(cursor, 'ocl_stg_name', ('seq', 'concept_seq', 'name', 'locale', 'uuid', 'name_type',
+                                                  'locale_preferred'), name_rows)
+        self.bulk_insert(cursor, 'ocl_stg_description', ('seq', 'concept_seq', 'description', 'locale', 'uuid'),
+                         description_rows)
+
+    def merge_concepts(self, cursor):
+        """
+        Matches the staged concepts to existing ones and inserts the missing concepts, names and
+        descriptions. As in sync_concept, a concept is matched by uuid, then by the last of its
+        names that an existing concept has, and then by a name that an earlier concept of the
+        file has. A name is only added if no concept has it yet and its uuid does not exist.
+        """
+        with self.stats.phase('concept matching'):
+            # Match by uuid, then by existing names
+            cursor.execute('UPDATE ocl_stg_concept SET concept_id = ('
+                           'SELECT k.concept_id FROM concept k WHERE k.uuid = ocl_stg_concept.uuid)')
+            cursor.execute('UPDATE ocl_stg_concept SET concept_id = ('
+                           'SELECT n.concept_id FROM ocl_stg_name s JOIN concept_name n '
+                           'ON n.name = s.name AND n.locale = s.locale AND n.voided = 0 '
+                           'WHERE s.concept_seq = ocl_stg_concept.seq ORDER BY s.seq DESC LIMIT 1) '
+                           'WHERE concept_id IS NULL')
+
+            # Names that are new and not already taken by an earlier concept of the file
+            cursor.execute('INSERT INTO ocl_stg_first (seq) SELECT s.seq FROM ocl_stg_name s '
+                           'JOIN ocl_stg_concept c ON c.seq = s.concept_seq '
+                           'WHERE NOT EXISTS (SELECT 1 FROM concept_name n '
+                           'WHERE n.name = s.name AND n.locale = s.locale AND n.voided = 0) '
+                           'AND NOT EXISTS (SELECT 1 FROM concept_name n WHERE n.uuid = s.uuid) '
+                           'AND NOT EXISTS (SELECT 1 FROM ocl_stg_name e '
+                           'WHERE e.name = s.name AND e.locale = s.locale AND e.seq < s.seq)')
+
+            # An unmatched concept that has a name of an earlier concept is merged into it
+            cursor.execute('INSERT INTO ocl_stg_rep (seq, rep_seq) '
+                           'SELECT c.seq, MIN(e.concept_seq) FROM ocl_stg_concept c '
+                           'JOIN ocl_stg_name s ON s.concept_seq = c.seq '
+                           'JOIN ocl_stg_name e ON e.name = s.name AND e.locale = s.locale AND e.concept_seq < c.seq '
+                           'WHERE c.concept_id IS NULL GROUP BY c.seq')
+            cursor.execute('SELECT COUNT(*) FROM ocl_stg_concept c WHERE c.concept_id IS NOT NULL '
+                           'OR EXISTS (SELECT 1 FROM ocl_stg_rep r WHERE r.seq = c.seq)')
+            self.cnt_concepts_matched += cursor.fetchone()[0]
+
+        with self.stats.phase('concept insert'):
+            # Insert the concepts that are left if they have a name to add
+            cursor.execute('SELECT c.ocl_id FROM ocl_stg_concept c WHERE c.concept_id IS NULL '
+                           'AND NOT EXISTS (SELECT 1 FROM ocl_stg_rep r WHERE r.seq = c.seq) '
+                           'AND NOT EXISTS (SELECT 1 FROM ocl_stg_first f JOIN ocl_stg_name s ON s.seq = f.seq '
+                           'WHERE s.concept_seq = c.seq)')
+            for row in cursor.fetchall():
+                print 'Concept "%s" has no names, skipping' % row[0]
+            self.insert_select(cursor, Concept, {
+                'concept_class_id': 'c.class_id', 'datatype_id': 'c.datatype_id', 'is_set': 'c.is_set',
+                'retired': 'c.retired', 'description': 'c.description', 'uuid': 'c.uuid',
+            }, 'FROM ocl_stg_concept c WHERE c.concept_id IS NULL '
+               'AND NOT EXISTS (SELECT 1 FROM ocl_stg_rep r WHERE r.seq = c.seq) '
+               'AND EXISTS (SELECT 1 FROM ocl_stg_first f JOIN ocl_stg_name s ON s.seq = f.seq '
+               'WHERE s.concept_seq = c.seq) ORDER BY c.seq')
+
+        with self.stats.phase('concept matching'):
+            # Build the crosswalk: matched concepts, new concepts, then merged concepts in rounds
+            # since a concept can be merged into one that was merged itself
+            cursor.execute('INSERT INTO ocl_stg_crosswalk (ocl_id, concept_id) '
+                           'SELECT c.ocl_id, c.concept_id FROM ocl_stg_concept c WHERE c.concept_id IS NOT NULL')
+            cursor.execute('INSERT INTO ocl_stg_crosswalk (ocl_id, concept_id) '
+                           'SELECT c.ocl_id, k.concept_id FROM ocl_stg_concept c JOIN concept k ON k.uuid = c.uuid '
+                           'WHERE c.concept_id IS NULL')
+            while True:
+                cursor.execute('INSERT INTO ocl_stg_crosswalk (ocl_id, concept_id) '
+                               'SELECT c.ocl_id, MIN(x.concept_id) FROM ocl_stg_rep r '
+                               'JOIN ocl_stg_concept c ON c.seq = r.seq '
+                               'JOIN ocl_stg_concept e ON e.seq = r.rep_seq '
+                               'JOIN ocl_stg_crosswalk x ON x.ocl_id = e.ocl_id '
+                               'WHERE NOT EXISTS (SELECT 1 FROM ocl_stg_crosswalk y WHERE y.ocl_id = c.ocl_id) '
+                               'GROUP BY c.ocl_id')
+                if cursor.rowcount <= 0:
+                    break
+            cursor.execute('INSERT INTO ocl_stg_crosswalk (ocl_id, concept_id) '
+                           'SELECT p.ocl_id, p.concept_id FROM ocl_stg_prior_crosswalk p '
+                           'WHERE NOT EXISTS (SELECT 1 FROM ocl_stg_crosswalk x WHERE x.ocl_id = p.ocl_id)')
+
+        # Names and descriptions of every synced concept
+        with self.stats.phase('names'):
+            self.insert_select(cursor, ConceptName, {
+                'concept_id': 'x.concept_id', 'name': 's.name', 'locale': 's.locale', 'uuid': 's.uuid',
+                'concept_name_type': 's.name_type', 'locale_preferred': 's.locale_preferred', 'voided': '0',
+            }, 'FROM ocl_stg_first f JOIN ocl_stg_name s ON s.seq = f.seq '
+               'JOIN ocl_stg_concept c ON c.seq = s.concept_seq '
+               'JOIN ocl_stg_crosswalk x ON x.ocl_id = c.ocl_id ORDER BY s.seq')
+        with self.stats.phase('descriptions'):
+            self.insert_select(cursor, ConceptDescription, {
+                'concept_id': 'x.concept_id', 'description': 'd.description', 'locale': 'd.locale', 'uuid': 'd.uuid',
+            }, 'FROM ocl_stg_description d JOIN ocl_stg_concept c ON c.seq = d.concept_seq '
+               'JOIN ocl_stg_crosswalk x ON x.ocl_id = c.ocl_id '
+               'WHERE NOT EXISTS (SELECT 1 FROM concept_description k WHERE k.uuid = d.uuid) '
+               'AND NOT EXISTS (SELECT 1 FROM ocl_stg_description e WHERE e.uuid = d.uuid AND e.seq < d.seq) '
+               'ORDER BY d.seq')
+
+    def load_staged_crosswalk(self, cursor):
+        """ Replaces the crosswalk with the one built in the ocl_stg_crosswalk table """
+        cursor.execute('SELECT ocl_id, MIN(concept_id) FROM ocl_stg_crosswalk GROUP BY ocl_id')
+        for old_concept_id, new_concept_id in cursor.fetchall():
+            self.crosswalk.add(old_concept_id, new_concept_id)
+
+    def stage_mappings(self, cursor, mappings):
+        """
+        Loads the mappings into the ocl_stg_mapping table. Reference sources and map types are
+        created as they are found, and the uuids of the rows that may be created are generated here.
+        """
+        rows = []
+        for seq, ref_map in enumerate(mappings):
+            if ref_map.kind is None:
+                continue
+            if ref_map.from_concept_id is None or (ref_map.kind == MappingRecord.INTERNAL and ref_map.to_concept_id is None):
+                print 'Invalid concept URL in mapping "%s"' % ref_map.external_id
+                continue
+            if ref_map.kind == MappingRecord.INTERNAL:
+                if ref_map.map_type == OclOpenmrsHelper.MAP_TYPE_Q_AND_A:
+                    kind = 'answer'
+                elif ref_map.map_type == OclOpenmrsHelper.MAP_TYPE_CONCEPT_SET:
+                    kind = 'set'
+                else:
+                    print 'Unexpected map type "%s"' % ref_map.map_type
+                    continue
+                to_ocl, term_source, code = ref_map.to_concept_id, ref_map.to_source, ref_map.from_concept_id
+                map_type = self.get_map_type('SAME-AS')
+                ciel_source = None
+                if OclOpenmrsHelper.get_omrs_source_id_from_ocl_id(term_source) is None:
+                    print 'Missing source in ciel mapping "%s"' % term_source
+            else:
+                kind, to_ocl, code = 'external', None, ref_map.to_concept_code
+                term_source = ref_map.to_source
+                map_type = self.get_map_type(ref_map.map_type)
+                ciel_source = OclOpenmrsHelper.get_omrs_source_id_from_ocl_id(ref_map.from_source)
+                if ciel_source is not None:
+                    ciel_source = self.get_reference_source(ciel_source).concept_source_id
+                else:
+                    print 'Missing source in ciel mapping "%s"' % ref_map.from_source
+            source = OclOpenmrsHelper.get_omrs_source_id_from_ocl_id(term_source)
+            if source is not None:
+                source = self.get_reference_source(source).concept_source_id
+            elif kind == 'external':
+                print 'Missing source in external mapping "%s"' % term_source
+                continue
+            rows.append((seq, kind, ref_map.external_id, ref_map.from_concept_id, to_ocl, source, unicode(code),
+                         map_type.concept_map_type_id, ciel_source, unicode(ref_map.from_concept_id), str(uuid.uuid1()),
+                         str(uuid.uuid1()), str(uuid.uuid1()), 0))
+            if len(rows) >= self.batch_size:
+                self.flush_staged_mappings(cursor, rows)
+        self.flush_staged_mappings(cursor, rows)
+
+    def flush_staged_mappings(self, cursor, rows):
+        self.bulk_insert(cursor, 'ocl_stg_mapping', (
+            'seq', 'kind', 'uuid', 'from_ocl', 'to_ocl', 'source_id', 'code', 'map_type_id', 'ciel_source_id',
+            'ciel_code', 'ciel_uuid', 'term_uuid', 'ciel_term_uuid', 'creates_term'), rows)
+
+    def merge_mappings(self, cursor):
+        """
+        Inserts the missing answers, set members, reference terms and reference maps. As in
+        create_external_mapping, an external mapping only adds reference maps if it is the first
+        mapping to a term that did not exist yet. Answers and set members get a SAME-AS map to
+        the CIEL term of the question or set, and the concept of an external mapping a map to its
+        own CIEL term.
+        """
+        with self.stats.phase('internal mappings'):
+            for kind, label in (('answer', 'Q-AND-A'), ('set', 'concept set')):
+                cursor.execute('SELECT m.uuid FROM ocl_stg_mapping m WHERE m.kind = %s '
+                               'AND (NOT EXISTS (SELECT 1 FROM ocl_stg_crosswalk x WHERE x.ocl_id = m.from_ocl) '
+                               'OR NOT EXISTS (SELECT 1 FROM ocl_stg_crosswalk x WHERE x.ocl_id = m.to_ocl)) '
+                               'ORDER BY m.seq', [kind])
+                for row in cursor.fetchall():
+                    print 'Missing concept in %s mapping "%s"' % (label, row[0])
+            internal_from_sql = ('FROM ocl_stg_mapping m JOIN ocl_stg_crosswalk f ON f.ocl_id = m.from_ocl '
+                                 'JOIN ocl_stg_crosswalk t ON t.ocl_id = m.to_ocl WHERE m.kind = %s')
+            self.insert_select(cursor, ConceptAnswer, {
+                'question_concept_id': 'f.concept_id', 'answer_concept_id': 't.concept_id', 'uuid': 'm.uuid',
+            }, internal_from_sql + ' AND NOT EXISTS (SELECT 1 FROM concept_answer k WHERE k.uuid = m.uuid) '
+               'AND NOT EXISTS (SELECT 1 FROM ocl_stg_mapping e WHERE e.uuid = m.uuid AND e.seq < m.seq) '
+               'ORDER BY m.seq', ['answer'])
+            self.insert_select(cursor, ConceptSet, {
+                'concept_set_owner_id': 'f.concept_id', 'concept_id': 't.concept_id', 'uuid': 'm.uuid',
+            }, internal_from_sql + ' AND NOT EXISTS (SELECT 1 FROM concept_set k WHERE k.uuid = m.uuid) '
+               'AND NOT EXISTS (SELECT 1 FROM ocl_stg_mapping e WHERE e.uuid = m.uuid AND e.seq < m.seq) '
+               'ORDER BY m.seq', ['set'])
+
+        with self.stats.phase('external mappings'):
+            # The first external mapping to each term that does not exist yet creates it
+            cursor.execute('DELETE FROM ocl_stg_first')
+            cursor.execute('INSERT INTO ocl_stg_first (seq) SELECT MIN(m.seq) FROM ocl_stg_mapping m '
+                           'WHERE m.kind = %s AND NOT EXISTS (SELECT 1 FROM concept_reference_term t '
+                           'WHERE t.concept_source_id = m.source_id AND t.code = m.code) '
+                           'GROUP BY m.source_id, m.code', ['external'])
+            cursor.execute('UPDATE ocl_stg_mapping SET creates_term = 1 WHERE seq IN (SELECT seq FROM ocl_stg_first)')
+
+            # Terms: those of external mappings, and the CIEL terms of the maps added below
+            cursor.execute('INSERT INTO ocl_stg_term (seq, source_id, code, uuid) '
+                           'SELECT 3 * m.seq, m.source_id, m.code, m.term_uuid FROM ocl_stg_mapping m WHERE m.kind = %s',
+                           ['external'])
+            cursor.execute('INSERT INTO ocl_stg_term (seq, source_id, code, uuid) '
+                           'SELECT 3 * m.seq + 1, m.ciel_source_id, m.ciel_code, m.ciel_term_uuid '
+                           'FROM ocl_stg_mapping m JOIN ocl_stg_crosswalk f ON f.ocl_id = m.from_ocl '
+                           'WHERE m.creates_term = 1 AND m.ciel_source_id IS NOT NULL')
+            cursor.execute('INSERT INTO ocl_stg_term (seq, source_id, code, uuid) '
+                           'SELECT 3 * m.seq + 2, m.source_id, m.code, m.ciel_term_uuid FROM ocl_stg_mapping m '
+                           'WHERE m.kind <> %s AND m.source_id IS NOT NULL '
+                           'AND EXISTS (SELECT 1 FROM ocl_stg_crosswalk f WHERE f.ocl_id = m.from_ocl) '
+                           'AND EXISTS (SELECT 1 FROM ocl_stg_crosswalk t WHERE t.ocl_id = m.to_ocl)', ['external'])
+            self.insert_select(cursor, ConceptReferenceTerm, {
+                'concept_source_id': 't.source_id', 'code': 't.code', 'uuid': 't.uuid', 'retired': '0',
+            }, 'FROM ocl_stg_term t WHERE t.seq IN (SELECT MIN(e.seq) FROM ocl_stg_term e GROUP BY e.source_id, e.code) '
+               'AND NOT EXISTS (SELECT 1 FROM concept_reference_term k '
+               'WHERE k.concept_source_id = t.source_id AND k.code = t.code) ORDER BY t.seq')
+
+        with self.stats.phase('reference maps'):
+            # Reference maps, in the order sync_mapping would add them
+            cursor.execute('INSERT INTO ocl_stg_refmap (seq, concept_id, source_id, code, map_type_id, uuid) '
+                           'SELECT 3 * m.seq, f.concept_id, m.source_id, m.code, m.map_type_id, m.uuid '
+                           'FROM ocl_stg_mapping m JOIN ocl_stg_crosswalk f ON f.ocl_id = m.from_ocl '
+                           'WHERE m.creates_term = 1')
+            cursor.execute('INSERT INTO ocl_stg_refmap (seq, concept_id, source_id, code, map_type_id, uuid) '
+                           'SELECT 3 * m.seq + 1, f.concept_id, m.ciel_source_id, m.ciel_code, m.map_type_id, m.ciel_uuid '
+                           'FROM ocl_stg_mapping m JOIN ocl_stg_crosswalk f ON f.ocl_id = m.from_ocl '
+                           'WHERE m.creates_term = 1 AND m.ciel_source_id IS NOT NULL')
+            cursor.execute('INSERT INTO ocl_stg_refmap (seq, concept_id, source_id, code, map_type_id, uuid) '
+                           'SELECT 3 * m.seq + 2, CASE WHEN m.kind = %s THEN t.concept_id ELSE f.concept_id END, '
+                           'm.source_id, m.code, m.map_type_id, m.uuid '
+                           'FROM ocl_stg_mapping m JOIN ocl_stg_crosswalk f ON f.ocl_id = m.from_ocl '
+                           'JOIN ocl_stg_crosswalk t ON t.ocl_id = m.to_ocl '
+                           'WHERE m.kind <> %s AND m.source_id IS NOT NULL', ['answer', 'external'])
+            refmap_term_sql = ('JOIN concept_reference_term t '
+                               'ON t.concept_source_id = {0}.source_id AND t.code = {0}.code')
+            self.insert_select(cursor, ConceptReferenceMap, {
+                'concept_id': 'r.concept_id', 'concept_reference_term_id': 't.concept_reference_term_id',
+                'map_type_id': 'r.map_type_id', 'uuid': 'r.uuid',
+            }, 'FROM ocl_stg_refmap r ' + refmap_term_sql.format('r') + ' '
+               'WHERE r.seq IN (SELECT MIN(e.seq) FROM ocl_stg_refmap e '
+               'GROUP BY e.concept_id, e.source_id, e.code, e.map_type_id) '
+               'AND NOT EXISTS (SELECT 1 FROM concept_reference_map k WHERE k.concept_id = r.concept_id '
+               'AND k.concept_reference_term_id = t.concept_reference_term_id '
+               'AND k.concept_map_type_id = r.map_type_id) '
+               'AND NOT EXISTS (SELECT 1 FROM concept_reference_map k WHERE k.uuid = r.uuid) '
+               'AND NOT EXISTS (SELECT 1 FROM ocl_stg_refmap e WHERE e.uuid = r.uuid AND e.seq < r.seq) '
+               'ORDER BY r.seq')
+
+    ## BULK RETIREMENT
+
+    def retire_concepts(self):
+        """
+        Retires the concepts listed in the retired file, one source concept ID per line as written
+        by 'extract_db --retired'. The file is streamed, the IDs are translated with the crosswalk,
+        and concepts are retired with one UPDATE ... WHERE concept_id IN (...) per batch.
+        """
+        with self.stats.phase('retirement'):
+            batch = []
+            for old_concept_id in self.read_json_lines(self.retired_filename):
+                new_concept_id = self.crosswalk.get_new_id(old_concept_id)
+                if new_concept_id is None:
+                    self.cnt_retired_not_found += 1
+                    if self.verbosity >= 2:
+                        print 'Retired concept "%s" is not in the crosswalk' % old_concept_id
+                    continue
+                batch.append(new_concept_id)
+                if len(batch) >= self.RETIRE_BATCH_SIZE:
+                    self.retire_batch(batch)
+                    batch = []
+            if batch:
+                self.retire_batch(batch)
+
+    def retire_batch(self, concept_ids):
+        """
+        Retires the concepts of a batch that are not retired yet. In a dry run they are written
+        to the plan instead, to be retired when the plan is applied. Concepts created by the same
+        dry run only have a synthetic (negative) ID and are not in the database yet, so they are
+        written to the plan as they are.
+        """
+        concept_ids = set(concept_ids)
+        concepts = Concept.objects.using(self.database).filter(
+            concept_id__in=[concept_id for concept_id in concept_ids if concept_id > 0], retired=False)
+        if self.plan_filename:
+            planned_ids = sorted(concepts.values_list('concept_id', flat=True))
+            planned_ids += sorted(concept_id for concept_id in concept_ids if concept_id < 0)
+            if planned_ids:
+                self.writer.write_record({'retire': planned_ids})
+            cnt_retired = len(planned_ids)
+        else:
+            cnt_retired = concepts.update(retired=True, retired_by=1, date_retired=timezone.now(),
+                                          retire_reason=self.RETIRE_REASON)
+        self.cnt_concepts_retired += cnt_retired
+        self.cnt_concepts_already_retired += len(concept_ids) - cnt_retired
+        self.stats.insert(cnt_retired)
+        self.stats.skip(len(concept_ids) - cnt_retired)
+
+    ## PLANS
+
+    def get_db_fingerprint(self):
+        """ Returns counts that change whenever the dictionary tables a plan is based on change """
+        return {
+            'max_concept_id': Concept.objects.using(self.database).aggregate(Max('concept_id'))['concept_id__max'],
+            'concept_names': ConceptName.objects.using(self.database).count(),
+            'reference_terms': ConceptReferenceTerm.objects.using(self.database).count(),
+            'reference_maps': ConceptReferenceMap.objects.using(self.database).count(),
+            'answers': ConceptAnswer.objects.using(self.database).count(),
+            'set_members': ConceptSet.objects.using(self.database).count(),
+        }
+
+    def apply_plan(self):
+        """ Inserts the rows of a plan file, replacing synthetic IDs with the generated ones """
+        records = self.read_json_lines(self.apply_plan_filename)
+        header = next(records, {})
+        if 'plan' not in header:
+            raise CommandError('"%s" is not a plan file' % self.apply_plan_filename)
+        if header['plan'] != self.get_db_fingerprint():
+            raise CommandError('The database has changed since the plan was made, create a new plan')
+        self.planned_rows = {}
+        self.process_in_transactions(records, self.apply_plan_record, 'Plan records', lambda record: record.get('id'))
+        if self.crosswalk_filename:
+            self.crosswalk.save(self.crosswalk_filename)
+
+    def apply_plan_record(self, record):
+        """ Inserts (or queues) the row of one plan record """
+        if 'retire' in record:
+            # Concepts created by the plan get their IDs when the pending rows are written
+            self.writer.flush()
+            self.retire_batch([self.planned_rows[concept_id].concept_id if concept_id < 0 else concept_id
+                               for concept_id in record['retire']])
+            return
+        if 'crosswalk' in record:
+            old_concept_id, new_concept_id = record['crosswalk']
+            if new_concept_id < 0:
+                self.writer.add_callback(self.planned_rows[new_concept_id],
+                                         lambda obj: self.crosswalk.add(old_concept_id, obj.concept_id))
+            else:
+                self.crosswalk.add(old_concept_id, new_concept_id)
+            return
+        obj, references = PlanWriter.make_row(record)
+        self.planned_rows[record['id']] = obj
+        for fk_attname, synthetic_id in references:
+            self.writer.add_dependency(obj, self.planned_rows[synthetic_id], fk_attname)
+        if record.get('saved'):
+            self.writer.save(obj)
+        else:
+            self.writer.add(obj)
 
-        self.sync_mapping(concepts, mappings)
+    def read_json_lines(self, filename, skip=0, record_type=None):
+        """
+        Yields the records of a JSON-lines export file one at a time, after the first 'skip'.
+        If record_type is given (ConceptRecord or MappingRecord), records are converted to it.
+        """
+        if filename in self.parsed_files:
+            for record in self.parsed_files[filename][skip:]:
+                yield record
+            return
+        with open(filename, 'r') as input_file:
+            for line in input_file:
+                if line.strip():
+                    if skip:
+                        skip -= 1
+                        continue
+                    record = json.loads(line)
+                    yield record_type(record) if record_type else record
+
+    def count_json_lines(self, filename):
+        """ Returns the number of records in a JSON-lines export file, without parsing them """
+        if filename in self.parsed_files:
+            return len(self.parsed_files[filename])
+        with open(filename, 'r') as input_file:
+            return sum(1 for line in input_file if line.strip())
+
+    def process_in_transactions(self, records, process_record, phase, describe_record, cnt_done=0, prefetch=None):
+        """
+        Calls process_record for each record and writes the queued rows.
+
+        If 'commit_every' is set, each group of that many records is written in one
+        transaction. A group that fails is rolled back, together with its crosswalk entries
+        and queued rows, and reported with the first and last record it covered. After each
+        group a checkpoint is saved, counting from cnt_done records already done.
+
+        prefetch is called with each group (or chunk of 'batch_size' records) before it is
+        processed, to load which of its rows already exist.
+        """
+        if not self.commit_every:
+            chunk = []
+            for record in records:
+                chunk.append(record)
+                if len(chunk) >= self.batch_size:
+                    self.process_chunk(chunk, process_record, prefetch)
+                    chunk = []
+            self.process_chunk(chunk, process_record, prefetch)
+            self.writer.flush()
+            return
+
+        batch = []
+        for record in records:
+            batch.append(record)
+            if len(batch) >= self.commit_every:
+                self.commit_batch(batch, process_record, phase, describe_record, prefetch)
+                cnt_done += len(batch)
+                self.save_checkpoint(phase, cnt_done)
+                batch = []
+        if batch:
+            self.commit_batch(batch, process_record, phase, describe_record, prefetch)
+            cnt_done += len(batch)
+            self.save_checkpoint(phase, cnt_done)
+
+    def process_chunk(self, chunk, process_record, prefetch):
+        """ Processes a chunk of records outside of an explicit transaction """
+        if prefetch:
+            # Rows queued for earlier chunks must be in the database to be found
+            self.writer.flush()
+            prefetch(chunk)
+        for record in chunk:
+            process_record(record)
+
+    def commit_batch(self, batch, process_record, phase, describe_record, prefetch=None):
+        """ Processes a group of records in one transaction, retrying it after lock errors """
+        for attempt in range(self.LOCK_RETRIES + 1):
+            for index in self.get_journaled_indexes():
+                index.begin()
+            try:
+                with self.group_lock(), transaction.atomic(using=self.database):
+                    if prefetch:
+                        prefetch(batch)
+                    for record in batch:
+                        process_record(record)
+                    self.writer.flush()
+            except Exception as e:
+                self.writer.discard()
+                for index in self.get_journaled_indexes():
+                    index.rollback()
+                if attempt < self.LOCK_RETRIES and self.is_lock_error(e):
+                    time.sleep(random.uniform(0.1, 0.5) * (attempt + 1))
+                    continue
+                first, last = describe_record(batch[0]), describe_record(batch[-1])
+                self.failed_batches.append((phase, first, last, str(e)))
+                print 'ERROR: %s %s to %s rolled back: %s' % (phase, first, last, e)
+            else:
+                for index in self.get_journaled_indexes():
+                    index.commit()
+            return
+
+    @contextmanager
+    def group_lock(self):
+        """ Holds the write lock shared by the workers, if any, while a group is written """
+        if self.write_lock is None:
+            yield
+            return
+        with self.write_lock:
+            yield
+
+    def is_lock_error(self, e):
+        """ Returns True for errors after which the transaction can simply be retried """
+        message = str(e).lower()
+        return isinstance(e, OperationalError) and ('deadlock' in message or 'lock' in message)
+
+    def get_journaled_indexes(self):
+        """ Returns the in-memory indexes that must follow the database on commit and rollback """
+        return [self.crosswalk, self.concept_names, self.concept_classes, self.datatypes,
+                self.reference_sources, self.map_types, self.reference_terms]
 
     ## CONCEPT and MAPPINGS sync to DB
 
+    def prefetch_concepts(self, concepts):
+        """ Loads which of the concepts, names and descriptions of a chunk already exist, by uuid """
+        with self.stats.phase('concept matching'):
+            self.existing.load(Concept, 'uuid', [concept.external_id for concept in concepts], value_field='concept_id')
+        with self.stats.phase('names'):
+            self.existing.load(ConceptName, 'uuid', [cname.external_id for concept in concepts for cname in concept.names])
+        with self.stats.phase('descriptions'):
+            self.existing.load(ConceptDescription, 'uuid', [cdescription.external_id for concept in concepts
+                                                             for cdescription in concept.descriptions])
+
+    def prefetch_mappings(self, mappings):
+        """
+        Loads which of the answers and set members of a chunk already exist, by uuid, and
+        the reference maps of the concepts the chunk maps from or to
+        """
+        uuids = [ref_map.external_id for ref_map in mappings]
+        with self.stats.phase('internal mappings'):
+            self.existing.load(ConceptAnswer, 'uuid', uuids)
+            self.existing.load(ConceptSet, 'uuid', uuids)
+        concept_ids = set()
+        for ref_map in mappings:
+            concept_ids.add(self.crosswalk.get_new_id(ref_map.from_concept_id))
+            concept_ids.add(self.crosswalk.get_new_id(ref_map.to_concept_id))
+        with self.stats.phase('ciel mappings'):
+            self.existing.load(ConceptReferenceMap, 'concept_id', concept_ids,
+                               key_fields=('concept_id', 'concept_reference_term_id', 'map_type_id'))
+
+    def warn(self, message):
+        """ Prints a problem with an input record, except in the shared rows pass that repeats them """
+        if not self.shared_rows_pass:
+            print message
+
     def sync_concept(self, concept):
         """
         Create one concept and its mappings.
@@ -248,234 +1588,283 @@ class Command(BaseCommand):
         """
 
         # Iterate the concept export counter
+        self.cnt_total_concepts_processed += 1
         self.cnt_concepts_created += 1
 
-        # Concept class, check if it is already created
-        concept_classes = ConceptClass.objects.filter(name=concept['concept_class'])
-        concept_class = None
-        if len(concept_classes) !=0:
-            concept_class = concept_classes[0]
-        else:
-            uuidcc = uuid.uuid1()
-            concept_class = ConceptClass(name=concept['concept_class'], retired=concept['retired'], creator=1, date_created=timezone.now(), uuid=uuidcc)
-            concept_class.save()
+        with self.stats.phase('concept matching'):
+            # Concept class, check if it is already created
+            concept_class = self.get_concept_class(concept.concept_class, concept.retired)
 
-        if concept['concept_class'] in self.cnt_of_classes:
-            self.cnt_of_classes[concept['concept_class']] = self.cnt_of_classes[concept['concept_class']] + 1
-        else:
-            self.cnt_of_classes[concept['concept_class']] = 1
+            if concept.concept_class in self.cnt_of_classes:
+                self.cnt_of_classes[concept.concept_class] = self.cnt_of_classes[concept.concept_class] + 1
+            else:
+                self.cnt_of_classes[concept.concept_class] = 1
             
-        datatypes = ConceptDatatype.objects.filter(name=concept['datatype'])
-        datatype = None
-        if len(datatypes) !=0:
-            datatype = datatypes[0]
-        else:
-            datatype = ConceptDatatype(name=concept['datatype'], creator=1, date_created=timezone.now())
-            datatype.save()
-
-        # Concept Name, check if it is already there
-        cnames = concept['names']
-        cconcept = None
-        concept['is_set'] = 0
-        if 'is_set' in concept['extras']:
-            concept['is_set'] = concept['extras']['is_set']
-        cconcept = None
-        backup_cnames = []
-        for cname in cnames:
-            concept_names = ConceptName.objects.filter(name=cname['name'], locale=cname['locale']) #, locale_preferred=cname['locale_preferred'])
-            if len(concept_names) != 0:
-                cconceptname = concept_names[0]
-                cconcept = Concept.objects.get(concept_id=cconceptname.concept_id)
-                if cconcept is None:
-                    print "Should not be here!!"
+            datatype = self.get_datatype(concept.datatype)
+
+            # Concept Name, check if it is already there
+            cnames = concept.names
+            cconcept = None
+
+            # A concept is matched by its uuid first, then by its names. Only the ID of the
+            # matched concept is needed, so it is not fetched.
+            cconcept = None
+            existing_concept_id = self.existing.get(Concept, concept.external_id)
+            if existing_concept_id is not None:
+                cconcept = Concept(concept_id=existing_concept_id)
+            backup_cnames = []
+            for cname in cnames:
+                # Names queued in the current batch are not in the database (or the index) yet
+                name_key = ConceptNameIndex.make_key(cname.name, cname.locale)
+                pending_name = self.writer.get_pending(ConceptName, name_key)
+                if pending_name is not None:
+                    if existing_concept_id is None:
+                        cconcept = pending_name.concept
+                    continue
+                matching_concept_id = self.concept_names.get(cname.name, cname.locale)
+                if matching_concept_id is not None:
+                    if existing_concept_id is None:
+                        cconcept = Concept(concept_id=matching_concept_id)
+                elif not self.existing.get(ConceptName, cname.external_id):
+                    backup_cnames.append(cname)
+            if cconcept is not None:
+                self.cnt_concepts_matched += 1
+        with self.stats.phase('concept insert'):
+            if cconcept is None and backup_cnames:
+                cconcept = Concept(concept_class=concept_class,datatype=datatype,is_set=concept.is_set,uuid=concept.external_id,retired=concept.retired,creator=1,date_created=timezone.now(), description=concept.description)
+                self.writer.add(cconcept)
             else:
-                backup_cnames.append(cname)
-        for cname in backup_cnames:
-            if cconcept is None:
-                desc = None
-                if 'description' in concept:
-                    desc = concept['description']
-                cconcept = Concept(concept_class=concept_class,datatype=datatype,is_set=concept['is_set'],uuid=concept['external_id'],retired=concept['retired'],creator=1,date_created=timezone.now(), description=desc)
-                cconcept.save()
-            cconceptname = ConceptName(concept=cconcept, name=cname['name'], uuid=cname['external_id'], concept_name_type=cname['name_type'], locale=cname['locale'], locale_preferred=cname['locale_preferred'], creator=1, voided=0, date_created=timezone.now())
-            cconceptname.save()
-            # save the new id
-        concept['new_id'] = cconcept.concept_id
+                self.stats.skip()
+        with self.stats.phase('names'):
+            self.stats.skip(len(cnames) - len(backup_cnames))
+            for cname in backup_cnames:
+                cconceptname = ConceptName(concept=cconcept, name=cname.name, uuid=cname.external_id, concept_name_type=cname.name_type, locale=cname.locale, locale_preferred=cname.locale_preferred, creator=1, voided=0, date_created=timezone.now())
+                self.writer.add(cconceptname, key=ConceptNameIndex.make_key(cname.name, cname.locale), depends_on=cconcept, fk_attname='concept_id')
+                self.existing.add(ConceptName, True, cname.external_id)
+        if cconcept is None:
+            print 'Concept "%s" has no names, skipping' % concept.id
+            return
+
+        # Save the new id and index the new names, once the concept has been inserted if it is new
+        old_concept_id = concept.id
+        self.writer.add_callback(cconcept, lambda obj: self.register_concept(old_concept_id, obj.concept_id, backup_cnames))
 
         # Concept Descriptions
         
-        for cdescription in concept['descriptions']:
-            concept_description = ConceptDescription.objects.filter(concept_id=cconcept.concept_id, description=cdescription['description'])
-            if len(concept_description) == 0:
-                concept_description = ConceptDescription(concept_id=cconcept.concept_id, description=cdescription['description'], uuid=cdescription['external_id'], locale=cdescription['locale'], creator=1, date_created=timezone.now())
-                concept_description.save()
-
-        extra = None
-        if concept['datatype'] == "Numeric":
-            extra = concept['extras']
-        # If the concept is of numeric type, map concept's numeric type data as extras
-        if extra is not None:
-            numeric = ConceptNumeric(concept_id=cconcept.concept_id)
-            if numeric is None:
-                numeric = ConceptNumeric(concept_id=cconcept['concept_id'], hi_absolute = extra['hi_absolute'], hi_critical=extra['hi_critical'], hi_normal=extra['hi_normal'], low_absolute=extra['low_absolute'], low_normal=extra['low_normal'], units =extra['units'],precise=extra['precise'],display_precision=extra['display_precision'], creator=1, date_created=timezone.now())
-                numeric.save()
-
-                
-        # for the Mappings
-    def sync_mapping(self, concepts, mappings):
-        
-        for ref_map in mappings:
-            if 'to_concept_url' in ref_map:
-                self.create_internal_mapping(concepts, map_type=ref_map['map_type'],
-                    from_concept_url=ref_map['from_concept_url'],
-                    to_concept_url=ref_map['to_concept_url'],
-                    external_id=ref_map['external_id'])
-            if 'to_source_url' in ref_map:
-                self.create_external_mapping(concepts, map_type=ref_map['map_type'],from_concept_url=ref_map['from_concept_url'],to_source_url=ref_map['to_source_url'],
-                    to_concept_code=ref_map['to_concept_code'],
-                    external_id=ref_map['external_id'])
+        with self.stats.phase('descriptions'):
+            for cdescription in concept.descriptions:
+                if self.existing.get(ConceptDescription, cdescription.external_id):
+                    self.stats.skip()
+                    continue
+                concept_description = ConceptDescription(concept=cconcept, description=cdescription.description, uuid=cdescription.external_id, locale=cdescription.locale, creator=1, date_created=timezone.now())
+                self.writer.add(concept_description, depends_on=cconcept, fk_attname='concept_id')
+                self.existing.add(ConceptDescription, True, cdescription.external_id)
+
+    def register_concept(self, old_concept_id, new_concept_id, new_cnames):
+        """ Adds a synced concept to the crosswalk and its newly inserted names to the name index """
+        self.crosswalk.add(old_concept_id, new_concept_id)
+        if self.plan_filename:
+            self.writer.write_record({'crosswalk': [old_concept_id, new_concept_id]})
+        for cname in new_cnames:
+            self.concept_names.add(new_concept_id, cname.name, cname.locale)
 
-            
+        # for the Mappings
+    def sync_mapping(self, ref_map):
+        """ Create one internal or external mapping """
+        if ref_map.kind == MappingRecord.INTERNAL:
+            with self.stats.phase('internal mappings'):
+                self.create_internal_mapping(ref_map)
+        elif ref_map.kind == MappingRecord.EXTERNAL:
+            with self.stats.phase('external mappings'):
+                self.create_external_mapping(ref_map)
         return
 
-    def create_internal_mapping(self, concepts, map_type, from_concept_url,
-                                  to_concept_url, external_id,
-                                  retired=False):
-        """ Generate OCL-formatted dictionary for an internal mapping based on passed params. """
-        to_source=None
-        from_source=None
+    def create_internal_mapping(self, ref_map):
+        """ Creates the answer or set member of an internal mapping, and the map to its CIEL term """
+        map_type = ref_map.map_type
+        external_id = ref_map.external_id
+        to_source = ref_map.to_source
         ciel_id = None
         iad_id = None
         if map_type == OclOpenmrsHelper.MAP_TYPE_Q_AND_A:
-            s1 = from_concept_url.split("/")
-            concept_id=s1[6]
-            from_source=s1[4]
-            new_concept_id = ConceptHelper.get_new_id(concepts, int(concept_id))
-            s2 = to_concept_url.split("/")
-            answer_concept=s2[6]
-            to_source=s2[4]
-            new_answer_concept = ConceptHelper.get_new_id(concepts, int(answer_concept))
-            canswers = ConceptAnswer.objects.filter(question_concept_id=new_concept_id, answer_concept_id=new_answer_concept, uuid=external_id)
+            concept_id = ref_map.from_concept_id
+            new_concept_id = self.crosswalk.get_new_id(concept_id)
+            new_answer_concept = self.crosswalk.get_new_id(ref_map.to_concept_id)
+            if new_concept_id is None or new_answer_concept is None:
+                self.warn('Missing concept in Q-AND-A mapping "%s"' % external_id)
+                return
             ciel_id = concept_id
             iad_id = new_answer_concept
-            if len(canswers) != 0:
-                canswer = canswers[0]
-            else:
+            if not self.shared_rows_pass and not self.existing.get(ConceptAnswer, external_id):
                 canswer = ConceptAnswer(question_concept_id=new_concept_id, answer_concept_id=new_answer_concept, uuid=external_id, creator=1, date_created=timezone.now())
-                canswer.save()
+                self.writer.add(canswer)
+                self.existing.add(ConceptAnswer, True, external_id)
+            elif not self.shared_rows_pass:
+                self.stats.skip()
             self.create_ciel_mapping(to_source, ciel_id, "SAME-AS", iad_id, external_id)
         elif map_type == OclOpenmrsHelper.MAP_TYPE_CONCEPT_SET:
-            s1 = from_concept_url.split("/")
-            concept_set_id=s1[6]
-            from_source=s1[4]
-            new_concept_set_id = ConceptHelper.get_new_id(concepts, int(concept_set_id))
-            s2 = to_concept_url.split("/")
-            concept_id=s2[6]
-            to_source=s2[4]
-            new_concept_id = ConceptHelper.get_new_id(concepts, int(concept_id))
-
-            csets = ConceptSet.objects.filter(concept_id=new_concept_id,  uuid=external_id) #concept_set_owner_id=new_concept_set_id)
-            if len(csets) != 0:
-                cset = csets[0]
-            else:
+            concept_set_id = ref_map.from_concept_id
+            new_concept_set_id = self.crosswalk.get_new_id(concept_set_id)
+            new_concept_id = self.crosswalk.get_new_id(ref_map.to_concept_id)
+            if new_concept_set_id is None or new_concept_id is None:
+                self.warn('Missing concept in concept set mapping "%s"' % external_id)
+                return
+
+            if not self.shared_rows_pass and not self.existing.get(ConceptSet, external_id):
                 cset = ConceptSet(concept_id=new_concept_id,  concept_set_owner_id=new_concept_set_id, uuid=external_id, creator=1, date_created=timezone.now())
-                cset.save()
+                self.writer.add(cset)
+                self.existing.add(ConceptSet, True, external_id)
+            elif not self.shared_rows_pass:
+                self.stats.skip()
             ciel_id = concept_set_id
             iad_id = new_concept_set_id
             self.create_ciel_mapping(to_source, ciel_id, "SAME-AS", iad_id, external_id)
         else:
-            print 'Unexpected map type "%s"' % (map_type)
+            self.warn('Unexpected map type "%s"' % (map_type))
 
   
         return
 
-    def create_external_mapping(self, concepts, map_type, from_concept_url,
-                                  to_source_url,
-                                  to_concept_code,
-                                  external_id, retired=False):
-        """ Generate OCL-formatted dictionary for an external mapping based on passed params. """
-        ss = to_source_url.split("/")
-        source_name = ss[4]
+    def create_external_mapping(self, ref_map):
+        """ Creates the reference term and map of an external mapping, and the map to its CIEL term """
+        map_type = ref_map.map_type
+        external_id = ref_map.external_id
+        source_name = ref_map.to_source
         source_id = OclOpenmrsHelper.get_omrs_source_id_from_ocl_id(source_name)
         if source_id is None:
-                print 'Missing source in external mapping "%s"' % source_name
+                self.warn('Missing source in external mapping "%s"' % source_name)
         else:
-            cc = from_concept_url.split("/")
-            concept_id = cc[6]
+            concept_id = ref_map.from_concept_id
 #            if self.verbosity >= 1:
 #                print 'Checking source "%s" at uuid "%s"' % (source_id, external_id)
-            creference_sources = ConceptReferenceSource.objects.filter(name=source_id)
-            if len(creference_sources) != 0:
-                creference_source = creference_sources[0]
-            else:
-                creference_source = ConceptReferenceSource(name=source_id, hl7_code=None, creator=1, retired=False,uuid=uuid.uuid1(), date_created=timezone.now())
-                creference_source.save()
-            
-            creference_map_types = ConceptMapType.objects.filter(name=map_type)
-            if len(creference_map_types) != 0:
-                creference_map_type = creference_map_types[0]
-            else:
-                creference_map_type = ConceptMapType(name=map_type, creator=1, uuid=uuid.uuid1(), date_created=timezone.now())
-                creference_map_type.save()
-
-            creference_terms = ConceptReferenceTerm.objects.filter(code=to_concept_code, concept_source=creference_source)
-            if len(creference_terms) != 0:
-#                creference_term = creference_terms[0]
+            creference_source = self.get_reference_source(source_id)
+            creference_map_type = self.get_map_type(map_type)
+
+            creference_term, term_key, created = self.get_reference_term(ref_map.to_concept_code, creference_source)
+            # In a parallel sync the terms are created ahead of the workers
+            if created and self.shared_rows_pass:
+                self.term_creating_mappings.add(external_id)
+            elif external_id in self.term_creating_mappings:
+                created = True
+            if not created:
 #       Nothing to be done, the mapping must also exist, just return                
+                if not self.shared_rows_pass:
+                    self.stats.skip()
                 return
-            else:
-                creference_term = ConceptReferenceTerm(code=to_concept_code, concept_source=creference_source, creator=1, retired=False, uuid=uuid.uuid1(), date_created=timezone.now())
-                creference_term.save()
 
-            new_concept_id = ConceptHelper.get_new_id(concepts, int(concept_id))
+            new_concept_id = self.crosswalk.get_new_id(concept_id)
             if new_concept_id != None:
-                creference_maps = ConceptReferenceMap.objects.filter(concept_id=new_concept_id, concept_reference_term=creference_term, map_type_id=creference_map_type.concept_map_type_id)
-                if len(creference_maps) != 0:
-                    creference_map = creference_maps[0]
-                else:
-                    creference_map = ConceptReferenceMap(concept_reference_term_id=creference_term.concept_reference_term_id, concept_id=new_concept_id, uuid=external_id, map_type_id=creference_map_type.concept_map_type_id, creator=1, date_created=timezone.now())
-                    creference_map.save()
+                # The term was just created, so it cannot have a reference map yet
+                self.add_reference_map(creference_term, term_key, new_concept_id, creference_map_type, external_id)
 
-                self.create_ciel_mapping(cc[4], int(concept_id), map_type, new_concept_id, uuid.uuid1())
+                self.create_ciel_mapping(ref_map.from_source, concept_id, map_type, new_concept_id, uuid.uuid1())
 
         return
 
     ### create CIEL mapping
 
     def create_ciel_mapping(self, to_source, ciel_id, map_type, iad_id, external_id):
+        with self.stats.phase('ciel mappings'):
+            self.create_ciel_reference_map(to_source, ciel_id, map_type, iad_id, external_id)
 
+    def create_ciel_reference_map(self, to_source, ciel_id, map_type, iad_id, external_id):
+        """ Adds a map from the concept iad_id to its term in the source dictionary, unless it exists """
         source_id = OclOpenmrsHelper.get_omrs_source_id_from_ocl_id(to_source)
         if source_id is None:
-                print 'Missing source in ciel mapping "%s"' % to_source
+                self.warn('Missing source in ciel mapping "%s"' % to_source)
         else:
-            creference_sources = ConceptReferenceSource.objects.filter(name=source_id)
-            if len(creference_sources) != 0:
-                creference_source = creference_sources[0]
-            else:
-                creference_source = ConceptReferenceSource(name=source_id, hl7_code=None, creator=1, retired=False,uuid=uuid.uuid1(), date_created=timezone.now())
-                creference_source.save()
-
-            creference_terms = ConceptReferenceTerm.objects.filter(code=ciel_id, concept_source=creference_source)
-            if len(creference_terms) != 0:
-                creference_term = creference_terms[0]
-            else:
-                creference_term = ConceptReferenceTerm(code=ciel_id, concept_source=creference_source, creator=1, retired=False, uuid=uuid.uuid1(), date_created=timezone.now())
-                creference_term.save()
-            
-            creference_map_types = ConceptMapType.objects.filter(name=map_type)
-            if len(creference_map_types) != 0:
-                creference_map_type = creference_map_types[0]
-            else:
-                creference_map_type = ConceptMapType(name=map_type, creator=1, uuid=uuid.uuid1(), date_created=timezone.now())
-                creference_map_type.save()
+            creference_source = self.get_reference_source(source_id)
+            creference_term, term_key, created = self.get_reference_term(ciel_id, creference_source)
+            creference_map_type = self.get_map_type(map_type)
+            if self.shared_rows_pass:
+                return
 
-            creference_maps = ConceptReferenceMap.objects.filter(concept_id=iad_id, concept_reference_term=creference_term, map_type=creference_map_type)
-            if len(creference_maps) != 0:
-                creference_map = creference_maps[0]
-            else:
-                creference_map = ConceptReferenceMap(concept_reference_term=creference_term, concept_id=iad_id, uuid=external_id, map_type_id=creference_map_type.concept_map_type_id, creator=1, date_created=timezone.now())
-                creference_map.save()
+            map_key = (iad_id, term_key, creference_map_type.concept_map_type_id)
+            if self.writer.get_pending(ConceptReferenceMap, map_key) is not None:
+                self.stats.skip()
+                return
+            if not created and not isinstance(creference_term, ConceptReferenceTerm):
+                if self.existing.get(ConceptReferenceMap, iad_id, creference_term, creference_map_type.concept_map_type_id):
+                    self.stats.skip()
+                    return
+            self.add_reference_map(creference_term, term_key, iad_id, creference_map_type, external_id)
         return
+
+    def add_reference_map(self, creference_term, term_key, concept_id, creference_map_type, external_id):
+        """ Queues a reference map to an existing term ID or to a term queued by get_reference_term() """
+        creference_map = ConceptReferenceMap(concept_id=concept_id, uuid=external_id, map_type_id=creference_map_type.concept_map_type_id, creator=1, date_created=timezone.now())
+        map_key = (concept_id, term_key, creference_map_type.concept_map_type_id)
+        # Once written, the map is no longer pending but must still be found in this chunk. The
+        # callback is registered first because add() may write the map right away.
+        self.writer.add_callback(creference_map, lambda obj: self.existing.add(
+            ConceptReferenceMap, True, obj.concept_id, obj.concept_reference_term_id, obj.map_type_id))
+        if isinstance(creference_term, ConceptReferenceTerm):
+            self.writer.add(creference_map, key=map_key, depends_on=creference_term, fk_attname='concept_reference_term_id')
+        else:
+            creference_map.concept_reference_term_id = creference_term
+            self.writer.add(creference_map, key=map_key)
+
+    ## LOOKUP TABLES
+
+    def load_lookup_caches(self):
+        """ Preloads the lookup tables used by get-or-create of concept and mapping metadata """
+        self.concept_classes = LookupCache(ConceptClass, ('name',), using=self.database)
+        self.datatypes = LookupCache(ConceptDatatype, ('name',), using=self.database)
+        self.reference_sources = LookupCache(ConceptReferenceSource, ('name',), using=self.database)
+        self.map_types = LookupCache(ConceptMapType, ('name',), using=self.database)
+        self.reference_terms = LookupCache(ConceptReferenceTerm, ('code', 'concept_source_id'),
+                                           value_field='concept_reference_term_id', using=self.database)
+
+    def get_concept_class(self, name, retired):
+        concept_class = self.concept_classes.get(name)
+        if concept_class is None:
+            concept_class = ConceptClass(name=name, retired=retired, creator=1, date_created=timezone.now(), uuid=uuid.uuid1())
+            self.writer.save(concept_class)
+            self.concept_classes.add(concept_class, name)
+        return concept_class
+
+    def get_datatype(self, name):
+        datatype = self.datatypes.get(name)
+        if datatype is None:
+            datatype = ConceptDatatype(name=name, retired=0, creator=1, date_created=timezone.now(), uuid=uuid.uuid1())
+            self.writer.save(datatype)
+            self.datatypes.add(datatype, name)
+        return datatype
+
+    def get_reference_source(self, name):
+        creference_source = self.reference_sources.get(name)
+        if creference_source is None:
+            creference_source = ConceptReferenceSource(name=name, hl7_code=None, creator=1, retired=False,uuid=uuid.uuid1(), date_created=timezone.now())
+            self.writer.save(creference_source)
+            self.reference_sources.add(creference_source, name)
+        return creference_source
+
+    def get_map_type(self, name):
+        creference_map_type = self.map_types.get(name)
+        if creference_map_type is None:
+            creference_map_type = ConceptMapType(name=name, retired=0, creator=1, uuid=uuid.uuid1(), date_created=timezone.now())
+            self.writer.save(creference_map_type)
+            self.map_types.add(creference_map_type, name)
+        return creference_map_type
+
+    def get_reference_term(self, code, creference_source):
+        """
+        Returns (term, term_key, created). term is the ID of an existing reference term, or a
+        ConceptReferenceTerm queued for insertion if it was created by this or an earlier
+        call that has not been written yet. created is True only if this call created it.
+        """
+        source_id = creference_source.concept_source_id
+        term_key = LookupCache.make_key((code, source_id))
+        creference_term = self.writer.get_pending(ConceptReferenceTerm, term_key)
+        if creference_term is not None:
+            return creference_term, term_key, False
+        creference_term_id = self.reference_terms.get(code, source_id)
+        if creference_term_id is not None:
+            return creference_term_id, term_key, False
+        creference_term = ConceptReferenceTerm(code=code, concept_source=creference_source, creator=1, retired=False, uuid=uuid.uuid1(), date_created=timezone.now())
+        self.writer.add(creference_term, key=term_key)
+        self.writer.add_callback(creference_term, lambda term: self.reference_terms.add(term.concept_reference_term_id, code, source_id))
+        return creference_term, term_key, True
         
     ### RETIRED CONCEPT EXPORT
 
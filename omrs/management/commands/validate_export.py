@@ -1,14 +1,20 @@
 """
 Command to validate an OCL source version export against an OpenMRS dictionary stored in Mysql.
 
+Use 'database' to read from another database alias than READ_DATABASE of the settings, e.g. a
+read replica. The temporary tables of 'pushdown' are created on that database.
+
 TODO: Implement "deep" comparison for both concepts and mappings -- start with checking only active status
 
 """
 import json
-from django.core.management import BaseCommand
+import os
+import glob
+from django.core.management import BaseCommand, CommandError
+from django.db import connections
 from optparse import make_option
 from omrs.models import (Concept, ConceptReferenceMap, ConceptAnswer, ConceptSet)
-from omrs.management.commands import OclOpenmrsHelper
+from omrs.management.commands import OclOpenmrsHelper, use_read_database
 
 
 class Command(BaseCommand):
@@ -20,19 +26,40 @@ class Command(BaseCommand):
     MISSING_IN_OCL = 1
     MISSING_IN_MYSQL = 2
 
+    # Number of rows sent per multi-row insert when loading OCL keys into staging tables
+    PUSHDOWN_BATCH_SIZE = 1000
+
+    # Temporary tables that hold the keys of the OCL export with 'pushdown'
+    PUSHDOWN_TABLES = ('ocl_concept_key', 'ocl_qanda_key', 'ocl_set_key', 'ocl_refmap_key')
+
     # Command attributes
     help = 'Validate an OCL export against an OpenMRS dictionary stored in Mysql.'
     option_list = BaseCommand.option_list + (
         make_option('--export',
-                    action='store',
-                    dest='ocl_export_filename',
-                    default=None,
-                    help='OCL export filename'),
+                    action='append',
+                    dest='ocl_export_filenames',
+                    default=[],
+                    help='OCL export filename or directory of export files. May be repeated.'),
         make_option('--ignore_retired_mappings',
                     action='store_true',
                     dest='ignore_retired_mappings',
                     default=False,
                     help='Retired mappings in OCL are not included in the comparison if set to True'),
+        make_option('--pushdown',
+                    action='store_true',
+                    dest='pushdown',
+                    default=False,
+                    help='Load OCL keys into temporary tables and let the database compute the differences'),
+        make_option('--reconcile_uuids',
+                    action='store_true',
+                    dest='reconcile_uuids',
+                    default=False,
+                    help='Match mappings on external_id (OpenMRS uuid) first and report drifted endpoints'),
+        make_option('--database',
+                    action='store',
+                    dest='database',
+                    default=None,
+                    help='Alias of the database to read from (default settings.READ_DATABASE, e.g. a replica)'),
     )
 
 
@@ -45,32 +72,145 @@ class Command(BaseCommand):
         """
 
         # Get command line arguments
-        self.ocl_export_filename = options['ocl_export_filename']
+        self.ocl_export_filenames = self.expand_export_filenames(options['ocl_export_filenames'])
         self.ignore_retired_mappings = options['ignore_retired_mappings']
+        self.pushdown = options['pushdown']
+        self.reconcile_uuids = options['reconcile_uuids']
         self.verbosity = int(options['verbosity'])
 
         # Option debug output
         if self.verbosity >= 2:
             print 'COMMAND LINE OPTIONS:\n', options
-
-        # Load the OCL export file into memory
+        if self.pushdown and self.reconcile_uuids:
+            raise CommandError('ERROR: "pushdown" and "reconcile_uuids" cannot be used together')
+        self.database = use_read_database(options['database'])
+
+        # The OpenMRS side is loaded once and reused for every export: the index of its keys, or
+        # with 'pushdown' its row counts and the staging tables that the export keys go into
+        if self.pushdown:
+            cursor = connections[self.database].cursor()
+            self.create_pushdown_tables(cursor)
+            try:
+                omrs_counts = self.count_omrs_rows()
+                for loaded_json in self.load_exports():
+                    self.validate_export_pushdown(cursor, loaded_json, omrs_counts)
+            finally:
+                self.drop_pushdown_tables(cursor)
+        else:
+            omrs_index = self.build_omrs_index()
+            for loaded_json in self.load_exports():
+                self.validate_export(loaded_json, omrs_index)
+
+    def expand_export_filenames(self, filenames):
+        """ Returns the list of export files, expanding directories to the JSON files they contain """
+        if not filenames:
+            raise CommandError('ERROR: at least one "export" option is required')
+        export_filenames = []
+        for filename in filenames:
+            if os.path.isdir(filename):
+                export_filenames += sorted(glob.glob(os.path.join(filename, '*.json')))
+            else:
+                export_filenames.append(filename)
+        return export_filenames
+
+    def load_exports(self):
+        """ Loads each export file in turn, with a header for its report if there are several """
+        for ocl_export_filename in self.ocl_export_filenames:
+            if len(self.ocl_export_filenames) > 1:
+                print '\n======================================================'
+                print 'EXPORT: %s' % ocl_export_filename
+                print '======================================================'
+            yield self.load_export(ocl_export_filename)
+
+    def load_export(self, ocl_export_filename):
+        """ Loads an OCL export file into memory """
         # NOTE: This will only work if it can fit into memory -- explore streaming partial loads
-        export_text = open(self.ocl_export_filename).read()
+        export_text = open(ocl_export_filename).read()
         loaded_json = json.loads(export_text)
         export_text = None
         if 'concepts' not in loaded_json:
             loaded_json['concepts'] = []
         if 'mappings' not in loaded_json:
             loaded_json['mappings'] = []
+        return loaded_json
+
+    def validate_export(self, data, omrs_index):
+        self.validate_concepts(data, omrs_index)
+        self.validate_mappings(data, omrs_index, self.count_index_rows(omrs_index))
 
-        # Validate the concepts and mappings in the file
-        self.validate_export(loaded_json)
 
-    def validate_export(self, data):
-        self.validate_concepts(data)
-        self.validate_mappings(data)
 
-    def validate_concepts(self, data):
+    ## OPENMRS INDEX
+
+    def build_omrs_index(self):
+        """
+        Loads the keys of all concepts, Q-AND-A, concept sets and reference maps from MySQL with
+        one scan per table. Mapping keys are stored as tuples of lowercase unicode values so that
+        they compare directly with the codes in the OCL export, ignoring case as MySQL does.
+
+        If reconciling uuids, the same scans also build a uuid -> (table, id, key) hash of
+        the mapping rows. extract_db exports the reference term uuid as the external_id of
+        internal mappings. A term is shared by every reference map that points to it, so term
+        uuids are indexed separately by (term uuid, from concept ID, map type).
+        """
+        if self.verbosity >= 1:
+            print 'Loading OpenMRS index...'
+        index = {
+            'concepts': set(),
+            'qanda': {},
+            'conceptsets': {},
+            'refmaps': {},
+            'refmap_ids': set(),
+            'uuids': {},
+            'term_uuids': {},
+        }
+        uuids = index['uuids']
+        for concept_id in Concept.objects.values_list('concept_id', flat=True).iterator():
+            index['concepts'].add(str(concept_id))
+        for answer_id, question_id, answer_concept_id, row_uuid in ConceptAnswer.objects.values_list(
+                'concept_answer_id', 'question_concept_id', 'answer_concept_id', 'uuid').iterator():
+            key = index_key(question_id, answer_concept_id)
+            index['qanda'].setdefault(key, []).append(answer_id)
+            if self.reconcile_uuids:
+                uuids[row_uuid] = ('qanda', answer_id, key)
+        for set_id, set_owner_id, set_member_id, row_uuid in ConceptSet.objects.values_list(
+                'concept_set_id', 'concept_set_owner_id', 'concept_id', 'uuid').iterator():
+            key = index_key(set_owner_id, set_member_id)
+            index['conceptsets'].setdefault(key, []).append(set_id)
+            if self.reconcile_uuids:
+                uuids[row_uuid] = ('conceptsets', set_id, key)
+        for map_id, concept_id, code, source_name, map_type, row_uuid, term_uuid in ConceptReferenceMap.objects.values_list(
+                'concept_map_id', 'concept_id', 'concept_reference_term__code',
+                'concept_reference_term__concept_source__name', 'map_type__name',
+                'uuid', 'concept_reference_term__uuid').iterator():
+            key = index_key(concept_id, code, source_name, map_type)
+            index['refmaps'].setdefault(key, []).append(map_id)
+            if source_name != 'CIEL':
+                index['refmap_ids'].add(map_id)
+            if self.reconcile_uuids:
+                uuids[row_uuid] = ('refmaps', map_id, key)
+                index['term_uuids'][index_key(term_uuid, concept_id, map_type)] = ('refmaps', map_id, key)
+        return index
+
+    def count_index_rows(self, omrs_index):
+        """ Returns the number of OpenMRS rows of each kind compared with the export, from the index """
+        return {
+            'concepts': len(omrs_index['concepts']),
+            'refmaps': len(omrs_index['refmap_ids']),
+            'qanda': sum(len(ids) for ids in omrs_index['qanda'].values()),
+            'conceptsets': sum(len(ids) for ids in omrs_index['conceptsets'].values()),
+        }
+
+    def count_omrs_rows(self):
+        """ Returns the number of OpenMRS rows of each kind compared with the export, from the database """
+        return {
+            'concepts': Concept.objects.count(),
+            'refmaps': ConceptReferenceMap.objects.exclude(concept_reference_term__concept_source__name='CIEL').count(),
+            'qanda': ConceptAnswer.objects.count(),
+            'conceptsets': ConceptSet.objects.count(),
+        }
+
+    def validate_concepts(self, data, omrs_index):
 
         # Create an array of concept IDs that are in the mysql db
         print '\nCONCEPT COUNT COMPARISON:'
@@ -78,8 +218,7 @@ class Command(BaseCommand):
             self.MISSING_IN_OCL:{},
             self.MISSING_IN_MYSQL:{},
         }
-        for c_mysql in Concept.objects.raw('SELECT concept_id FROM concept'):
-            id_comparison[self.MISSING_IN_OCL][str(c_mysql.concept_id)] = 0
+        id_comparison[self.MISSING_IN_OCL] = dict.fromkeys(omrs_index['concepts'], 0)
         count_mysql = len(id_comparison[self.MISSING_IN_OCL])
 
         # Perform count comparison
@@ -112,8 +251,16 @@ class Command(BaseCommand):
         print '\n%s concept IDs missing in MySQL:\n' % len(id_comparison[self.MISSING_IN_MYSQL])
         print id_comparison[self.MISSING_IN_MYSQL]
 
-        # For IDs missing in MySQL, check if they are duplicated in the export
-        missing_ids = id_comparison[self.MISSING_IN_MYSQL].copy()
+        self.check_duplicate_ids(data, id_comparison[self.MISSING_IN_MYSQL])
+
+        # Perform deep comparison
+        print '\nSkipping deep comparison of concepts...\n'
+
+        return
+
+    def check_duplicate_ids(self, data, missing_in_mysql):
+        """ For IDs missing in MySQL, checks if they are duplicated in the export """
+        missing_ids = dict.fromkeys(missing_in_mysql, 0)
         if missing_ids:
             for c_ocl in data['concepts']:
                 if c_ocl['id'] in missing_ids:
@@ -128,17 +275,141 @@ class Command(BaseCommand):
             if not num_duplicates:
                 print 'No duplicates found in export file\n'
 
-        # Perform deep comparison
-        print '\nSkipping deep comparison of concepts...\n'
-
-        return
-
-    def validate_mappings(self, data):
+    def validate_mappings(self, data, omrs_index, omrs_counts):
         """
         OpenMRS has 3 different objects that get stored as mappings in OCL: Reference Maps,
         Q-and-A, and Concept Sets. This script iterates through each of these sets of objects
         and compares against the records in OCL.
         """
+        cnt_ocl_total = self.compare_mapping_counts(data, omrs_counts)
+
+        # Create an array of key comparison data from mappings in Mysql
+        # Populate "missing_in_ocl" sets with everything from omrs
+        self.qanda_comparison = {
+            self.MISSING_IN_OCL:set(answer_id for ids in omrs_index['qanda'].values() for answer_id in ids),
+            self.MISSING_IN_MYSQL:[],
+        }
+        self.conceptset_comparison = {
+            self.MISSING_IN_OCL:set(set_id for ids in omrs_index['conceptsets'].values() for set_id in ids),
+            self.MISSING_IN_MYSQL:[],
+        }
+        self.refmap_comparison = {
+            self.MISSING_IN_OCL:set(omrs_index['refmap_ids']),
+            self.MISSING_IN_MYSQL:[],
+        }
+
+        # Mappings matched by uuid, and the subset whose endpoints differ from OpenMRS
+        self.cnt_uuid_matches = 0
+        self.cnt_uuid_fallbacks = 0
+        self.uuid_drift = []
+
+        # Iterate through OCL data and directly compare
+        print '\nVALIDATING MAPPINGS:'
+        cnt = 0
+        for m_ocl in data['mappings']:
+
+            # Skip retired mappings entirely if flag is set
+            if self.ignore_retired_mappings and m_ocl['retired']:
+                continue
+
+            # Display progress info
+            cnt += 1
+            if (cnt % 1000) == 1: print 'Validating %s to %s of %s mappings...' % (cnt, cnt - 1 + 1000, cnt_ocl_total)
+
+            # Determine the type of comparison to perform, compare, and handle results
+            table = self.get_mapping_table(m_ocl)
+            if self.reconcile_uuids and self.reconcile_uuid(m_ocl, table, omrs_index):
+                continue
+            if table == 'qanda':
+                mysql_matching_qanda_id = self.validate_qanda(m_ocl, omrs_index)
+                if mysql_matching_qanda_id:
+                    self.qanda_comparison[self.MISSING_IN_OCL].discard(mysql_matching_qanda_id)
+                else:
+                    self.qanda_comparison[self.MISSING_IN_MYSQL].append(m_ocl['id'])
+                    if self.verbosity >= 2: print 'Missing qanda in MySQL: %s\n' % m_ocl
+            elif table == 'conceptsets':
+                mysql_matching_conceptset_id = self.validate_concept_set(m_ocl, omrs_index)
+                if mysql_matching_conceptset_id:
+                    self.conceptset_comparison[self.MISSING_IN_OCL].discard(mysql_matching_conceptset_id)
+                else:
+                    self.conceptset_comparison[self.MISSING_IN_MYSQL].append(m_ocl['id'])
+                    if self.verbosity >= 2: print 'Missing concept set in MySQL: %s\n' % m_ocl
+            else:
+                mysql_matching_refmap_id = self.validate_reference_map(m_ocl, omrs_index)
+                if mysql_matching_refmap_id:
+                    self.refmap_comparison[self.MISSING_IN_OCL].discard(mysql_matching_refmap_id)
+                else:
+                    self.refmap_comparison[self.MISSING_IN_MYSQL].append(m_ocl['id'])
+                    if self.verbosity >= 2: print 'Missing reference map in MySQL: %s\n' % m_ocl
+
+        # Display results of comparison
+        self.print_mapping_summary()
+        if self.reconcile_uuids:
+            self.print_uuid_summary()
+
+    def get_mapping_table(self, m_ocl):
+        """ Returns the OpenMRS index table ('qanda', 'conceptsets' or 'refmaps') for an OCL mapping """
+        ocl_map_type = str(m_ocl['map_type'])
+        if ocl_map_type == OclOpenmrsHelper.MAP_TYPE_Q_AND_A and m_ocl['to_source_name'] == 'CIEL':
+            return 'qanda'
+        elif ocl_map_type == OclOpenmrsHelper.MAP_TYPE_CONCEPT_SET and m_ocl['to_source_name'] == 'CIEL':
+            return 'conceptsets'
+        return 'refmaps'
+
+    def get_mapping_key(self, m_ocl, table):
+        """ Returns the natural key of an OCL mapping in the form used by the OpenMRS index """
+        if table == 'refmaps':
+            to_source_name = OclOpenmrsHelper.get_omrs_source_id_from_ocl_id(m_ocl['to_source_name'])
+            return index_key(m_ocl['from_concept_code'], m_ocl['to_concept_code'], to_source_name, m_ocl['map_type'])
+        return index_key(m_ocl['from_concept_code'], m_ocl['to_concept_code'])
+
+    def reconcile_uuid(self, m_ocl, table, omrs_index):
+        """
+        Matches an OCL mapping to an OpenMRS row by its external_id. Returns True if the uuid
+        matched, in which case the row is no longer missing in OCL. A match whose table or
+        natural key differs is recorded as drift, and False is returned so that the mapping is
+        still looked up by natural key. A reference term uuid only matches the reference maps
+        of the same from concept and map type.
+        """
+        entry = omrs_index['uuids'].get(m_ocl.get('external_id'))
+        if entry is None and table == 'refmaps':
+            entry = omrs_index['term_uuids'].get(
+                index_key(m_ocl.get('external_id'), m_ocl['from_concept_code'], m_ocl['map_type']))
+        if entry is None:
+            self.cnt_uuid_fallbacks += 1
+            return False
+        omrs_table, omrs_id, omrs_key = entry
+        ocl_key = self.get_mapping_key(m_ocl, table)
+        if omrs_table != table or omrs_key != ocl_key:
+            self.uuid_drift.append({
+                'ocl_id': m_ocl['id'],
+                'external_id': m_ocl['external_id'],
+                'ocl': (table, ocl_key),
+                'mysql': (omrs_table, omrs_id, omrs_key),
+            })
+            if self.verbosity >= 2: print 'Mapping endpoints drifted for uuid %s: %s\n' % (m_ocl['external_id'], m_ocl)
+            return False
+        comparisons = {
+            'qanda': self.qanda_comparison,
+            'conceptsets': self.conceptset_comparison,
+            'refmaps': self.refmap_comparison,
+        }
+        comparisons[omrs_table][self.MISSING_IN_OCL].discard(omrs_id)
+        self.cnt_uuid_matches += 1
+        return True
+
+    def print_uuid_summary(self):
+        """ Outputs the results of the uuid reconciliation """
+        print '\n\nUUID RECONCILIATION SUMMARY:'
+        print '%s mapping(s) matched by uuid' % self.cnt_uuid_matches
+        print '%s mapping(s) without a uuid match compared by natural key' % self.cnt_uuid_fallbacks
+        print '\n%s mapping(s) matched by uuid with drifted endpoints, compared by natural key:\n' % len(self.uuid_drift)
+        if self.verbosity >= 1:
+            for drift in self.uuid_drift:
+                print '%s (%s): OCL %s != MYSQL %s' % (drift['ocl_id'], drift['external_id'], drift['ocl'], drift['mysql'])
+
+    def compare_mapping_counts(self, data, omrs_counts):
+        """ Outputs a count comparison of mappings by type and returns the OCL total """
 
         # Count objects in OCL
         print '\nMAPPING COUNT COMPARISON:'
@@ -159,9 +430,9 @@ class Command(BaseCommand):
         cnt_ocl_total_with_retired = (cnt_ocl_total + cnt_ocl_retired_maps) if self.ignore_retired_mappings else cnt_ocl_total
 
         # Count objects in MySQL
-        cnt_mysql_mapref = ConceptReferenceMap.objects.exclude(concept_reference_term__concept_source__name='CIEL').count()
-        cnt_mysql_qanda = ConceptAnswer.objects.count()
-        cnt_mysql_conceptset = ConceptSet.objects.count()
+        cnt_mysql_mapref = omrs_counts['refmaps']
+        cnt_mysql_qanda = omrs_counts['qanda']
+        cnt_mysql_conceptset = omrs_counts['conceptsets']
         cnt_mysql_total = cnt_mysql_mapref + cnt_mysql_qanda + cnt_mysql_conceptset
 
         # Count comparison
@@ -187,119 +458,223 @@ class Command(BaseCommand):
         else:
             print 'Count comparison of Concept Sets: OCL %s != MYSQL %s' % (cnt_ocl_conceptset, cnt_mysql_conceptset)
 
-        # Create an array of key comparison data from mappings in Mysql
-        self.qanda_comparison = {
-            self.MISSING_IN_OCL:[],
-            self.MISSING_IN_MYSQL:[],
-        }
-        self.conceptset_comparison = {
-            self.MISSING_IN_OCL:[],
-            self.MISSING_IN_MYSQL:[],
-        }
-        self.refmap_comparison = {
-            self.MISSING_IN_OCL:[],
-            self.MISSING_IN_MYSQL:[],
-        }
-
-        # Populate "missing_in_ocl" arrays with everything from omrs
-        for refmap_mysql in ConceptReferenceMap.objects.exclude(concept_reference_term__concept_source__name='CIEL'):
-            self.refmap_comparison[self.MISSING_IN_OCL].append(refmap_mysql.concept_map_id)
-        for qanda_mysql in ConceptAnswer.objects.raw('SELECT concept_answer_id FROM concept_answer'):
-            self.qanda_comparison[self.MISSING_IN_OCL].append(qanda_mysql.concept_answer_id)
-        for conceptset_mysql in ConceptSet.objects.raw('select concept_set_id from concept_set'):
-            self.conceptset_comparison[self.MISSING_IN_OCL].append(conceptset_mysql.concept_set_id)
-
-        # Iterate through OCL data and directly compare
-        print '\nVALIDATING MAPPINGS:'
-        cnt = 0
-        for m_ocl in data['mappings']:
-
-            # Skip retired mappings entirely if flag is set
-            if self.ignore_retired_mappings and m_ocl['retired']:
-                continue
+        return cnt_ocl_total
 
-            # Display progress info
-            cnt += 1
-            if (cnt % 1000) == 1: print 'Validating %s to %s of %s mappings...' % (cnt, cnt - 1 + 1000, cnt_ocl_total)
-
-            # Determine the type of comparison to perform, compare, and handle results
-            ocl_map_type = str(m_ocl['map_type'])
-            if ocl_map_type == OclOpenmrsHelper.MAP_TYPE_Q_AND_A and m_ocl['to_source_name'] == 'CIEL':
-                mysql_matching_qanda_id = self.validate_qanda(m_ocl)
-                if mysql_matching_qanda_id:
-                    self.qanda_comparison[self.MISSING_IN_OCL].remove(mysql_matching_qanda_id)
-                else:
-                    self.qanda_comparison[self.MISSING_IN_MYSQL].append(m_ocl['id'])
-                    if self.verbosity >= 2: print 'Missing qanda in MySQL: %s\n' % m_ocl
-            elif ocl_map_type == OclOpenmrsHelper.MAP_TYPE_CONCEPT_SET and m_ocl['to_source_name'] == 'CIEL':
-                mysql_matching_conceptset_id = self.validate_concept_set(m_ocl)
-                if mysql_matching_conceptset_id:
-                    self.conceptset_comparison[self.MISSING_IN_OCL].remove(mysql_matching_conceptset_id)
-                else:
-                    self.conceptset_comparison[self.MISSING_IN_MYSQL].append(m_ocl['id'])
-                    if self.verbosity >= 2: print 'Missing concept set in MySQL: %s\n' % m_ocl
-            else:
-                mysql_matching_refmap_id = self.validate_reference_map(m_ocl)
-                if mysql_matching_refmap_id:
-                    self.refmap_comparison[self.MISSING_IN_OCL].remove(mysql_matching_refmap_id)
-                else:
-                    self.refmap_comparison[self.MISSING_IN_MYSQL].append(m_ocl['id'])
-                    if self.verbosity >= 2: print 'Missing reference map in MySQL: %s\n' % m_ocl
-
-        # Display results of comparison
+    def print_mapping_summary(self):
+        """ Outputs the results of the mapping comparison """
         print '\n\nMAPPING VALIDATION SUMMARY:'
         print '%s Q/A mapping(s) missing in OCL Export:\n' % len(self.qanda_comparison[self.MISSING_IN_OCL])
-        if self.verbosity >= 1: print self.qanda_comparison[self.MISSING_IN_OCL]
+        if self.verbosity >= 1: print sorted(self.qanda_comparison[self.MISSING_IN_OCL])
         print '\n%s Q/A mapping(s) missing in MySQL:\n' % len(self.qanda_comparison[self.MISSING_IN_MYSQL])
         if self.verbosity >= 1: print self.qanda_comparison[self.MISSING_IN_MYSQL]
         print '\n%s Concept Set(s) mappings missing in OCL Export:\n' % len(self.conceptset_comparison[self.MISSING_IN_OCL])
-        if self.verbosity >= 1: print self.conceptset_comparison[self.MISSING_IN_OCL]
+        if self.verbosity >= 1: print sorted(self.conceptset_comparison[self.MISSING_IN_OCL])
         print '\n%s Concept Set(s) mappings missing in MySQL:\n' % len(self.conceptset_comparison[self.MISSING_IN_MYSQL])
         if self.verbosity >= 1: print self.conceptset_comparison[self.MISSING_IN_MYSQL]
         print '\n%s Reference Map(s) missing in OCL Export:\n' % len(self.refmap_comparison[self.MISSING_IN_OCL])
-        if self.verbosity >= 1: print self.refmap_comparison[self.MISSING_IN_OCL]
+        if self.verbosity >= 1: print sorted(self.refmap_comparison[self.MISSING_IN_OCL])
         print '\n%s Reference Map(s) missing in MySQL:\n' % len(self.refmap_comparison[self.MISSING_IN_MYSQL])
         if self.verbosity >= 1: print self.refmap_comparison[self.MISSING_IN_MYSQL]
 
-    def validate_reference_map(self, m_ocl):
-        map_type = m_ocl['map_type']
-        from_concept_id = m_ocl['from_concept_code']
-        to_concept_code = m_ocl['to_concept_code']
-        to_source_name = OclOpenmrsHelper.get_omrs_source_id_from_ocl_id(m_ocl['to_source_name'])
-        try:
-            m_omrs = ConceptReferenceMap.objects.get(map_type__name=map_type,
-                                                     concept_reference_term__code=to_concept_code,
-                                                     concept_id=from_concept_id,
-                                                     concept_reference_term__concept_source__name=to_source_name)
-            return m_omrs.concept_map_id
-        except ConceptReferenceMap.DoesNotExist:
-            return False
-        except ConceptReferenceMap.MultipleObjectsReturned:
+    def validate_reference_map(self, m_ocl, omrs_index):
+        key = self.get_mapping_key(m_ocl, 'refmaps')
+        matches = omrs_index['refmaps'].get(key, [])
+        if len(matches) > 1:
             print 'Multiple objects returned from MySQL for reference mapping: %s\n' % m_ocl
             return False
+        return matches[0] if matches else False
 
-    def validate_qanda(self, m_ocl):
-        question_concept_id = m_ocl['from_concept_code']
-        answer_concept_id = m_ocl['to_concept_code']
-        try:
-            qa_omrs = ConceptAnswer.objects.get(question_concept_id=question_concept_id,
-                                                answer_concept_id=answer_concept_id)
-            return qa_omrs.concept_answer_id
-        except ConceptAnswer.DoesNotExist:
-            return False
-        except ConceptAnswer.MultipleObjectsReturned:
+    def validate_qanda(self, m_ocl, omrs_index):
+        key = self.get_mapping_key(m_ocl, 'qanda')
+        matches = omrs_index['qanda'].get(key, [])
+        if len(matches) > 1:
             print 'Multiple objects returned for qanda: %s\n' % m_ocl
             return False
+        return matches[0] if matches else False
 
-    def validate_concept_set(self, m_ocl):
-        set_owner_id = m_ocl['from_concept_code']
-        set_member_id = m_ocl['to_concept_code']
-        try:
-            cs_omrs = ConceptSet.objects.get(concept_set_owner_id=set_owner_id,
-                                             concept_id=set_member_id)
-            return cs_omrs.concept_set_id
-        except ConceptSet.DoesNotExist:
-            return False
-        except ConceptSet.MultipleObjectsReturned:
+    def validate_concept_set(self, m_ocl, omrs_index):
+        key = self.get_mapping_key(m_ocl, 'conceptsets')
+        matches = omrs_index['conceptsets'].get(key, [])
+        if len(matches) > 1:
             print 'Multiple objects returned for concept set: %s\n' % m_ocl
             return False
+        return matches[0] if matches else False
+
+
+    ## DATABASE-SIDE (PUSHDOWN) VALIDATION
+
+    def validate_export_pushdown(self, cursor, data, omrs_counts):
+        """
+        Validates the export by loading the OCL keys into temporary tables and letting the
+        database compute both sides of the comparison with LEFT JOIN anti-joins. Only the
+        discrepancies are returned from MySQL. The tables are emptied first, since they are
+        created once for all the exports.
+        """
+        for table in self.PUSHDOWN_TABLES:
+            cursor.execute('DELETE FROM %s' % table)
+        self.validate_concepts_pushdown(cursor, data, omrs_counts)
+        self.validate_mappings_pushdown(cursor, data, omrs_counts)
+
+    def create_pushdown_tables(self, cursor):
+        """ Creates the temporary staging tables that hold the keys of the OCL export """
+        cursor.execute('CREATE TEMPORARY TABLE ocl_concept_key (concept_id INTEGER NOT NULL)')
+        cursor.execute('CREATE INDEX ocl_concept_key_idx ON ocl_concept_key (concept_id)')
+        cursor.execute('CREATE TEMPORARY TABLE ocl_qanda_key ('
+                       'ocl_id VARCHAR(255) NOT NULL, question INTEGER NOT NULL, answer INTEGER NOT NULL)')
+        cursor.execute('CREATE INDEX ocl_qanda_key_idx ON ocl_qanda_key (question, answer)')
+        cursor.execute('CREATE TEMPORARY TABLE ocl_set_key ('
+                       'ocl_id VARCHAR(255) NOT NULL, set_owner INTEGER NOT NULL, set_member INTEGER NOT NULL)')
+        cursor.execute('CREATE INDEX ocl_set_key_idx ON ocl_set_key (set_owner, set_member)')
+        cursor.execute('CREATE TEMPORARY TABLE ocl_refmap_key ('
+                       'ocl_id VARCHAR(255) NOT NULL, concept_id INTEGER NOT NULL, '
+                       'source_name VARCHAR(50), code VARCHAR(255) NOT NULL, map_type VARCHAR(255) NOT NULL)')
+        cursor.execute('CREATE INDEX ocl_refmap_key_idx ON ocl_refmap_key (concept_id, code, source_name, map_type)')
+
+    def drop_pushdown_tables(self, cursor):
+        """ Drops the temporary staging tables, never a permanent table that has the same name """
+        drop = 'DROP TEMPORARY TABLE' if connections[self.database].vendor == 'mysql' else 'DROP TABLE'
+        for table in self.PUSHDOWN_TABLES:
+            cursor.execute('%s IF EXISTS %s' % (drop, table))
+
+    def bulk_insert(self, cursor, table, columns, rows):
+        """ Loads rows into a staging table using multi-row inserts of PUSHDOWN_BATCH_SIZE rows """
+        sql = 'INSERT INTO %s (%s) VALUES (%s)' % (
+            table, ', '.join(columns), ', '.join(['%s'] * len(columns)))
+        for i in range(0, len(rows), self.PUSHDOWN_BATCH_SIZE):
+            cursor.executemany(sql, rows[i:i + self.PUSHDOWN_BATCH_SIZE])
+
+    def validate_concepts_pushdown(self, cursor, data, omrs_counts):
+        """ Compares concept IDs using the ocl_concept_key staging table """
+        print '\nVALIDATING CONCEPTS (PUSHDOWN):'
+
+        # IDs that are not numeric cannot exist in MySQL, so they are reported without a lookup
+        rows = []
+        missing_in_mysql = {}
+        for c_ocl in data['concepts']:
+            try:
+                rows.append((int(c_ocl['id']),))
+            except ValueError:
+                missing_in_mysql[c_ocl['id']] = 0
+        self.bulk_insert(cursor, 'ocl_concept_key', ['concept_id'], rows)
+
+        count_mysql = omrs_counts['concepts']
+        count_ocl = len(data['concepts'])
+        if count_ocl == count_mysql:
+            print 'Concept count comparison: OCL %s == MYSQL %s\n' % (count_ocl, count_mysql)
+        else:
+            print 'Concept count comparison: OCL %s != MYSQL %s\n' % (count_ocl, count_mysql)
+
+        cursor.execute('SELECT c.concept_id FROM concept c '
+                       'LEFT JOIN ocl_concept_key k ON k.concept_id = c.concept_id '
+                       'WHERE k.concept_id IS NULL')
+        missing_in_ocl = dict((str(row[0]), 0) for row in cursor.fetchall())
+        cursor.execute('SELECT k.concept_id FROM ocl_concept_key k '
+                       'LEFT JOIN concept c ON c.concept_id = k.concept_id '
+                       'WHERE c.concept_id IS NULL')
+        for row in cursor.fetchall():
+            missing_in_mysql[unicode(row[0])] = 0
+        # As in validate_concepts(), an ID repeated in the export is only matched once
+        cursor.execute('SELECT concept_id FROM ocl_concept_key GROUP BY concept_id HAVING COUNT(*) > 1')
+        for row in cursor.fetchall():
+            missing_in_mysql[unicode(row[0])] = 0
+
+        print '\n\nCONCEPT VALIDATION SUMMARY:'
+        print '\n%s concept IDs missing in OCL:\n' % len(missing_in_ocl)
+        print missing_in_ocl
+        print '\n%s concept IDs missing in MySQL:\n' % len(missing_in_mysql)
+        print missing_in_mysql
+        self.check_duplicate_ids(data, missing_in_mysql)
+        print '\nSkipping deep comparison of concepts...\n'
+
+    def validate_mappings_pushdown(self, cursor, data, omrs_counts):
+        """
+        Compares Q-AND-A, concept set and reference map keys using the staging tables. The
+        mappings are classified exactly as in validate_mappings().
+        """
+        self.compare_mapping_counts(data, omrs_counts)
+        print '\nVALIDATING MAPPINGS (PUSHDOWN):'
+        qanda_rows = []
+        conceptset_rows = []
+        refmap_rows = []
+        self.qanda_comparison = {self.MISSING_IN_OCL: [], self.MISSING_IN_MYSQL: []}
+        self.conceptset_comparison = {self.MISSING_IN_OCL: [], self.MISSING_IN_MYSQL: []}
+        self.refmap_comparison = {self.MISSING_IN_OCL: [], self.MISSING_IN_MYSQL: []}
+        comparisons = {'qanda': self.qanda_comparison, 'conceptsets': self.conceptset_comparison,
+                       'refmaps': self.refmap_comparison}
+        key_rows = {'qanda': qanda_rows, 'conceptsets': conceptset_rows, 'refmaps': refmap_rows}
+        for m_ocl in data['mappings']:
+            if self.ignore_retired_mappings and m_ocl['retired']:
+                continue
+            try:
+                from_concept_id = int(m_ocl['from_concept_code'])
+            except ValueError:
+                from_concept_id = None
+            table = self.get_mapping_table(m_ocl)
+            comparison, rows = comparisons[table], key_rows[table]
+            if from_concept_id is None:
+                comparison[self.MISSING_IN_MYSQL].append(m_ocl['id'])
+            elif table == 'refmaps':
+                rows.append((m_ocl['id'], from_concept_id,
+                             OclOpenmrsHelper.get_omrs_source_id_from_ocl_id(m_ocl['to_source_name']),
+                             m_ocl['to_concept_code'], str(m_ocl['map_type'])))
+            else:
+                try:
+                    rows.append((m_ocl['id'], from_concept_id, int(m_ocl['to_concept_code'])))
+                except ValueError:
+                    comparison[self.MISSING_IN_MYSQL].append(m_ocl['id'])
+        self.bulk_insert(cursor, 'ocl_qanda_key', ['ocl_id', 'question', 'answer'], qanda_rows)
+        self.bulk_insert(cursor, 'ocl_set_key', ['ocl_id', 'set_owner', 'set_member'], conceptset_rows)
+        self.bulk_insert(cursor, 'ocl_refmap_key',
+                         ['ocl_id', 'concept_id', 'source_name', 'code', 'map_type'], refmap_rows)
+
+        # Q-AND-A
+        cursor.execute('SELECT a.concept_answer_id FROM concept_answer a '
+                       'LEFT JOIN ocl_qanda_key k ON k.question = a.concept_id AND k.answer = a.answer_concept '
+                       'WHERE k.ocl_id IS NULL')
+        self.qanda_comparison[self.MISSING_IN_OCL] += [row[0] for row in cursor.fetchall()]
+        cursor.execute('SELECT k.ocl_id FROM ocl_qanda_key k '
+                       'LEFT JOIN concept_answer a ON a.concept_id = k.question AND a.answer_concept = k.answer '
+                       'WHERE a.concept_answer_id IS NULL')
+        self.qanda_comparison[self.MISSING_IN_MYSQL] += [row[0] for row in cursor.fetchall()]
+
+        # Concept sets
+        cursor.execute('SELECT s.concept_set_id FROM concept_set s '
+                       'LEFT JOIN ocl_set_key k ON k.set_owner = s.concept_set AND k.set_member = s.concept_id '
+                       'WHERE k.ocl_id IS NULL')
+        self.conceptset_comparison[self.MISSING_IN_OCL] += [row[0] for row in cursor.fetchall()]
+        cursor.execute('SELECT k.ocl_id FROM ocl_set_key k '
+                       'LEFT JOIN concept_set s ON s.concept_set = k.set_owner AND s.concept_id = k.set_member '
+                       'WHERE s.concept_set_id IS NULL')
+        self.conceptset_comparison[self.MISSING_IN_MYSQL] += [row[0] for row in cursor.fetchall()]
+
+        # Reference maps, excluding the CIEL source as in validate_mappings()
+        cursor.execute('SELECT m.concept_map_id FROM concept_reference_map m '
+                       'JOIN concept_reference_term t ON t.concept_reference_term_id = m.concept_reference_term_id '
+                       'JOIN concept_reference_source s ON s.concept_source_id = t.concept_source_id '
+                       'JOIN concept_map_type mt ON mt.concept_map_type_id = m.concept_map_type_id '
+                       'LEFT JOIN ocl_refmap_key k ON k.concept_id = m.concept_id AND k.code = t.code '
+                       'AND k.source_name = s.name AND k.map_type = mt.name '
+                       "WHERE s.name <> 'CIEL' AND k.ocl_id IS NULL")
+        self.refmap_comparison[self.MISSING_IN_OCL] += [row[0] for row in cursor.fetchall()]
+        cursor.execute('SELECT DISTINCT k.ocl_id FROM ocl_refmap_key k '
+                       'LEFT JOIN concept_reference_source s ON s.name = k.source_name '
+                       'LEFT JOIN concept_reference_term t ON t.concept_source_id = s.concept_source_id AND t.code = k.code '
+                       'LEFT JOIN concept_map_type mt ON mt.name = k.map_type '
+                       'LEFT JOIN concept_reference_map m ON m.concept_id = k.concept_id '
+                       'AND m.concept_reference_term_id = t.concept_reference_term_id '
+                       'AND m.concept_map_type_id = mt.concept_map_type_id '
+                       'WHERE m.concept_map_id IS NULL')
+        self.refmap_comparison[self.MISSING_IN_MYSQL] += [row[0] for row in cursor.fetchall()]
+
+        self.print_mapping_summary()
+
+
+
+## HELPER METHOD
+
+def index_key(*values):
+    """
+    Utility function: Returns a hashable key of lowercase unicode values used by the OpenMRS index,
+    so that codes and names that only differ in case match, as with MySQL's collation
+    """
+    return tuple(unicode(value).lower() for value in values)
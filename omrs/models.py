@@ -9,9 +9,111 @@
 # into your database.
 from __future__ import unicode_literals
 
+from itertools import islice
 from django.db import models
 
 
+class ConceptQuerySet(models.query.QuerySet):
+    """
+    QuerySet of concepts that can fetch the rows exported to OCL, or the preferred names of the
+    concepts, with a few queries per batch of concepts instead of a few queries per concept
+    """
+
+    # Rows of a concept that extract_db exports with the concept, and as its mappings
+    CONCEPT_GRAPH = (
+        'conceptname_set',
+        'conceptdescription_set',
+        'conceptnumeric_set',
+    )
+    MAPPING_GRAPH = (
+        'conceptreferencemap_set__concept_reference_term__concept_source',
+        'conceptreferencemap_set__map_type',
+        'question_answer',
+        'conceptset_set',
+    )
+
+    # Number of concepts whose preferred names are loaded per query
+    PREFERRED_NAMES_BATCH_SIZE = 500
+
+    # Set by preferred_names()
+    _with_preferred_names = False
+    _preferred_names_locale = None
+
+    def with_export_graph(self, concepts=True, mappings=True):
+        """
+        Fetches the class and datatype of the concepts with a join and, when the queryset is
+        evaluated, with one query per relation: their names, descriptions and numerics if
+        'concepts', and their reference maps (with terms, sources and map types), answers and set
+        members if 'mappings'. Use in_batches() to keep the IN lists of these queries short.
+        """
+        lookups = (concepts and self.CONCEPT_GRAPH or ()) + (mappings and self.MAPPING_GRAPH or ())
+        return self.select_related('concept_class', 'datatype').prefetch_related(*lookups)
+
+    def preferred_names(self, locale=None):
+        """
+        Loads the preferred names of the concepts in a locale (or in every locale if None) with
+        one query per PREFERRED_NAMES_BATCH_SIZE concepts, and caches them on each concept for
+        Concept.get_preferred_name()
+        """
+        return self._clone(_with_preferred_names=True, _preferred_names_locale=locale)
+
+    def in_batches(self, batch_size=100):
+        """
+        Yields the concepts in concept_id order, fetching batch_size of them at a time, so that the
+        queries of with_export_graph() stay within the parameter limits of the database
+        """
+        queryset = self.order_by('concept_id')
+        last_concept_id = None
+        while True:
+            batch = queryset
+            if last_concept_id is not None:
+                batch = batch.filter(concept_id__gt=last_concept_id)
+            batch = list(batch[:batch_size])
+            if not batch:
+                return
+            for concept in batch:
+                yield concept
+            last_concept_id = batch[-1].concept_id
+
+    def iterator(self):
+        concepts = super(ConceptQuerySet, self).iterator()
+        if self._with_preferred_names:
+            concepts = self._load_preferred_names(concepts)
+        return concepts
+
+    def _load_preferred_names(self, concepts):
+        while True:
+            batch = list(islice(concepts, self.PREFERRED_NAMES_BATCH_SIZE))
+            if not batch:
+                return
+            names = ConceptName.objects.using(self.db).filter(
+                concept__in=[concept.concept_id for concept in batch], locale_preferred=True, voided=False)
+            if self._preferred_names_locale is not None:
+                names = names.filter(locale=self._preferred_names_locale)
+            names_by_concept = {}
+            for concept_id, locale, name in names.order_by('concept_name_id').values_list('concept', 'locale', 'name'):
+                names_by_concept.setdefault(concept_id, []).append((locale, name))
+            for concept in batch:
+                concept.cache_preferred_names(names_by_concept.get(concept.concept_id, []), self._preferred_names_locale)
+                yield concept
+
+    def _clone(self, klass=None, setup=False, **kwargs):
+        kwargs.setdefault('_with_preferred_names', self._with_preferred_names)
+        kwargs.setdefault('_preferred_names_locale', self._preferred_names_locale)
+        return super(ConceptQuerySet, self)._clone(klass, setup, **kwargs)
+
+
+class ConceptManager(models.Manager):
+    def get_queryset(self):
+        return ConceptQuerySet(self.model, using=self._db)
+
+    def with_export_graph(self, concepts=True, mappings=True):
+        return self.get_queryset().with_export_graph(concepts, mappings)
+
+    def preferred_names(self, locale=None):
+        return self.get_queryset().preferred_names(locale)
+
+
 class Concept(models.Model):
     concept_id = models.AutoField(primary_key=True)
     retired = models.BooleanField()
@@ -33,9 +135,38 @@ class Concept(models.Model):
     retire_reason = models.CharField(max_length=255, blank=True)
     uuid = models.CharField(unique=True, max_length=38)
 
+    objects = ConceptManager()
+
     def __unicode__(self):
-        rs = self.conceptname_set.filter(locale_preferred=True)
-        return rs[0].name
+        name = self.get_preferred_name()
+        return name if name is not None else unicode(self.concept_id)
+
+    def get_preferred_name(self, locale=None):
+        """
+        Returns the preferred name of the concept in a locale, or its first preferred name in any
+        locale if locale is None, or None if it has none. The names are loaded with one query on
+        first use and cached, unless the concept was fetched with ConceptQuerySet.preferred_names().
+        """
+        cache = getattr(self, '_preferred_names', {})
+        if locale in cache:
+            return cache[locale]
+        if None in cache:
+            # Every locale was loaded
+            return None
+        names = self.conceptname_set.filter(locale_preferred=True, voided=False).order_by('concept_name_id')
+        self.cache_preferred_names(names.values_list('locale', 'name'))
+        return self._preferred_names.get(locale)
+
+    def cache_preferred_names(self, names, locale=None):
+        """ Caches (locale, name) preferred names, of one locale or of every locale if locale is None """
+        cache = self.__dict__.setdefault('_preferred_names', {})
+        names = list(names)
+        if locale is not None:
+            cache[locale] = names[0][1] if names else None
+            return
+        for name_locale, name in names:
+            cache.setdefault(name_locale, name)
+        cache[None] = names[0][1] if names else None
 
     class Meta:
         managed = False
@@ -0,0 +1,29 @@
+"""
+Database routers of the ocl_omrs project.
+"""
+
+
+class ReadDatabaseRouter(object):
+    """
+    Sends the reads of the read-only commands (extract_db, validate_export) to the database they
+    select with use_for_reads(), e.g. a replica of the OpenMRS database, so that their scans do not
+    load the primary. Reads through a model instance, e.g. concept.conceptname_set, stay on the
+    database the instance was loaded from. Until a command selects a database, and for writes,
+    the router has no opinion, so commands that pass their database explicitly such as
+    sync_bahmni_db are not affected.
+    """
+
+    read_database = None
+
+    @classmethod
+    def use_for_reads(cls, alias):
+        cls.read_database = alias
+
+    def db_for_read(self, model, **hints):
+        instance = hints.get('instance')
+        if instance is not None and instance._state.db:
+            return instance._state.db
+        return self.read_database
+
+    def db_for_write(self, model, **hints):
+        return None
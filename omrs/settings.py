@@ -49,9 +49,24 @@ DATABASES = {
         'PASSWORD': 'admin',
         'HOST': '192.168.33.17',
         'PORT': '3306',
-    }
+    },
+    # A read replica of 'default' for the read-only commands, e.g.:
+    # 'replica': {
+    #     'ENGINE': 'django.db.backends.mysql',
+    #     'NAME': 'refapp',
+    #     'USER': 'readonly',
+    #     'PASSWORD': 'readonly',
+    #     'HOST': '192.168.33.18',
+    #     'PORT': '3306',
+    # },
 }
 
+# Database that extract_db and validate_export read from (e.g. 'replica'), unless they are given
+# a 'database' option. sync_bahmni_db and check_indexes ignore it and use their own 'database'
+# option, which defaults to 'default'.
+READ_DATABASE = 'default'
+DATABASE_ROUTERS = ['omrs.routers.ReadDatabaseRouter']
+
 LANGUAGE_CODE = 'en-us'
 TIME_ZONE = 'UTC'
 USE_I18N = True
@@ -0,0 +1,28 @@
+"""
+Tests of the ocl_omrs commands and their helpers. The OpenMRS models are unmanaged, so the test
+database has none of their tables: tests that need some create them with create_tables().
+"""
+from django.core.management.color import no_style
+from django.db import connections
+
+
+def create_tables(models, using='default'):
+    """ Creates the tables of unmanaged models, without their foreign key constraints """
+    connection = connections[using]
+    cursor = connection.cursor()
+    for model in models:
+        model._meta.managed = True
+        try:
+            statements = connection.creation.sql_create_model(model, no_style())[0]
+        finally:
+            model._meta.managed = False
+        for sql in statements:
+            cursor.execute(sql)
+
+
+def drop_tables(models, using='default'):
+    """ Drops the tables made by create_tables() """
+    connection = connections[using]
+    cursor = connection.cursor()
+    for model in models:
+        cursor.execute('DROP TABLE %s' % connection.ops.quote_name(model._meta.db_table))
@@ -0,0 +1,72 @@
+"""
+Tests of the baseline check of the benchmark command, run on saved results with --results.
+"""
+import copy, json, os, shutil, subprocess, sys, tempfile
+from django.test import SimpleTestCase
+
+MANAGE_PY = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), 'manage.py')
+
+
+class BenchmarkBaselineTest(SimpleTestCase):
+
+    BASELINE = {
+        'seed': 1,
+        'scales': [{
+            'concepts': 1000,
+            'rows': 10240,
+            'steps': [
+                {'step': 'extract_db concepts', 'queries': 40, 'time': 1.0, 'peak_rss_kb': 50000},
+                {'step': 'sync_bahmni_db', 'queries': 300, 'max_queries': 310, 'time': 2.0, 'peak_rss_kb': 40000},
+            ],
+        }],
+    }
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='ocl_test_benchmark_')
+        self.baseline_filename = self.write_json('baseline.json', self.BASELINE)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write_json(self, name, data):
+        filename = os.path.join(self.directory, name)
+        with open(filename, 'w') as output_file:
+            json.dump(data, output_file)
+        return filename
+
+    def check(self, changes, *args):
+        """ Checks results that differ from the baseline by changes, {step: {key: value}}, and returns the exit status """
+        results = copy.deepcopy(self.BASELINE)
+        for step in results['scales'][0]['steps']:
+            step.pop('max_queries', None)
+            step.update(changes.get(step['step'], {}))
+        command = [sys.executable, MANAGE_PY, 'benchmark', '--baseline=%s' % self.baseline_filename,
+                   '--results=%s' % self.write_json('results.json', results)] + list(args)
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=env)
+        self.output = process.communicate()[0]
+        return process.returncode
+
+    def test_within_budget(self):
+        self.assertEqual(self.check({'extract_db concepts': {'queries': 44}, 'sync_bahmni_db': {'queries': 310}}), 0)
+        self.assertIn('All steps are within their budget', self.output)
+
+    def test_queries_over_tolerance(self):
+        self.assertEqual(self.check({'extract_db concepts': {'queries': 45}}), 1)
+        self.assertIn('1 step(s) exceeded their budget', self.output)
+
+    def test_queries_over_max_queries(self):
+        # 311 queries are within the 10% tolerance, but over the max_queries of the step
+        self.assertEqual(self.check({'sync_bahmni_db': {'queries': 311}}), 1)
+
+    def test_time_is_advisory(self):
+        self.assertEqual(self.check({'sync_bahmni_db': {'time': 10.0}}), 0)
+        self.assertIn('SLOW', self.output)
+
+    def test_enforce_time(self):
+        self.assertEqual(self.check({'sync_bahmni_db': {'time': 10.0}}, '--enforce_time'), 1)
+
+    def test_results_require_baseline(self):
+        self.assertEqual(subprocess.call([sys.executable, MANAGE_PY, 'benchmark', '--results=missing.json'],
+                                         env=dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path)),
+                                         stdout=open(os.devnull, 'w'), stderr=subprocess.STDOUT), 1)
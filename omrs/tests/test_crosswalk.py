@@ -0,0 +1,122 @@
+"""
+Tests of ConceptCrosswalk and of the journal of JournaledIndex, which keeps the in-memory indexes
+of a sync consistent with the database when a group of 'commit_every' records is rolled back.
+"""
+import os, shutil, sys, tempfile
+from StringIO import StringIO
+from django.test import SimpleTestCase, TestCase
+from django.utils import timezone
+from omrs.models import ConceptReferenceMap
+from omrs.management.commands import BulkWriter, ConceptCrosswalk, JournaledIndex
+from omrs.management.commands.sync_bahmni_db import Command
+from omrs.tests import create_tables, drop_tables
+
+
+class ConceptCrosswalkTest(SimpleTestCase):
+
+    def setUp(self):
+        self.crosswalk = ConceptCrosswalk()
+        self.crosswalk.add(1, 101)
+        self.crosswalk.add('2', '102')
+
+    def test_get_new_id(self):
+        self.assertEqual(self.crosswalk.get_new_id(1), 101)
+        self.assertEqual(self.crosswalk.get_new_id('2'), 102)
+        self.assertEqual(len(self.crosswalk), 2)
+
+    def test_miss(self):
+        self.assertIsNone(self.crosswalk.get_new_id(3))
+        self.assertIsNone(self.crosswalk.get_new_id('3'))
+        self.assertIsNone(self.crosswalk.get_new_id(None))
+
+    def test_save_and_load(self):
+        directory = tempfile.mkdtemp(prefix='ocl_test_crosswalk_')
+        try:
+            filename = os.path.join(directory, 'crosswalk.tsv')
+            self.crosswalk.save(filename)
+            with open(filename) as crosswalk_file:
+                self.assertEqual(crosswalk_file.read(), '1\t101\n2\t102\n')
+            crosswalk = ConceptCrosswalk.load(filename)
+        finally:
+            shutil.rmtree(directory)
+        self.assertEqual(crosswalk.values, {1: 101, 2: 102})
+
+    def test_rollback(self):
+        self.crosswalk.begin()
+        self.crosswalk.add(3, 103)
+        self.crosswalk.add(1, 201)
+        self.crosswalk.add(1, 301)
+        self.crosswalk.rollback()
+        self.assertEqual(self.crosswalk.values, {1: 101, 2: 102})
+        self.assertIsNone(self.crosswalk.journal)
+
+    def test_commit(self):
+        self.crosswalk.begin()
+        self.crosswalk.add(3, 103)
+        self.crosswalk.commit()
+        self.crosswalk.rollback()
+        self.assertEqual(self.crosswalk.get_new_id(3), 103)
+
+    def test_no_journal_outside_of_begin(self):
+        self.crosswalk.add(3, 103)
+        self.assertIsNone(self.crosswalk.journal)
+        self.crosswalk.rollback()
+        self.assertEqual(self.crosswalk.get_new_id(3), 103)
+
+
+class FailedGroupCommitTest(TestCase):
+    """ commit_batch() of sync_bahmni_db with groups of (old concept ID, new concept ID, map uuid) records """
+
+    @classmethod
+    def setUpClass(cls):
+        super(FailedGroupCommitTest, cls).setUpClass()
+        create_tables([ConceptReferenceMap])
+
+    @classmethod
+    def tearDownClass(cls):
+        drop_tables([ConceptReferenceMap])
+        super(FailedGroupCommitTest, cls).tearDownClass()
+
+    def setUp(self):
+        self.command = Command()
+        self.command.database = 'default'
+        self.command.write_lock = None
+        self.command.failed_batches = []
+        self.command.writer = BulkWriter()
+        self.command.crosswalk = ConceptCrosswalk()
+        for name in ('concept_names', 'concept_classes', 'datatypes', 'reference_sources', 'map_types',
+                     'reference_terms'):
+            setattr(self.command, name, JournaledIndex())
+
+    def process_record(self, record):
+        old_concept_id, new_concept_id, map_uuid = record
+        self.command.crosswalk.add(old_concept_id, new_concept_id)
+        self.command.writer.add(ConceptReferenceMap(
+            concept_id=new_concept_id, concept_reference_term_id=1, map_type_id=1, uuid=map_uuid, creator=1,
+            date_created=timezone.now()))
+
+    def commit_batch(self, batch):
+        stdout, sys.stdout = sys.stdout, StringIO()
+        try:
+            self.command.commit_batch(batch, self.process_record, 'Concepts', lambda record: record[0])
+        finally:
+            sys.stdout = stdout
+
+    def test_failed_group_is_rolled_back(self):
+        self.commit_batch([(1, 101, 'uuid-1'), (2, 102, 'uuid-2')])
+        # The duplicate uuid fails the insert of the second group
+        self.commit_batch([(3, 103, 'uuid-3'), (1, 201, 'uuid-4'), (4, 104, 'uuid-1')])
+
+        self.assertEqual(self.command.crosswalk.values, {1: 101, 2: 102})
+        self.assertIsNone(self.command.crosswalk.get_new_id(3))
+        self.assertEqual(sorted(ConceptReferenceMap.objects.values_list('uuid', flat=True)), ['uuid-1', 'uuid-2'])
+        self.assertEqual(len(self.command.failed_batches), 1)
+        self.assertEqual(self.command.failed_batches[0][:3], ('Concepts', 3, 4))
+        self.assertIsNone(self.command.writer.get_pending(ConceptReferenceMap, None))
+        self.assertEqual(self.command.writer.cnt_pending, 0)
+
+    def test_next_group_after_failure(self):
+        self.commit_batch([(1, 101, 'uuid-1'), (2, 101, 'uuid-1')])
+        self.commit_batch([(3, 103, 'uuid-3')])
+        self.assertEqual(self.command.crosswalk.values, {3: 103})
+        self.assertEqual(list(ConceptReferenceMap.objects.values_list('uuid', flat=True)), ['uuid-3'])
@@ -0,0 +1,106 @@
+"""
+Tests of the parsing of the concept URLs of mappings and of the existence checks of ExistingRows.
+"""
+from django.test import SimpleTestCase, TestCase
+from django.utils import timezone
+from omrs.models import ConceptName, ConceptReferenceMap
+from omrs.management.commands import ExistingRows, MappingRecord
+from omrs.tests import create_tables, drop_tables
+
+
+class ParseUrlTest(SimpleTestCase):
+
+    def test_concept_url(self):
+        self.assertEqual(MappingRecord.parse_url('/orgs/CIEL/sources/CIEL/concepts/1234/'), ('CIEL', 1234))
+
+    def test_relative_url(self):
+        self.assertEqual(MappingRecord.parse_url('orgs/CIEL/sources/CIEL/concepts/1234/'), ('CIEL', 1234))
+
+    def test_absolute_url(self):
+        self.assertEqual(MappingRecord.parse_url('https://api.openconceptlab.org/orgs/CIEL/sources/CIEL/concepts/1234/'),
+                         ('CIEL', 1234))
+
+    def test_no_trailing_slash(self):
+        self.assertEqual(MappingRecord.parse_url('/orgs/CIEL/sources/CIEL/concepts/1234'), ('CIEL', 1234))
+
+    def test_source_url(self):
+        self.assertEqual(MappingRecord.parse_url('/orgs/IHTSDO/sources/SNOMED-CT/'), ('SNOMED-CT', None))
+        self.assertEqual(MappingRecord.parse_url('/orgs/IHTSDO/sources/SNOMED-CT'), ('SNOMED-CT', None))
+
+    def test_malformed_url(self):
+        self.assertEqual(MappingRecord.parse_url(None), (None, None))
+        self.assertEqual(MappingRecord.parse_url(''), (None, None))
+        self.assertEqual(MappingRecord.parse_url('/orgs/CIEL/'), (None, None))
+        self.assertEqual(MappingRecord.parse_url('/orgs/CIEL/sources/'), (None, None))
+        self.assertEqual(MappingRecord.parse_url('/orgs/CIEL/sources/CIEL/concepts/'), ('CIEL', None))
+        self.assertEqual(MappingRecord.parse_url('/orgs/CIEL/sources/CIEL/concepts/abc/'), ('CIEL', None))
+        self.assertEqual(MappingRecord.parse_url('/orgs/CIEL/sources/CIEL/mappings/1234/'), ('CIEL', None))
+
+    def test_mapping_record(self):
+        mapping = MappingRecord({'from_concept_url': '/orgs/CIEL/sources/CIEL/concepts/1/', 'map_type': 'SAME-AS',
+                                 'to_source_url': '/orgs/IHTSDO/sources/SNOMED-CT/', 'to_concept_code': '123'})
+        self.assertEqual((mapping.kind, mapping.from_source, mapping.from_concept_id, mapping.to_source),
+                         (MappingRecord.EXTERNAL, 'CIEL', 1, 'SNOMED-CT'))
+
+
+class ExistingRowsTest(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super(ExistingRowsTest, cls).setUpClass()
+        create_tables([ConceptName, ConceptReferenceMap])
+
+    @classmethod
+    def tearDownClass(cls):
+        drop_tables([ConceptName, ConceptReferenceMap])
+        super(ExistingRowsTest, cls).tearDownClass()
+
+    def setUp(self):
+        now = timezone.now()
+        for i in range(1, 4):
+            ConceptName.objects.create(concept_name_id=i, concept_id=i, name='Name %s' % i, locale='en', creator=1,
+                                       date_created=now, voided=False, uuid='NAME-UUID-%s' % i,
+                                       locale_preferred=False)
+            ConceptReferenceMap.objects.create(concept_id=i, concept_reference_term_id=10 + i, map_type_id=1,
+                                               uuid='map-uuid-%s' % i, creator=1, date_created=now)
+        self.existing = ExistingRows()
+
+    def test_load_by_uuid(self):
+        self.existing.load(ConceptName, 'uuid', ['NAME-UUID-1', 'NAME-UUID-2', 'NAME-UUID-9'])
+        self.assertTrue(self.existing.get(ConceptName, 'NAME-UUID-1'))
+        self.assertTrue(self.existing.get(ConceptName, 'name-uuid-2'))
+        self.assertIsNone(self.existing.get(ConceptName, 'NAME-UUID-3'))
+        self.assertIsNone(self.existing.get(ConceptName, 'NAME-UUID-9'))
+        self.assertIsNone(self.existing.get(ConceptReferenceMap, 'map-uuid-1'))
+
+    def test_load_value_field(self):
+        self.existing.load(ConceptName, 'uuid', ['NAME-UUID-2', None], value_field='concept_id')
+        self.assertEqual(self.existing.get(ConceptName, 'NAME-UUID-2'), 2)
+        self.assertIsNone(self.existing.get(ConceptName, None))
+
+    def test_load_replaces_rows(self):
+        self.existing.load(ConceptName, 'uuid', ['NAME-UUID-1'])
+        self.existing.load(ConceptName, 'uuid', ['NAME-UUID-2'])
+        self.assertIsNone(self.existing.get(ConceptName, 'NAME-UUID-1'))
+        self.assertTrue(self.existing.get(ConceptName, 'NAME-UUID-2'))
+
+    def test_add_queued_row(self):
+        self.existing.load(ConceptName, 'uuid', ['NAME-UUID-4'])
+        self.existing.add(ConceptName, True, 'NAME-UUID-4')
+        self.assertTrue(self.existing.get(ConceptName, 'name-uuid-4'))
+
+    def test_load_by_natural_key(self):
+        """ A mapping is matched by its concept, term and map type, whatever its uuid """
+        self.existing.load(ConceptReferenceMap, 'concept_id', [1, 2],
+                           key_fields=('concept_id', 'concept_reference_term_id', 'map_type_id'))
+        self.assertTrue(self.existing.get(ConceptReferenceMap, 1, 11, 1))
+        self.assertTrue(self.existing.get(ConceptReferenceMap, 2, 12, 1))
+        self.assertIsNone(self.existing.get(ConceptReferenceMap, 1, 11, 2))
+        self.assertIsNone(self.existing.get(ConceptReferenceMap, 3, 13, 1))
+        self.assertIsNone(self.existing.get(ConceptReferenceMap, 'map-uuid-1'))
+
+    def test_query_batches(self):
+        self.existing.QUERY_BATCH_SIZE = 2
+        self.existing.load(ConceptName, 'uuid', ['NAME-UUID-%s' % i for i in range(1, 6)], value_field='concept_id')
+        self.assertEqual([self.existing.get(ConceptName, 'NAME-UUID-%s' % i) for i in range(1, 6)],
+                         [1, 2, 3, None, None])